@@ -0,0 +1,255 @@
+"""The async engine: crawl() on an asyncio event loop with aiohttp.
+
+Kept apart from main6 so that asyncio and aiohttp are only imported by
+runs that use engine="async". It is not throttled per host beyond
+aiohttp's connection limit: there is no HostScheduler (adaptive limits,
+host_rate, robots.txt Crawl-delay, circuit breaker) and no segmented
+downloads. Failed pages and resources are still retried as the
+RetryPolicy says, and 429/503 responses are waited out for their Retry-After (capped at
+MAX_THROTTLE_DELAY).
+"""
+import asyncio
+import functools
+import io
+import time
+from urllib.parse import urlparse
+
+from archive import new_buffer
+from crawler import is_stylesheet, normalize_url, parse_page
+from logs import LOGGER, progress_bar
+from main6 import CHUNK_SIZE, handle_stylesheet, save_cached, save_page, text_decoder, update_score
+from metrics import METRICS
+from politeness import MAX_THROTTLED, THROTTLE_STATUSES, Throttled, retry_after_seconds, throttle_delay
+from retry import RetryPolicy
+from rewrite import LocalPaths
+from tracing import span
+from transport import DNS_TTL
+
+
+async def async_save_response(response, writer, arcname, cache=None, url=None, on_resource=None, paths=None):
+    """Async counterpart of save_response() for aiohttp responses."""
+    body = new_buffer()
+    try:
+        async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+            body.write(chunk)
+        METRICS.record_body(url or str(response.url), response.headers.get("Content-Type"), body.tell())
+        if cache:
+            await asyncio.to_thread(cache.store, url, body, response.headers)
+        body = handle_stylesheet(body, url, arcname, response.headers.get("Content-Type"), on_resource, paths)
+    except BaseException:
+        body.close()
+        raise
+    # The writer queue may be full, wait for it without blocking the event loop
+    await asyncio.to_thread(writer.add, arcname, body, response.headers.get("Content-Type"), url)
+
+
+def crawl_async(frontier, resources, writer, max_in_flight=1000, limit_per_host=100, cache=None, journal=None,
+                quiet=False, parser="stream", srcset="largest", paths=None, dns_cache=True, retry=None):
+    """Same as crawl(), but on an asyncio event loop using aiohttp instead of a thread pool."""
+    try:
+        import aiohttp
+    except ImportError:
+        raise RuntimeError("The async engine requires aiohttp (pip install aiohttp)")
+    if paths is None:
+        paths = LocalPaths(frontier.start_url)
+    if retry is None:
+        retry = RetryPolicy()
+    return asyncio.run(_crawl_async(aiohttp, frontier, resources, writer, max_in_flight, limit_per_host, cache,
+                                    journal, quiet, parser, srcset, paths, dns_cache, retry))
+
+
+async def _crawl_async(aiohttp, frontier, resources, writer, max_in_flight, limit_per_host, cache, journal, quiet,
+                       parser, srcset, paths, dns_cache, retry):
+    connector = aiohttp.TCPConnector(limit=max_in_flight, limit_per_host=limit_per_host, use_dns_cache=dns_cache,
+                                     ttl_dns_cache=DNS_TTL)
+    # Match the requests timeout=10, which limits connecting and each read, not the whole body
+    timeout = aiohttp.ClientTimeout(total=None, sock_connect=10, sock_read=10)
+    seen_resources = {normalize_url(url) for url in journal.done_urls()} if journal else set()
+    pending = {}
+    counts = [0, 0]
+
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        with progress_bar(quiet, total=0, desc="Downloading resources", unit="file", ncols=100) as pbar:
+            def submit_resources(links):
+                for link in links:
+                    key = normalize_url(link)
+                    if key in seen_resources:
+                        continue
+                    seen_resources.add(key)
+                    if journal:
+                        journal.queue(key, "resource")
+                    task = asyncio.ensure_future(async_span("download file", link, async_download_file(
+                        aiohttp, session, link, writer, cache, found_resource, paths, retry)))
+                    pending[task] = (link, None)
+                    pbar.total += 1
+                pbar.refresh()
+
+            def found_resource(link):
+                submit_resources([link])
+
+            def found_links(links, depth):
+                for link in links:
+                    if frontier.add(link, depth + 1):
+                        paths.page(link)
+
+            def submit_pages():
+                while len(pending) < max_in_flight:
+                    item = frontier.pop()
+                    if item is None:
+                        break
+                    page_url, depth = item
+                    task = asyncio.ensure_future(async_span("download page", page_url, async_download_page(
+                        aiohttp, session, page_url, writer, parser, srcset, paths,
+                        functools.partial(found_links, depth=depth), retry)))
+                    pending[task] = (page_url, depth)
+                    pbar.total += 1
+                pbar.refresh()
+
+            submit_resources(resources)
+            submit_pages()
+            while pending:
+                done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    url, depth = pending.pop(task)
+                    ok = False
+                    try:
+                        result = task.result()
+                        ok = result is not False
+                        update_score(ok)
+                        if depth is not None and result is not None:
+                            _, page_resources = result
+                            submit_resources(page_resources)
+                    except Exception as e:
+                        LOGGER.error("Error downloading %s: %s", url, e, extra={"url": url})
+                        update_score(False)
+                    if journal:
+                        journal.finish(normalize_url(url), ok)
+                    counts[0 if ok else 1] += 1
+                    pbar.update(1)
+                submit_pages()
+    return tuple(counts)
+
+
+async def async_span(name, url, coroutine):
+    """Await coroutine inside a span; each task gets a row of its own in the trace, as tasks share the thread."""
+    with span(name, "fetch", lane=id(asyncio.current_task()), url=url):
+        return await coroutine
+
+
+async def async_download_page(aiohttp, session, url, writer, parser="stream", srcset="largest", paths=None,
+                              on_links=None, retry=None):
+    """Async counterpart of download_page(), retried like async_download_file()."""
+    if paths is None:
+        paths = LocalPaths(url)
+    if retry is None:
+        retry = RetryPolicy()
+
+    async def fetch():
+        started = time.monotonic()
+        async with session.get(url) as response:
+            METRICS.record_response(url, response.status, response.headers.get("Content-Type"),
+                                    time.monotonic() - started)
+            if response.status in THROTTLE_STATUSES:
+                raise Throttled(url, retry_after_seconds(response.headers.get("Retry-After")))
+            response.raise_for_status()
+            if "html" not in response.headers.get("Content-Type", "text/html"):
+                await async_save_response(response, writer, paths.page(url), url=url, paths=paths)
+                LOGGER.debug("Downloaded: %s", url, extra={"url": url})
+                return None
+            body = await response.read()
+            METRICS.record_body(url, response.headers.get("Content-Type"), len(body))
+            return body, response.charset
+
+    fetched = await with_retries(aiohttp, url, retry, fetch)
+    if fetched is None:
+        return None
+    body, encoding = fetched
+    text = text_decoder(encoding).decode(body, final=True)
+
+    # Parsing and rewriting are CPU bound, keep them off the event loop
+    links, resources = await asyncio.to_thread(parse_page, text, url, parser, srcset)
+    if on_links:
+        on_links(links)
+    await asyncio.to_thread(save_page, io.BytesIO(body), encoding, url, writer, paths, resources)
+    LOGGER.debug("Page downloaded: %s", url, extra={"url": url})
+    return links, resources
+
+
+async def async_download_file(aiohttp, session, url, writer, cache=None, on_resource=None, paths=None, retry=None):
+    """Async counterpart of download_file(), with the same retry and cache behaviour."""
+    if paths is None:
+        paths = LocalPaths(url)
+    if retry is None:
+        retry = RetryPolicy()
+    arcname = paths.resource(url)
+    reusable = not (on_resource and is_stylesheet(url))
+    if reusable and await asyncio.to_thread(writer.reuse, arcname, url):
+        LOGGER.debug("Reused from store: %s", url, extra={"url": url})
+        return True
+    try:
+        return await with_retries(aiohttp, url, retry, functools.partial(
+            async_fetch_file, aiohttp, session, url, writer, arcname, cache, on_resource, paths))
+    except (Throttled, aiohttp.ClientError, asyncio.TimeoutError) as e:
+        LOGGER.error("Error downloading %s: %s", url, e, extra={"url": url})
+        return False
+
+
+async def with_retries(aiohttp, url, retry, fetch):
+    """Await fetch() for url until it goes through, and return what it returns.
+
+    Network errors are tried again after the delays of `retry` (a
+    RetryPolicy) and 429/503 responses (Throttled) after their Retry-After;
+    waiting doesn't hold up other downloads. Error statuses are not retried.
+    Raises the last error once the URL is out of attempts.
+    """
+    attempt = throttled = 0
+    while True:
+        retry.record_request()
+        try:
+            return await fetch()
+        except Throttled as e:
+            throttled += 1
+            if throttled > MAX_THROTTLED:
+                raise
+            METRICS.inc("throttled_total", host=urlparse(url).netloc.lower())
+            LOGGER.warning("Throttled, trying again later: %s", url, extra={"url": url})
+            await asyncio.sleep(throttle_delay(e.retry_after))
+        except aiohttp.ClientResponseError:
+            # The host answered, an error status is not worth retrying
+            raise
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            delay = retry.next_delay(attempt)
+            if delay is None:
+                raise
+            attempt += 1
+            METRICS.inc("retries_total", host=urlparse(url).netloc.lower())
+            LOGGER.warning("Retrying %s in %.1fs... Attempt %d failed: %s", url, delay, attempt, e,
+                           extra={"url": url, "attempt": attempt})
+            await asyncio.sleep(delay)
+
+
+async def async_fetch_file(aiohttp, session, url, writer, arcname, cache=None, on_resource=None, paths=None):
+    """Make one request for url; returns whether it was saved, raises Throttled on a 429/503."""
+    headers = cache.conditional_headers(url) if cache else {}
+    started = time.monotonic()
+    async with session.get(url, headers=headers) as response:
+        METRICS.record_response(url, response.status, response.headers.get("Content-Type"),
+                                time.monotonic() - started)
+        if response.status == 304 and cache:
+            # save_cached runs in a thread, resources it finds are handed back to the event loop
+            loop = asyncio.get_running_loop()
+            found = (lambda link: loop.call_soon_threadsafe(on_resource, link)) if on_resource else None
+            if not await asyncio.to_thread(save_cached, cache, url, writer, arcname, found, paths):
+                raise aiohttp.ClientError(f"Cached copy of {url} is gone")
+            LOGGER.debug("Not modified (cached): %s", url, extra={"url": url})
+            return True
+        elif response.status == 200:
+            await async_save_response(response, writer, arcname, cache, url, on_resource, paths)
+            LOGGER.debug("Downloaded: %s", url, extra={"url": url})
+            return True
+        elif response.status in THROTTLE_STATUSES:
+            raise Throttled(url, retry_after_seconds(response.headers.get("Retry-After")))
+        else:
+            LOGGER.error("Failed to download: %s - Status code: %s", url, response.status,
+                         extra={"url": url, "status": response.status})
+            return False
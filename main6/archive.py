@@ -0,0 +1,397 @@
+import io
+import os
+import queue
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import zipfile
+import zlib
+from collections import deque
+from concurrent.futures import Future
+
+from tracing import bind, span
+
+# Downloads smaller than this stay in memory until they are archived, bigger
+# ones spill over to a temporary file
+SPOOL_SIZE = 1024 * 1024
+
+# How many finished downloads may wait for the archive writer; workers block
+# once the queue is full, which bounds the memory held by finished bodies
+QUEUE_SIZE = 64
+
+# Formats that are already compressed; deflating them again costs CPU for ~0% gain
+MEDIA_EXTENSIONS = {
+    ".jpg", ".jpeg", ".png", ".gif", ".webp", ".avif", ".ico",
+    ".woff", ".woff2", ".mp4", ".webm", ".mov", ".mp3", ".ogg", ".m4a",
+    ".zip", ".gz", ".tgz", ".bz2", ".xz", ".br", ".7z", ".pdf",
+}
+TEXT_EXTENSIONS = {
+    ".html", ".htm", ".css", ".js", ".mjs", ".svg", ".json", ".xml",
+    ".txt", ".map", ".csv", ".md",
+}
+TEXT_CONTENT_TYPES = ("text/", "application/javascript", "application/json", "application/xml", "image/svg+xml")
+MEDIA_CONTENT_TYPES = ("image/", "video/", "audio/", "font/", "application/zip", "application/pdf", "application/gzip")
+
+# Compression methods a policy can use for text entries
+METHODS = {
+    "deflate": zipfile.ZIP_DEFLATED,
+    "bzip2": zipfile.ZIP_BZIP2,
+    "lzma": zipfile.ZIP_LZMA,
+    # Only available from Python 3.14
+    "zstd": getattr(zipfile, "ZIP_ZSTANDARD", None),
+}
+
+
+def classify(arcname, content_type=None):
+    """Return "text", "media" or "other" for an archive entry."""
+    ext = os.path.splitext(arcname)[1].lower()
+    if ext in TEXT_EXTENSIONS:
+        return "text"
+    if ext in MEDIA_EXTENSIONS:
+        return "media"
+    content_type = (content_type or "").split(";")[0].strip().lower()
+    # SVG is an image type but is plain text
+    if content_type.startswith(TEXT_CONTENT_TYPES):
+        return "text"
+    if content_type.startswith(MEDIA_CONTENT_TYPES):
+        return "media"
+    return "other"
+
+
+class CompressionPolicy:
+    """Decides how each archive entry is compressed, based on its kind.
+
+    Already compressed media is stored as-is, text is compressed with `method`
+    ("deflate", "bzip2", "lzma" or "zstd") at `level`, and anything else is
+    deflated with the default level.
+    """
+
+    def __init__(self, method="deflate", level=6):
+        if method not in METHODS:
+            raise ValueError(f"Unknown compression method: {method}")
+        if METHODS[method] is None:
+            raise ValueError(f"Compression method {method} is not supported by this Python version")
+        self.method = METHODS[method]
+        self.level = level
+
+    def choose(self, kind):
+        """Return the (compress_type, compress_level) for an entry of this kind."""
+        if kind == "media":
+            return zipfile.ZIP_STORED, None
+        if kind == "text":
+            return self.method, self.level
+        return zipfile.ZIP_DEFLATED, None
+
+
+def set_compress_level(info, level):
+    # The attribute became public in Python 3.13
+    if hasattr(zipfile.ZipInfo, "compress_level"):
+        info.compress_level = level
+    else:
+        info._compresslevel = level
+
+
+def new_buffer():
+    """Return a buffer for one download that spills to disk past SPOOL_SIZE."""
+    return tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)
+
+
+class ArchiveWriter:
+    """Writes finished downloads straight into a ZIP archive.
+
+    Worker threads call add() with a buffer holding a downloaded body; a single
+    writer thread appends the buffers to the archive in the order they arrive.
+    The archive is written to a .part file and only renamed to zip_path once
+    close() succeeds. Entries are compressed according to `policy`, and
+    `stats` records files, bytes in, bytes out and seconds spent per kind.
+    """
+
+    def __init__(self, zip_path, policy=None):
+        self.zip_path = zip_path
+        self.policy = policy or CompressionPolicy()
+        self.stats = {}
+        self.names = set()
+        self.error = None
+        self.queue = queue.Queue(maxsize=QUEUE_SIZE)
+        self.temp_path = zip_path + ".part"
+        self.zipf = zipfile.ZipFile(self.temp_path, 'w', zipfile.ZIP_DEFLATED)
+        # The writer thread traces into the download that created it
+        self.thread = threading.Thread(target=bind(self._run), name="archive-writer", daemon=True)
+        self.thread.start()
+
+    def add(self, arcname, fileobj, content_type=None, url=None):
+        """Queue fileobj to be stored as arcname; the writer closes it when done."""
+        self.queue.put((arcname, fileobj, content_type))
+
+    def add_bytes(self, arcname, data, content_type=None, url=None):
+        self.add(arcname, io.BytesIO(data), content_type)
+
+    def reuse(self, arcname, url):
+        """Only BlobWriter can reuse earlier downloads instead of fetching them."""
+        return False
+
+    def close(self):
+        """Wait for queued entries, finish the archive and move it into place."""
+        self.queue.put(None)
+        self.thread.join()
+        self.zipf.close()
+        if self.error is not None:
+            os.remove(self.temp_path)
+            raise self.error
+        os.replace(self.temp_path, self.zip_path)
+
+    def abort(self):
+        """Stop writing and throw the unfinished archive away."""
+        self.error = self.error or RuntimeError("Archive aborted")
+        try:
+            self.close()
+        except Exception:
+            pass
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            arcname, fileobj, content_type = item
+            try:
+                # Keep going after an error so workers blocked on put() are released
+                if self.error is None:
+                    with span("write", "disk", arcname=arcname):
+                        self._write(arcname, fileobj, content_type)
+            except Exception as e:
+                self.error = e
+            finally:
+                fileobj.close()
+
+    def _write(self, arcname, fileobj, content_type):
+        # The first body stored under a name wins, a ZIP can't overwrite entries
+        if arcname in self.names:
+            return
+        self.names.add(arcname)
+
+        fileobj.seek(0, os.SEEK_END)
+        size = fileobj.tell()
+        fileobj.seek(0)
+        kind = classify(arcname, content_type)
+        info = zipfile.ZipInfo(arcname, date_time=time.localtime()[:6])
+        info.compress_type, level = self.policy.choose(kind)
+        set_compress_level(info, level)
+        info.file_size = size
+        info.external_attr = 0o644 << 16
+
+        start = time.perf_counter()
+        with self.zipf.open(info, 'w') as entry:
+            shutil.copyfileobj(fileobj, entry, 64 * 1024)
+        stats = self.stats.setdefault(kind, {"files": 0, "bytes_in": 0, "bytes_out": 0, "seconds": 0.0})
+        stats["files"] += 1
+        stats["bytes_in"] += size
+        stats["bytes_out"] += info.compress_size
+        stats["seconds"] += time.perf_counter() - start
+
+
+# ParallelArchiveWriter deflates entries in blocks of this size; each block
+# is primed with the 32 KiB before it, like pigz, so the ratio barely changes
+BLOCK_SIZE = 1024 * 1024
+DICT_SIZE = 32 * 1024
+
+# ParallelArchiveWriter writes entries through private zipfile internals.
+# They are only relied on up to this Python version, and only if they are
+# all there; otherwise entries are written by the serial ArchiveWriter code.
+PARALLEL_ZIP_MAX_VERSION = (3, 14)
+ZIPFILE_INTERNALS = ("_writecheck", "_didModify", "fp", "start_dir", "NameToInfo", "filelist")
+
+
+def parallel_zip_supported():
+    """Return whether ParallelArchiveWriter can write through zipfile's internals on this Python."""
+    if sys.version_info[:2] > PARALLEL_ZIP_MAX_VERSION or not hasattr(zipfile.ZipInfo, "FileHeader"):
+        return False
+    with zipfile.ZipFile(io.BytesIO(), 'w') as zipf:
+        return all(hasattr(zipf, name) for name in ZIPFILE_INTERNALS)
+
+
+def compress_block(data, level, zdict, last):
+    """Deflate one block of an entry in a worker process; return (data, seconds).
+
+    Blocks other than the last end with a sync flush, so the compressed blocks
+    of an entry can be concatenated into one valid deflate stream.
+    """
+    start = time.process_time()
+    if zdict:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15, 8, zlib.Z_DEFAULT_STRATEGY, zdict)
+    else:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    out = compressor.compress(data) + compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+    return out, time.process_time() - start
+
+
+class _Entry:
+    """An archive entry whose blocks are still being compressed."""
+
+    def __init__(self, info, kind, zip64):
+        self.info = info
+        self.kind = kind
+        self.zip64 = zip64
+        self.seconds = 0.0
+
+
+def check_parallel_policy(policy):
+    """Raise ValueError for a CompressionPolicy ParallelArchiveWriter can't use."""
+    if policy.method != zipfile.ZIP_DEFLATED:
+        raise ValueError("The parallel archive writer only supports deflate compression")
+
+
+class ParallelArchiveWriter(ArchiveWriter):
+    """ArchiveWriter that deflates entries in a pool of `processes` worker processes.
+
+    Entries are split into BLOCK_SIZE blocks that are compressed in parallel,
+    across entries as well as within big ones. The writer thread still writes
+    the compressed blocks, local headers and central directory in order, so
+    the archive extracts to exactly the same files as the serial writer's.
+    Only "deflate" is supported for text entries. Where zipfile's internals
+    can't be relied on (see parallel_zip_supported()) it writes like
+    ArchiveWriter.
+    """
+
+    def __init__(self, zip_path, policy=None, processes=None):
+        policy = policy or CompressionPolicy()
+        check_parallel_policy(policy)
+        self.pool = None
+        if parallel_zip_supported():
+            # Imported here, multiprocessing is only needed with archive_processes > 0
+            from concurrent.futures import ProcessPoolExecutor
+
+            self.pool = ProcessPoolExecutor(processes)
+        # Blocks waiting to be written, bounded so memory stays proportional to the pool size
+        self.window = deque()
+        self.max_window = (processes or os.cpu_count() or 1) * 4
+        super().__init__(zip_path, policy)
+
+    def close(self):
+        try:
+            super().close()
+        finally:
+            if self.pool:
+                self.pool.shutdown()
+
+    def _run(self):
+        super()._run()
+        try:
+            while self.window and self.error is None:
+                self._write_next()
+        except Exception as e:
+            self.error = self.error or e
+        # The archive is thrown away after an error, don't write what is left
+        for _, future, _, _ in self.window:
+            future.cancel()
+        self.window.clear()
+
+    def _write(self, arcname, fileobj, content_type):
+        if self.pool is None:
+            return super()._write(arcname, fileobj, content_type)
+        if arcname in self.names:
+            return
+        self.names.add(arcname)
+
+        fileobj.seek(0, os.SEEK_END)
+        size = fileobj.tell()
+        fileobj.seek(0)
+        kind = classify(arcname, content_type)
+        info = zipfile.ZipInfo(arcname, date_time=time.localtime()[:6])
+        info.compress_type, level = self.policy.choose(kind)
+        info.file_size = size
+        info.external_attr = 0o644 << 16
+        info.compress_size = 0
+        info.CRC = 0
+        info.flag_bits = 0
+        # Same rule zipfile uses for entries whose size is known up front
+        entry = _Entry(info, kind, size * 1.05 > zipfile.ZIP64_LIMIT)
+        if level is None:
+            level = zlib.Z_DEFAULT_COMPRESSION
+
+        remaining = size
+        previous = b""
+        first = True
+        while first or remaining:
+            block = fileobj.read(min(BLOCK_SIZE, remaining))
+            remaining -= len(block)
+            info.CRC = zlib.crc32(block, info.CRC)
+            last = remaining == 0
+            if info.compress_type == zipfile.ZIP_STORED:
+                future = Future()
+                future.set_result((block, 0.0))
+            else:
+                future = self.pool.submit(compress_block, block, level, previous[-DICT_SIZE:], last)
+            previous = block
+
+            while len(self.window) >= self.max_window:
+                self._write_next()
+            self.window.append((entry, future, first, last))
+            first = False
+
+    def _write_next(self):
+        entry, future, first, last = self.window.popleft()
+        data, seconds = future.result()
+        zipf = self.zipf
+        info = entry.info
+        if first:
+            info.header_offset = zipf.fp.tell()
+            zipf._writecheck(info)
+            zipf._didModify = True
+            zipf.fp.write(info.FileHeader(entry.zip64))
+        zipf.fp.write(data)
+        info.compress_size += len(data)
+        entry.seconds += seconds
+        if last:
+            # Rewrite the local header now that the CRC and sizes are known,
+            # then register the entry for the central directory
+            end = zipf.fp.tell()
+            zipf.fp.seek(info.header_offset)
+            zipf.fp.write(info.FileHeader(entry.zip64))
+            zipf.fp.seek(end)
+            zipf.filelist.append(info)
+            zipf.NameToInfo[info.filename] = info
+            zipf.start_dir = end
+
+            stats = self.stats.setdefault(entry.kind, {"files": 0, "bytes_in": 0, "bytes_out": 0, "seconds": 0.0})
+            stats["files"] += 1
+            stats["bytes_in"] += info.file_size
+            stats["bytes_out"] += info.compress_size
+            stats["seconds"] += entry.seconds
+
+
+class FolderWriter:
+    """Writes finished downloads into a plain folder instead of an archive."""
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.stats = {}
+        os.makedirs(folder, exist_ok=True)
+
+    def add(self, arcname, fileobj, content_type=None, url=None):
+        path = os.path.join(self.folder, arcname)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write next to the target and rename, so files are never half written
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".", suffix=".part")
+        try:
+            with span("write", "disk", arcname=arcname), os.fdopen(fd, 'wb') as file, fileobj:
+                fileobj.seek(0)
+                shutil.copyfileobj(fileobj, file, 64 * 1024)
+            os.replace(temp_path, path)
+        except BaseException:
+            os.remove(temp_path)
+            raise
+
+    def add_bytes(self, arcname, data, content_type=None, url=None):
+        self.add(arcname, io.BytesIO(data), content_type)
+
+    def reuse(self, arcname, url):
+        return False
+
+    def close(self):
+        pass
+
+    def abort(self):
+        """Stop writing; the files already written are kept."""
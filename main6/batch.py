@@ -0,0 +1,345 @@
+"""Mirror a list of websites without the interactive menu.
+
+Usage: python batch.py urls.txt [--sites 8] [--per-domain 1] [--summary summary.jsonl] ...
+       python batch.py urls.txt --processes 4 [--queue batch_queue.sqlite] ...
+       python batch.py --worker --queue batch_queue.sqlite ...
+
+The URL list is read from a file, or from stdin when it is "-". Blank lines
+and lines starting with # are ignored. Every finished site appends one JSON
+line to the summary file. With --metrics, the counters and latency and size
+histograms (see metrics.MetricsRegistry) are written to a file after every
+site, as Prometheus text for a .prom name and as JSON otherwise.
+
+Progress and errors are logged at --log-level, and with --log-json also as
+JSON lines. --quiet replaces the log on the terminal with one progress line.
+
+With --processes the sites are shared out through a work queue file to that
+many worker processes, each downloading --sites sites at a time. More
+workers on the same machine can join with --worker; sites of a worker
+that dies are handed to another one once its lease runs out. The queue
+file must be on a local disk (see workqueue.WorkQueue).
+"""
+import argparse
+import contextlib
+import json
+import multiprocessing
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from urllib.parse import urlparse
+
+from crawler import DEFAULT_MAX_PAGES
+from logs import LOGGER, ProgressLine, setup_logging
+from main6 import download_website
+from metrics import METRICS
+from politeness import DEFAULT_PER_HOST
+from retry import DEFAULT_RETRIES
+from segments import DEFAULT_SEGMENTS
+from workqueue import WorkQueue, new_run_id, new_worker_id
+
+
+# Replacement workers a batch starts for each worker process before it gives up
+MAX_RESTARTS_PER_WORKER = 3
+
+# Seconds before a worker that exited is replaced, doubled for each further replacement
+RESTART_BACKOFF = 1
+
+
+def read_urls(source):
+    """Return the URLs listed in a file, or on stdin for "-"."""
+    file = sys.stdin if source == "-" else open(source, encoding="utf-8")
+    try:
+        return [line.strip() for line in file if line.strip() and not line.lstrip().startswith("#")]
+    finally:
+        if file is not sys.stdin:
+            file.close()
+
+
+def run_batch(urls, sites=8, per_domain=1, summary_path="batch_summary.jsonl", metrics_path=None, **options):
+    """Download many websites concurrently; return the list of per-site summaries.
+
+    At most `sites` downloads run at once and at most `per_domain` of them
+    against the same domain. Domains take turns, so one domain with many
+    URLs in the list does not hold up all the others. `options` are passed
+    on to download_website(). With metrics_path, METRICS is written there
+    after every site.
+    """
+    # One queue per domain, visited round-robin
+    queues = OrderedDict()
+    for url in urls:
+        queues.setdefault(urlparse(url).netloc.lower(), deque()).append(url)
+    running = {}
+    active = {}
+    results = []
+    summary_lock = threading.Lock()
+
+    def next_url():
+        for domain in list(queues):
+            if active.get(domain, 0) >= per_domain:
+                continue
+            url = queues[domain].popleft()
+            # Move the domain to the back so the others go first next time
+            queues.move_to_end(domain)
+            if not queues[domain]:
+                del queues[domain]
+            return domain, url
+        return None
+
+    with open(summary_path, "a", encoding="utf-8") as summary_file, ThreadPoolExecutor(max_workers=sites) as executor:
+        def submit_sites():
+            while len(running) < sites:
+                picked = next_url()
+                if picked is None:
+                    return
+                domain, url = picked
+                active[domain] = active.get(domain, 0) + 1
+                running[executor.submit(run_site, url, options)] = domain
+
+        submit_sites()
+        while running:
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                domain = running.pop(future)
+                active[domain] -= 1
+                result = future.result()
+                results.append(result)
+                with summary_lock:
+                    summary_file.write(json.dumps(result) + "\n")
+                    summary_file.flush()
+                if metrics_path:
+                    METRICS.write(metrics_path)
+            submit_sites()
+    return results
+
+
+def run_site(url, options):
+    try:
+        return download_website(url, quiet=True, **options)
+    except Exception as e:
+        return {"url": url, "ok": False, "error": str(e)}
+
+
+def run_worker(queue_path, sites=1, per_domain=1, worker=None, metrics_path=None, log_options=None, **options):
+    """Download websites claimed from the work queue until none are left.
+
+    Leases are renewed while the downloads run. A site whose lease was lost
+    anyway (the worker stalled for longer than the lease) is logged and no
+    longer renewed; it finishes, but the result of the worker it was handed
+    to counts. A worker with nothing to
+    claim keeps waiting as long as other workers hold jobs, in case they die
+    and their jobs come back to the queue. With metrics_path, each worker
+    writes its METRICS to its own file next to it (see worker_metrics_path()).
+    log_options, if given, are passed to setup_logging() first, as a worker
+    process doesn't inherit the logging thread of its parent.
+    """
+    if log_options is not None:
+        setup_logging(**log_options)
+    queue = WorkQueue(queue_path)
+    worker = worker or new_worker_id()
+    if metrics_path:
+        metrics_path = worker_metrics_path(metrics_path, worker)
+    running = {}
+    # Sites whose lease ran out while they were downloading, another worker has them now
+    lost = set()
+    try:
+        with ThreadPoolExecutor(max_workers=sites) as executor:
+            while True:
+                while len(running) < sites:
+                    url = queue.claim(worker, per_domain)
+                    if url is None:
+                        break
+                    running[executor.submit(run_site, url, options)] = url
+                if not running:
+                    if not queue.unfinished():
+                        break
+                    time.sleep(1)
+                    continue
+                done, _ = wait(running, timeout=queue.lease_seconds / 3, return_when=FIRST_COMPLETED)
+                for future in done:
+                    url = running.pop(future)
+                    if not queue.complete(worker, url, future.result()) and url not in lost:
+                        LOGGER.warning("Finished %s after another worker took it over, result dropped", url,
+                                       extra={"url": url})
+                    lost.discard(url)
+                for url in queue.heartbeat(worker, [url for url in running.values() if url not in lost]):
+                    lost.add(url)
+                    LOGGER.warning("Lost the lease on %s to another worker, its result will be dropped", url,
+                                   extra={"url": url})
+                if metrics_path and done:
+                    METRICS.write(metrics_path)
+    finally:
+        queue.close()
+
+
+def worker_metrics_path(path, worker):
+    """Return the metrics file of one worker: path with the worker id before its extension."""
+    stem, extension = os.path.splitext(path)
+    return f"{stem}.{worker}{extension}"
+
+
+def run_coordinator(urls, queue_path="batch_queue.sqlite", processes=None, sites=1, per_domain=1,
+                    summary_path="batch_summary.jsonl", log_options=None, **options):
+    """Queue the URLs, run `processes` local workers and collect their summaries.
+
+    Workers that exit while work is left are replaced after a growing delay,
+    up to MAX_RESTARTS_PER_WORKER times per worker in all; then the workers
+    are stopped and RuntimeError is raised, as they are likely to crash on
+    startup. With processes=0 all work is left to workers started elsewhere
+    with run_worker(). The workers
+    log with log_options (see setup_logging()); if they are quiet, a progress
+    line counts the finished sites. Returns the list of per-site summaries.
+    """
+    queue = WorkQueue(queue_path)
+    # Sites finished by an earlier batch in the same queue file are downloaded again, and not reported
+    run = new_run_id()
+    queue.add(urls, run)
+    processes = multiprocessing.cpu_count() if processes is None else processes
+    kwargs = dict(options, sites=sites, per_domain=per_domain, log_options=log_options)
+    left = {"sites": len(urls)}
+
+    def describe():
+        failed = sum(1 for result in results if not result["ok"])
+        return f"sites {len(results) - failed} ok {failed} failed, {left['sites']} left"
+
+    def start_worker():
+        process = multiprocessing.Process(target=run_worker, args=(queue_path,), kwargs=kwargs)
+        process.start()
+        return process
+
+    workers = [start_worker() for _ in range(processes)]
+    restarts = [0] * processes
+    # When the replacement of each exited worker is due
+    restart_at = [None] * processes
+    results = []
+    position = 0
+    quiet = log_options and log_options.get("quiet")
+    try:
+        with open(summary_path, "a", encoding="utf-8") as summary_file, \
+                (ProgressLine(describe) if quiet else contextlib.nullcontext()):
+            while True:
+                unfinished = left["sites"] = queue.unfinished(run)
+                for position, result in queue.results(position, run):
+                    results.append(result)
+                    summary_file.write(json.dumps(result) + "\n")
+                summary_file.flush()
+                if not unfinished:
+                    break
+                for index, process in enumerate(workers):
+                    if process.is_alive():
+                        continue
+                    if restart_at[index] is None:
+                        if sum(restarts) >= MAX_RESTARTS_PER_WORKER * processes:
+                            for other in workers:
+                                if other.is_alive():
+                                    other.terminate()
+                            raise RuntimeError(f"Workers keep exiting (last exit code {process.exitcode}), "
+                                               f"giving up with {unfinished} sites left")
+                        delay = RESTART_BACKOFF * 2 ** restarts[index]
+                        LOGGER.warning("Worker %s exited with code %s, starting a new one in %ds", process.pid,
+                                       process.exitcode, delay)
+                        restart_at[index] = time.monotonic() + delay
+                    if time.monotonic() >= restart_at[index]:
+                        restarts[index] += 1
+                        restart_at[index] = None
+                        workers[index] = start_worker()
+                time.sleep(1)
+    finally:
+        for process in workers:
+            process.join()
+        queue.close()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Mirror a list of websites.")
+    parser.add_argument("urls", nargs="?", help='file with one URL per line, or "-" for stdin')
+    parser.add_argument("--sites", type=int, default=None,
+                        help="websites downloaded at the same time (per worker with --processes/--worker)")
+    parser.add_argument("--per-domain", type=int, default=1, help="websites of one domain downloaded at the same time")
+    parser.add_argument("--summary", default="batch_summary.jsonl", help="JSON lines file the results are appended to")
+    parser.add_argument("--depth", type=int, default=0, help="how many links deep to follow")
+    parser.add_argument("--max-pages", type=int, default=DEFAULT_MAX_PAGES,
+                        help="maximum number of pages per website with --depth, start page included")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="most requests in flight per website (adapted per host by default)")
+    parser.add_argument("--engine", choices=("threads", "async"), default="threads")
+    parser.add_argument("--output", choices=("zip", "folder", "store"), default="zip")
+    parser.add_argument("--cache-dir", default=None, help="share an HTTP cache between runs")
+    parser.add_argument("--resumable", action="store_true", help="journal each download so it can be resumed")
+    parser.add_argument("--per-host", type=int, default=DEFAULT_PER_HOST,
+                        help="most requests at the same time per host")
+    parser.add_argument("--host-rate", type=float, default=None, help="requests per second per host")
+    parser.add_argument("--ignore-robots", action="store_true", help="ignore the Crawl-delay of robots.txt")
+    parser.add_argument("--parser", choices=("stream", "lxml", "bs4"), default="stream", help="HTML parser")
+    parser.add_argument("--srcset", choices=("largest", "smallest", "all", "none"), default="largest",
+                        help="which srcset candidates to download")
+    parser.add_argument("--keep-links", action="store_true",
+                        help="save pages and stylesheets as downloaded, without pointing links at the local copies")
+    parser.add_argument("--segments", type=int, default=DEFAULT_SEGMENTS,
+                        help="parallel byte ranges per big file (1 to turn off)")
+    parser.add_argument("--pool-size", type=int, default=None,
+                        help="connections kept open per host (per-host limit plus segments by default)")
+    parser.add_argument("--no-dns-cache", action="store_true", help="resolve host names for every new connection")
+    parser.add_argument("--http2", action="store_true", help="use HTTP/2 for https:// (needs httpx[http2])")
+    parser.add_argument("--trace", action="store_true",
+                        help="write a Chrome trace of each site to <name>.trace.json and log time per stage")
+    parser.add_argument("--profile", action="store_true", help="profile each site with cProfile into <name>.pstats")
+    parser.add_argument("--metrics", default=None,
+                        help="write metrics to this file after every site (Prometheus text if it ends in .prom, "
+                             "else JSON; one file per worker with --processes/--worker)")
+    parser.add_argument("--log-level", choices=("DEBUG", "INFO", "WARNING", "ERROR"), default="INFO",
+                        help="least important messages logged (DEBUG lists every file)")
+    parser.add_argument("--log-json", default=None, help='also log as JSON lines to this file ("-" for stdout)')
+    parser.add_argument("--quiet", action="store_true", help="show one progress line instead of the log")
+    parser.add_argument("--retries", type=int, default=DEFAULT_RETRIES, help="retries of a URL after network errors")
+    parser.add_argument("--processes", type=int, default=None, help="share the work out to this many processes")
+    parser.add_argument("--queue", default="batch_queue.sqlite", help="work queue file shared by the workers")
+    parser.add_argument("--worker", action="store_true", help="join the workers of an existing work queue")
+    args = parser.parse_args()
+    if args.engine == "async" and args.host_rate is not None:
+        parser.error("--host-rate needs --engine threads, the async engine is not throttled per host")
+
+    options = dict(
+        max_depth=args.depth, max_pages=args.max_pages, workers=args.workers, engine=args.engine,
+        output=args.output, cache_dir=args.cache_dir, resumable=args.resumable, per_host=args.per_host,
+        host_rate=args.host_rate, robots=not args.ignore_robots, retries=args.retries,
+        parser=args.parser, srcset=args.srcset, rewrite_links=not args.keep_links, segments=args.segments,
+        pool_size=args.pool_size, dns_cache=not args.no_dns_cache, http2=args.http2,
+        trace=args.trace, profile=args.profile,
+    )
+    log_options = dict(level=args.log_level, json_path=args.log_json, quiet=args.quiet)
+    setup_logging(**log_options)
+    progress = ProgressLine() if args.quiet else contextlib.nullcontext()
+    if args.worker:
+        with progress:
+            run_worker(args.queue, sites=args.sites or 1, per_domain=args.per_domain, metrics_path=args.metrics,
+                       **options)
+        return
+    if args.urls is None:
+        parser.error("a URL list is required unless --worker is given")
+    if args.processes is not None:
+        try:
+            results = run_coordinator(
+                read_urls(args.urls), args.queue, processes=args.processes, sites=args.sites or 1,
+                per_domain=args.per_domain, summary_path=args.summary, metrics_path=args.metrics,
+                log_options=log_options, **options,
+            )
+        except RuntimeError as e:
+            LOGGER.error("Batch failed: %s", e)
+            sys.exit(2)
+    else:
+        with progress:
+            results = run_batch(
+                read_urls(args.urls), sites=args.sites or 8, per_domain=args.per_domain, summary_path=args.summary,
+                metrics_path=args.metrics, **options,
+            )
+    failed = sum(1 for result in results if not result["ok"])
+    print(f"{len(results) - failed} websites saved, {failed} failed, summary in {args.summary}")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+"""Compare the serial and the parallel archive writers on a synthetic mirror.
+
+Usage: python bench_archive.py [total_megabytes] [processes]
+"""
+import os
+import random
+import sys
+import tempfile
+import time
+import zipfile
+
+from archive import ArchiveWriter, ParallelArchiveWriter
+
+
+def make_files(total_bytes, seed=0):
+    """Build a mix of compressible text pages and incompressible images."""
+    rng = random.Random(seed)
+    words = [bytes(rng.choice(b"abcdefghijklmnop") for _ in range(rng.randint(2, 9))) for _ in range(2000)]
+    files = {}
+    size = 0
+    index = 0
+    while size < total_bytes:
+        if index % 4 == 3:
+            data = rng.randbytes(rng.randint(20_000, 400_000))
+            name = f"images/{index}.jpg"
+        else:
+            length = rng.randint(5_000, 3_000_000)
+            data = b" ".join(rng.choice(words) for _ in range(length // 6))
+            name = f"html/{index}.html"
+        files[name] = data
+        size += len(data)
+        index += 1
+    return files
+
+
+def run(writer_class, path, files, **kwargs):
+    start = time.perf_counter()
+    writer = writer_class(path, **kwargs)
+    for name, data in files.items():
+        writer.add_bytes(name, data)
+    writer.close()
+    return time.perf_counter() - start
+
+
+def main():
+    total_mb = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    processes = int(sys.argv[2]) if len(sys.argv) > 2 else os.cpu_count()
+    files = make_files(total_mb * 1024 * 1024)
+    print(f"{len(files)} files, {sum(map(len, files.values())) / 1e6:.1f} MB, {processes} processes")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        serial_path = os.path.join(tmp, "serial.zip")
+        parallel_path = os.path.join(tmp, "parallel.zip")
+        serial = run(ArchiveWriter, serial_path, files)
+        parallel = run(ParallelArchiveWriter, parallel_path, files, processes=processes)
+
+        # Both archives must extract to exactly the same files
+        with zipfile.ZipFile(serial_path) as a, zipfile.ZipFile(parallel_path) as b:
+            assert sorted(a.namelist()) == sorted(b.namelist())
+            for name in a.namelist():
+                assert a.read(name) == b.read(name), name
+
+        print(f"serial:   {serial:6.2f}s  {os.path.getsize(serial_path) / 1e6:8.1f} MB")
+        print(f"parallel: {parallel:6.2f}s  {os.path.getsize(parallel_path) / 1e6:8.1f} MB  ({serial / parallel:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
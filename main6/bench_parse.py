@@ -0,0 +1,66 @@
+"""Compare the page parsers on large synthetic pages.
+
+Usage: python bench_parse.py [page_megabytes] [pages]
+"""
+import random
+import sys
+import time
+
+from crawler import PARSERS, parse_page
+
+
+def make_page(total_bytes, seed=0):
+    """Build an HTML page of about total_bytes with links, images, scripts and stylesheets mixed into text."""
+    rng = random.Random(seed)
+    words = ["lorem", "ipsum", "dolor", "sit", "amet", "consectetur", "adipiscing", "elit", "&amp;", "&lt;b&gt;"]
+    parts = ['<!DOCTYPE html><html><head><title>Fixture</title>',
+             '<link rel="stylesheet" href="/css/site.css"><script src="/js/app.js"></script></head><body>']
+    size = 0
+    index = 0
+    while size < total_bytes:
+        kind = rng.randrange(10)
+        if kind == 0:
+            part = f'<img src="/img/{index}.png" alt="picture {index}">'
+        elif kind == 1:
+            part = f'<a href="/docs/page{index}.html?ref=bench#top">page {index}</a>'
+        elif kind == 2:
+            part = f'<script src="https://cdn.example.com/lib{index}.js"></script>'
+        elif kind == 3:
+            part = f'<link rel="preload stylesheet" href="/css/{index}.css">'
+        else:
+            text = " ".join(rng.choice(words) for _ in range(rng.randint(20, 80)))
+            part = f'<div class="row"><p>{text}</p><span data-id="{index}">{index}</span></div>\n'
+        parts.append(part)
+        size += len(part)
+        index += 1
+    parts.append("</body></html>")
+    return "".join(parts)
+
+
+def main():
+    page_mb = float(sys.argv[1]) if len(sys.argv) > 1 else 5
+    pages = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    fixtures = [make_page(int(page_mb * 1024 * 1024), seed) for seed in range(pages)]
+    print(f"{pages} pages of {page_mb:.1f} MB")
+
+    results = {}
+    for name in PARSERS:
+        start = time.perf_counter()
+        try:
+            results[name] = [parse_page(html, "http://example.com/", name) for html in fixtures]
+        except RuntimeError as e:
+            print(f"{name:7s} skipped: {e}")
+            continue
+        elapsed = time.perf_counter() - start
+        found = sum(len(links) + len(resources) for links, resources in results[name])
+        print(f"{name:7s} {elapsed:6.2f}s  {pages * page_mb / elapsed:6.1f} MB/s  {found} URLs")
+
+    # Every parser must find the same URLs as the BeautifulSoup one (which lists them by tag, not in page order)
+    for name, result in results.items():
+        for (links, resources), (expected_links, expected_resources) in zip(result, results["bs4"]):
+            assert links == expected_links, name
+            assert sorted(resources) == sorted(expected_resources), name
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,351 @@
+"""Benchmark download_website() end to end against a local fixture server.
+
+A synthetic site (pages linking to each other, each with stylesheets,
+scripts and images) is served from this process, optionally with added
+latency, failing resources and 429 responses, and downloaded in a fresh
+process per run so its CPU time and peak memory can be measured. Results
+are appended to a JSON lines file with the git commit they were measured
+on, and every run is compared with the last one of the same configuration.
+
+Usage: python bench_site.py [scenario ...] [--engine async] [--output folder] [--repeat 3]
+       python bench_site.py --history
+"""
+import argparse
+import datetime
+import http.server
+import json
+import multiprocessing
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+try:
+    import resource
+except ImportError:
+    # Not on Windows; CPU time and peak memory are then not reported
+    resource = None
+
+# Synthetic sites: pages, resources per page, their sizes, and how the server misbehaves
+SCENARIOS = {
+    "small": dict(pages=20, assets=10, asset_kb=10, page_kb=20, latency_ms=0, error_rate=0.0, throttle_rate=0.0),
+    "assets": dict(pages=10, assets=40, asset_kb=250, page_kb=20, latency_ms=0, error_rate=0.0, throttle_rate=0.0),
+    "latency": dict(pages=40, assets=10, asset_kb=10, page_kb=20, latency_ms=50, error_rate=0.0,
+                    throttle_rate=0.0),
+    "flaky": dict(pages=30, assets=10, asset_kb=20, page_kb=20, latency_ms=10, error_rate=0.05,
+                  throttle_rate=0.05),
+}
+
+# Resource kinds, used in turn: extension, Content-Type and whether the body is compressible text
+ASSET_KINDS = (
+    ("css", "text/css", True),
+    ("js", "application/javascript", True),
+    ("png", "image/png", False),
+)
+
+# Drop in pages/s, against the last run of the same configuration, reported as a regression;
+# short scenarios vary by about 10% from run to run, use --repeat to compare medians
+REGRESSION_THRESHOLD = 0.15
+
+# Where results are kept, next to the script; the file is local history and is gitignored
+RESULTS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench_results.jsonl")
+
+
+def page_path(index):
+    return "/" if index == 0 else f"/pages/{index}.html"
+
+
+def make_site(pages, assets, asset_kb, page_kb, error_rate=0.0, throttle_rate=0.0, seed=0):
+    """Build the site: {path: (status, content type, body)} plus the paths that fail and the ones throttled once.
+
+    Page i links to pages 2i+1 and 2i+2, so all pages are found within a
+    depth of log2(pages).
+    """
+    rng = random.Random(seed)
+    words = ["lorem", "ipsum", "dolor", "sit", "amet", "consectetur", "adipiscing", "elit"]
+    files = {}
+    asset_paths = []
+    for index in range(pages):
+        parts = ["<!DOCTYPE html><html><head><title>Page", str(index), "</title>"]
+        body = ["</head><body>"]
+        for number in range(assets):
+            extension, content_type, text = ASSET_KINDS[number % len(ASSET_KINDS)]
+            path = f"/assets/{index}/{number}.{extension}"
+            asset_paths.append(path)
+            size = asset_kb * 1024
+            if text:
+                data = " ".join(rng.choice(words) for _ in range(size // 6)).encode()[:size]
+            else:
+                data = rng.randbytes(size)
+            files[path] = (content_type, data)
+            if extension == "css":
+                parts.append(f'<link rel="stylesheet" href="{path}">')
+            elif extension == "js":
+                parts.append(f'<script src="{path}"></script>')
+            else:
+                body.append(f'<img src="{path}" alt="image {number}">')
+        for child in (2 * index + 1, 2 * index + 2):
+            if child < pages:
+                body.append(f'<a href="{page_path(child)}">page {child}</a>')
+        filler = page_kb * 1024 - sum(map(len, parts + body))
+        while filler > 0:
+            text = " ".join(rng.choice(words) for _ in range(rng.randint(20, 80)))
+            body.append(f"<p>{text}</p>\n")
+            filler -= len(text) + 8
+        body.append("</body></html>")
+        files[page_path(index)] = ("text/html; charset=utf-8", "".join(parts + body).encode())
+    failing = set(rng.sample(asset_paths, round(len(asset_paths) * error_rate)))
+    throttled = set(rng.sample(sorted(set(asset_paths) - failing), round(len(asset_paths) * throttle_rate)))
+    return files, failing, throttled
+
+
+class FixtureServer(http.server.ThreadingHTTPServer):
+    """Serves a site from make_site() and counts what it sent."""
+
+    daemon_threads = True
+
+    def __init__(self, files, failing=(), throttled=(), latency_ms=0):
+        super().__init__(("127.0.0.1", 0), FixtureHandler)
+        self.files = files
+        self.failing = failing
+        self.throttled = throttled
+        self.latency = latency_ms / 1000
+        self.lock = threading.Lock()
+        self.reset()
+
+    def handle_error(self, request, client_address):
+        # The downloader closing its keep-alive connections at the end is expected
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+    def reset(self):
+        with self.lock:
+            self.counts = {}
+            self.sent = 0
+            self.pages = 0
+            self.requested = set()
+
+    def respond(self, path):
+        """Return (status, headers, body) for path, counting it."""
+        with self.lock:
+            first = path not in self.requested
+            self.requested.add(path)
+        if path in self.failing:
+            status, headers, body = 500, {"Content-Type": "text/plain"}, b"injected error"
+        elif path in self.throttled and first:
+            status, headers, body = 429, {"Content-Type": "text/plain", "Retry-After": "0"}, b"slow down"
+        elif path in self.files:
+            content_type, body = self.files[path]
+            status, headers = 200, {"Content-Type": content_type}
+        else:
+            status, headers, body = 404, {"Content-Type": "text/plain"}, b"not found"
+        with self.lock:
+            self.counts[status] = self.counts.get(status, 0) + 1
+            if status == 200:
+                self.sent += len(body)
+                self.pages += headers["Content-Type"].startswith("text/html")
+        return status, headers, body
+
+
+class FixtureHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        status, headers, body = self.server.respond(self.path.split("?", 1)[0])
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def usage():
+    """Return (CPU seconds of this process and the processes it waited for, peak RSS of this process in MB)."""
+    if resource is None:
+        return None, None
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    cpu = own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime
+    try:
+        # Linux keeps ru_maxrss across exec, so it would include the benchmark process that started this one
+        with open("/proc/self/status", encoding="ascii") as file:
+            peak = next(int(line.split()[1]) for line in file if line.startswith("VmHWM:")) / 1024
+    except (OSError, StopIteration):
+        # ru_maxrss is in kilobytes, except on macOS
+        peak = own.ru_maxrss / (1024 * 1024 if sys.platform == "darwin" else 1024)
+    return cpu, peak
+
+
+def download_in_child(url, options, directory, connection):
+    """Body of the benchmark process: download url into directory and send back the summary and usage."""
+    os.chdir(directory)
+    from logs import setup_logging
+    from main6 import download_website
+
+    # The injected errors would only clutter the report
+    setup_logging("ERROR", quiet=True)
+    cpu_before, _ = usage()
+    summary = download_website(url, quiet=True, **options)
+    cpu_after, peak = usage()
+    connection.send({"summary": summary, "cpu": None if cpu_before is None else cpu_after - cpu_before,
+                     "peak_rss_mb": peak})
+    connection.close()
+
+
+def run_once(server, url, options):
+    """Download the served site once in a fresh process; return its measurements."""
+    server.reset()
+    context = multiprocessing.get_context("spawn")
+    receiver, sender = context.Pipe(duplex=False)
+    with tempfile.TemporaryDirectory() as directory:
+        process = context.Process(target=download_in_child, args=(url, options, directory, sender))
+        process.start()
+        sender.close()
+        try:
+            result = receiver.recv()
+        except EOFError:
+            result = None
+        process.join()
+    if result is None:
+        raise RuntimeError(f"benchmark process failed with exit code {process.exitcode}")
+    summary = result["summary"]
+    seconds = summary["seconds"]
+    return {
+        "seconds": seconds,
+        "pages": server.pages,
+        "files": summary["downloaded"],
+        "failed": summary["failed"],
+        "ok": summary["ok"],
+        "bytes": server.sent,
+        "pages_per_s": server.pages / seconds,
+        "mb_per_s": server.sent / 1e6 / seconds,
+        "cpu_seconds": result["cpu"],
+        "peak_rss_mb": result["peak_rss_mb"],
+        "responses": {str(status): count for status, count in sorted(server.counts.items())},
+    }
+
+
+def git_commit():
+    """Return the commit of the working tree ("+dirty" if it has changes), or None outside a git checkout."""
+    try:
+        return subprocess.run(["git", "describe", "--always", "--dirty=+dirty"], capture_output=True, text=True,
+                              check=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def read_results(path):
+    if not os.path.exists(path):
+        return []
+    with open(path, encoding="utf-8") as file:
+        return [json.loads(line) for line in file if line.strip()]
+
+
+def run_scenario(name, site_options, options, repeat, previous):
+    """Serve one scenario, download it `repeat` times and return the result, with medians of the runs."""
+    latency_ms = site_options["latency_ms"]
+    files, failing, throttled = make_site(**{key: value for key, value in site_options.items()
+                                             if key != "latency_ms"})
+    server = FixtureServer(files, failing, throttled, latency_ms)
+    thread = threading.Thread(target=server.serve_forever, name="fixture-server", daemon=True)
+    thread.start()
+    try:
+        url = f"http://127.0.0.1:{server.server_address[1]}/"
+        runs = [run_once(server, url, options) for _ in range(repeat)]
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    result = {
+        "time": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+        "commit": git_commit(),
+        "python": sys.version.split()[0],
+        "scenario": name,
+        "site": site_options,
+        "options": options,
+        "repeat": repeat,
+    }
+    for key in ("seconds", "pages_per_s", "mb_per_s", "cpu_seconds", "peak_rss_mb"):
+        values = [run[key] for run in runs if run[key] is not None]
+        result[key] = statistics.median(values) if values else None
+    for key in ("pages", "files", "failed", "bytes", "responses"):
+        result[key] = runs[-1][key]
+    result["ok"] = all(run["ok"] for run in runs)
+
+    print(format_result(result))
+    last = next((entry for entry in reversed(previous) if entry["scenario"] == name
+                 and entry["site"] == site_options and entry["options"] == options), None)
+    if last:
+        change = result["pages_per_s"] / last["pages_per_s"] - 1
+        flag = "  REGRESSION" if change < -REGRESSION_THRESHOLD else ""
+        print(f"{'':10s} vs {last['commit']} ({last['time']}): {last['pages_per_s']:.1f} pages/s, "
+              f"{change:+.0%}{flag}")
+    return result
+
+
+def format_result(result):
+    cpu = "-" if result["cpu_seconds"] is None else f"{result['cpu_seconds']:.2f}s"
+    rss = "-" if result["peak_rss_mb"] is None else f"{result['peak_rss_mb']:.0f} MB"
+    return (f"{result['scenario']:10s} {result['seconds']:6.2f}s  {result['pages_per_s']:7.1f} pages/s  "
+            f"{result['mb_per_s']:7.2f} MB/s  CPU {cpu:>7s}  RSS {rss:>7s}  "
+            f"{result['files']} files, {result['failed']} failed  [{result['commit']}]")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark download_website() against a local fixture server.")
+    parser.add_argument("scenarios", nargs="*", default=list(SCENARIOS),
+                        help=f"scenarios to run (default: all of {', '.join(SCENARIOS)})")
+    parser.add_argument("--engine", choices=("threads", "async"), default="threads")
+    parser.add_argument("--output", choices=("zip", "folder", "store"), default="zip")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--parser", choices=("stream", "lxml", "bs4"), default="stream")
+    parser.add_argument("--repeat", type=int, default=1, help="runs per scenario; the medians are reported")
+    parser.add_argument("--results", default=RESULTS_FILE, help="JSON lines file the results are appended to")
+    parser.add_argument("--no-save", action="store_true", help="don't append the results")
+    parser.add_argument("--history", action="store_true", help="list the stored results and exit")
+    for name in ("pages", "assets", "asset_kb", "page_kb", "latency_ms"):
+        parser.add_argument(f"--{name.replace('_', '-')}", type=int, default=None, help="override the scenario's")
+    for name in ("error_rate", "throttle_rate"):
+        parser.add_argument(f"--{name.replace('_', '-')}", type=float, default=None, help="override the scenario's")
+    args = parser.parse_args()
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenario {', '.join(sorted(unknown))}")
+
+    previous = read_results(args.results)
+    if args.history:
+        for entry in previous:
+            print(f"{entry['time']}  {entry['options']['engine']:7s} {entry['options']['output']:6s} "
+                  + format_result(entry))
+        return
+
+    options = dict(engine=args.engine, output=args.output, workers=args.workers, parser=args.parser)
+    results = []
+    for name in args.scenarios:
+        site_options = dict(SCENARIOS[name])
+        for key in site_options:
+            if getattr(args, key) is not None:
+                site_options[key] = getattr(args, key)
+        # Deep enough to reach every page of the site
+        options.update(max_depth=site_options["pages"], max_pages=site_options["pages"])
+        results.append(run_scenario(name, site_options, dict(options), args.repeat, previous))
+
+    if not args.no_save:
+        with open(args.results, "a", encoding="utf-8") as file:
+            for result in results:
+                file.write(json.dumps(result) + "\n")
+        print(f"Results appended to {args.results}")
+
+
+if __name__ == "__main__":
+    main()
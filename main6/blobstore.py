@@ -0,0 +1,314 @@
+import hashlib
+import io
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+from archive import ArchiveWriter
+from tracing import span
+
+
+def start_url_hash(url):
+    """Key of the snapshots of one start URL; different pages of a site don't share snapshots."""
+    return hashlib.sha1(url.encode("utf-8")).hexdigest()
+
+
+class BlobStore:
+    """Content-addressed store of downloaded bodies, shared by all mirrored sites.
+
+    Each body is stored once under its SHA-256 in `directory`/blobs, no matter
+    how many sites reference it. Sites are described by JSON manifests in
+    `directory`/manifests that map archive paths to hashes, and an SQLite
+    index remembers the last hash seen for every URL and the snapshots taken
+    of every start URL.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.blob_dir = os.path.join(directory, "blobs")
+        self.manifest_dir = os.path.join(directory, "manifests")
+        os.makedirs(self.blob_dir, exist_ok=True)
+        os.makedirs(self.manifest_dir, exist_ok=True)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(os.path.join(directory, "urls.sqlite"), check_same_thread=False)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS urls (url TEXT PRIMARY KEY, sha256 TEXT, size INTEGER, content_type TEXT)"
+        )
+        self.db.execute("CREATE TABLE IF NOT EXISTS snapshots (name TEXT PRIMARY KEY, url_hash TEXT, created REAL)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS snapshots_url ON snapshots (url_hash, created)")
+        self.db.commit()
+
+    def blob_path(self, digest):
+        # Fan out over 256 subfolders so no folder gets too big
+        return os.path.join(self.blob_dir, digest[:2], digest)
+
+    def has(self, digest):
+        return os.path.exists(self.blob_path(digest))
+
+    def put(self, fileobj):
+        """Store the contents of fileobj (read from its start); return (sha256, size)."""
+        sha = hashlib.sha256()
+        fd, temp_path = tempfile.mkstemp(dir=self.blob_dir, suffix=".part")
+        try:
+            with os.fdopen(fd, 'wb') as file:
+                fileobj.seek(0)
+                while True:
+                    chunk = fileobj.read(64 * 1024)
+                    if not chunk:
+                        break
+                    sha.update(chunk)
+                    file.write(chunk)
+                size = file.tell()
+            digest = sha.hexdigest()
+            path = self.blob_path(digest)
+            if os.path.exists(path):
+                os.remove(temp_path)
+            else:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                os.replace(temp_path, path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        return digest, size
+
+    def open(self, digest):
+        return open(self.blob_path(digest), 'rb')
+
+    def lookup_url(self, url):
+        """Return (sha256, size, content_type) last stored for url if that blob is still present, else None."""
+        with self.lock:
+            row = self.db.execute("SELECT sha256, size, content_type FROM urls WHERE url = ?", (url,)).fetchone()
+        if row and self.has(row[0]):
+            return row
+        return None
+
+    def record_url(self, url, digest, size, content_type=None):
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO urls VALUES (?, ?, ?, ?)", (url, digest, size, content_type))
+            self.db.commit()
+
+    def manifest_path(self, name):
+        return os.path.join(self.manifest_dir, f"{name}.json")
+
+    def write_manifest(self, name, manifest):
+        path = self.manifest_path(name)
+        with open(path + ".part", "w", encoding="utf-8") as file:
+            json.dump(manifest, file, indent=1)
+        os.replace(path + ".part", path)
+        self._index_snapshot(name, manifest)
+
+    def _index_snapshot(self, name, manifest):
+        url_hash = start_url_hash(manifest["url"]) if manifest.get("url") else None
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO snapshots VALUES (?, ?, ?)",
+                            (name, url_hash, manifest.get("created", 0)))
+            self.db.commit()
+
+    def read_manifest(self, name):
+        with open(self.manifest_path(name), encoding="utf-8") as file:
+            return json.load(file)
+
+    def list_manifests(self):
+        return sorted(name[:-5] for name in os.listdir(self.manifest_dir) if name.endswith(".json"))
+
+    def latest_manifest(self, url):
+        """Return the newest snapshot of the site downloaded from start URL url, or None if there is none."""
+        # Manifests written before the snapshot index existed are indexed once
+        with self.lock:
+            indexed = {row[0] for row in self.db.execute("SELECT name FROM snapshots")}
+        for name in self.list_manifests():
+            if name not in indexed:
+                self._index_snapshot(name, self.read_manifest(name))
+        with self.lock:
+            rows = self.db.execute("SELECT name FROM snapshots WHERE url_hash = ? ORDER BY created DESC",
+                                   (start_url_hash(url),)).fetchall()
+        for (name,) in rows:
+            if os.path.exists(self.manifest_path(name)):
+                return name
+        return None
+
+    def export_zip(self, name, zip_path, policy=None, delta=False):
+        """Build the per-site ZIP archive for a stored site from its manifest.
+
+        With delta=True only the entries that are new or changed since the
+        snapshot it was based on are exported, plus a delta.json listing the
+        base snapshot and the removed paths. Returns the compression stats of
+        the archive, like ArchiveWriter.stats.
+        """
+        manifest = self.read_manifest(name)
+        entries = manifest["entries"]
+        if delta:
+            entries = [entry for entry in entries if entry.get("changed", True)]
+        writer = ArchiveWriter(zip_path, policy)
+        try:
+            for entry in entries:
+                writer.add(entry["path"], self.open(entry["sha256"]), entry.get("content_type"))
+            if delta:
+                info = {"base": manifest.get("base"), "removed": manifest.get("removed", [])}
+                writer.add_bytes("delta.json", json.dumps(info, indent=1).encode("utf-8"), "application/json")
+        except BaseException:
+            writer.abort()
+            raise
+        writer.close()
+        return writer.stats
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+class SnapshotCache:
+    """Revalidates downloads against a previous snapshot of the same site.
+
+    Has the same interface as cache.HttpCache, so download_file() sends the
+    validators recorded in the previous manifest and reuses its blob on a
+    304. It also remembers the validators of this run for the new manifest.
+    Stylesheets are stored with their references rewritten, so their
+    original body is stored as well (the entry's source_sha256) and is what
+    a 304 reuses. URLs the snapshot doesn't have are revalidated against
+    `fallback`, an HttpCache, if given; it also keeps a copy of every body.
+    """
+
+    def __init__(self, store, previous=None, fallback=None):
+        self.blobs = store
+        self.fallback = fallback
+        self.previous = {}
+        if previous:
+            self.previous = {entry["url"]: entry for entry in previous["entries"] if entry.get("url")}
+        self.lock = threading.Lock()
+        self.validators = {}
+        self.sources = {}
+
+    def conditional_headers(self, url):
+        entry = self.previous.get(url)
+        headers = {}
+        if entry and self.blobs.has(entry["sha256"]):
+            if entry.get("etag"):
+                headers["If-None-Match"] = entry["etag"]
+            if entry.get("last_modified"):
+                headers["If-Modified-Since"] = entry["last_modified"]
+        elif self.fallback:
+            headers = self.fallback.conditional_headers(url)
+        return headers
+
+    def open(self, url):
+        entry = self.previous.get(url)
+        digest = entry and (entry.get("source_sha256") or entry["sha256"])
+        if entry is None or not self.blobs.has(digest):
+            return self._open_fallback(url)
+        with self.lock:
+            self.validators[url] = (entry.get("etag"), entry.get("last_modified"))
+            if entry.get("source_sha256"):
+                self.sources[url] = digest
+        return self.blobs.open(digest), entry.get("content_type")
+
+    def _open_fallback(self, url):
+        if self.fallback is None:
+            return None, None
+        # The validators the 304 confirmed are the ones the fallback sent
+        headers = self.fallback.conditional_headers(url)
+        body, content_type = self.fallback.open(url)
+        if body is not None:
+            # Kept like a downloaded body, see store()
+            self.store(url, body, {"Content-Type": content_type or "", "ETag": headers.get("If-None-Match"),
+                                   "Last-Modified": headers.get("If-Modified-Since")}, fallback=False)
+        return body, content_type
+
+    def store(self, url, fileobj, headers, fallback=True):
+        source = None
+        if "text/css" in headers.get("Content-Type", "").lower():
+            source, _ = self.blobs.put(fileobj)
+            fileobj.seek(0)
+        with self.lock:
+            self.validators[url] = (headers.get("ETag"), headers.get("Last-Modified"))
+            if source:
+                self.sources[url] = source
+        if fallback and self.fallback:
+            self.fallback.store(url, fileobj, headers)
+
+    def close(self):
+        if self.fallback:
+            self.fallback.close()
+
+
+class BlobWriter:
+    """Writer that stores downloads in a BlobStore and records them in a site manifest.
+
+    With reuse_known=True, reuse() lets download_file() skip the network for
+    URLs whose last known body is already in the store. With a previous
+    snapshot, `cache` revalidates against it so unchanged resources are not
+    downloaded again, and the manifest marks which entries changed. An
+    HttpCache given as `http_cache` is chained behind it. Entries are also
+    recorded in `journal`, if given, so a resumed job keeps them.
+    """
+
+    def __init__(self, store, name, url, reuse_known=False, previous=None, journal=None, http_cache=None):
+        self.store = store
+        self.name = name
+        self.reuse_known = reuse_known
+        self.journal = journal
+        self.stats = {}
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.manifest = {"name": name, "url": url, "created": time.time(), "entries": []}
+        self.previous = {}
+        if previous:
+            self.manifest["base"] = previous["name"]
+            self.previous = {entry["path"]: entry for entry in previous["entries"]}
+        self.cache = SnapshotCache(store, previous, http_cache)
+
+    def add(self, arcname, fileobj, content_type=None, url=None):
+        with span("write", "disk", arcname=arcname), fileobj:
+            digest, size = self.store.put(fileobj)
+        if url:
+            self.store.record_url(url, digest, size, content_type)
+        self._record(arcname, url, digest, size, content_type)
+
+    def add_bytes(self, arcname, data, content_type=None, url=None):
+        self.add(arcname, io.BytesIO(data), content_type, url)
+
+    def reuse(self, arcname, url):
+        """Record a URL's known blob without downloading it; return True if it was reused."""
+        if not self.reuse_known:
+            return False
+        known = self.store.lookup_url(url)
+        if known is None:
+            return False
+        self._record(arcname, url, *known)
+        return True
+
+    def restore(self, entries):
+        """Re-add the entries an interrupted run already stored, without downloading them."""
+        for entry in entries:
+            if self.store.has(entry["sha256"]):
+                self._record(entry["path"], entry["url"], entry["sha256"], entry["size"], entry["content_type"],
+                             journal=False)
+
+    def _record(self, arcname, url, digest, size, content_type, journal=True):
+        with self.lock:
+            # Like the ZIP writer, the first body stored under a path wins
+            if arcname in self.entries:
+                return
+            entry = {"path": arcname, "url": url, "sha256": digest, "size": size, "content_type": content_type}
+            previous = self.previous.get(arcname)
+            entry["changed"] = previous is None or previous["sha256"] != digest
+            self.entries[arcname] = entry
+            self.manifest["entries"].append(entry)
+        if journal and self.journal:
+            self.journal.record_entry(entry)
+
+    def close(self):
+        for entry in self.manifest["entries"]:
+            entry["etag"], entry["last_modified"] = self.cache.validators.get(entry["url"], (None, None))
+            if entry["url"] in self.cache.sources:
+                entry["source_sha256"] = self.cache.sources[entry["url"]]
+        if self.previous:
+            self.manifest["removed"] = sorted(set(self.previous) - set(self.entries))
+        self.store.write_manifest(self.name, self.manifest)
+
+    def abort(self):
+        """Stop without writing the manifest; stored blobs stay, the journal remembers them."""
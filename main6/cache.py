@@ -0,0 +1,121 @@
+import hashlib
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+
+# Default upper bound for the bytes kept on disk by an HttpCache
+DEFAULT_MAX_BYTES = 1024 * 1024 * 1024
+
+
+class HttpCache:
+    """On-disk HTTP cache keyed by URL, revalidated with ETag / Last-Modified.
+
+    Bodies live in `directory`/bodies and are indexed in an SQLite database
+    together with their validators. Once the bodies exceed `max_bytes` the
+    least recently used entries are evicted. Safe to share between threads.
+    """
+
+    def __init__(self, directory, max_bytes=DEFAULT_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.body_dir = os.path.join(directory, "bodies")
+        os.makedirs(self.body_dir, exist_ok=True)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(os.path.join(directory, "index.sqlite"), check_same_thread=False)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS entries ("
+            "url TEXT PRIMARY KEY, etag TEXT, last_modified TEXT, content_type TEXT,"
+            "size INTEGER, last_used REAL)"
+        )
+        self.db.commit()
+
+    def _body_path(self, url):
+        return os.path.join(self.body_dir, hashlib.sha256(url.encode("utf-8")).hexdigest())
+
+    def conditional_headers(self, url):
+        """Return the If-None-Match / If-Modified-Since headers for a cached URL."""
+        with self.lock:
+            row = self.db.execute("SELECT etag, last_modified FROM entries WHERE url = ?", (url,)).fetchone()
+        headers = {}
+        if row:
+            etag, last_modified = row
+            if etag:
+                headers["If-None-Match"] = etag
+            if last_modified:
+                headers["If-Modified-Since"] = last_modified
+        return headers
+
+    def open(self, url):
+        """Return (file, content_type) for a cached body, or (None, None) if it is not cached."""
+        with self.lock:
+            row = self.db.execute("SELECT content_type FROM entries WHERE url = ?", (url,)).fetchone()
+            if row is None:
+                return None, None
+            try:
+                file = open(self._body_path(url), 'rb')
+            except FileNotFoundError:
+                self.db.execute("DELETE FROM entries WHERE url = ?", (url,))
+                self.db.commit()
+                return None, None
+            self.db.execute("UPDATE entries SET last_used = ? WHERE url = ?", (time.time(), url))
+            self.db.commit()
+            return file, row[0]
+
+    def store(self, url, fileobj, headers):
+        """Copy a downloaded body into the cache if the response can be revalidated later.
+
+        fileobj is read from its start and rewound afterwards.
+        """
+        etag = headers.get("ETag")
+        last_modified = headers.get("Last-Modified")
+        if not etag and not last_modified:
+            return
+        if "no-store" in headers.get("Cache-Control", ""):
+            return
+
+        path = self._body_path(url)
+        fd, temp_path = tempfile.mkstemp(dir=self.body_dir, suffix=".part")
+        try:
+            with os.fdopen(fd, 'wb') as file:
+                fileobj.seek(0)
+                shutil.copyfileobj(fileobj, file, 64 * 1024)
+                size = file.tell()
+            fileobj.seek(0)
+            if size > self.max_bytes:
+                os.remove(temp_path)
+                return
+            os.replace(temp_path, path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+        with self.lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?)",
+                (url, etag, last_modified, headers.get("Content-Type"), size, time.time()),
+            )
+            self._evict()
+            self.db.commit()
+
+    def _evict(self):
+        # Drop least recently used bodies until the cache fits in max_bytes
+        total = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        for url, size in self.db.execute("SELECT url, size FROM entries ORDER BY last_used").fetchall():
+            if total <= self.max_bytes:
+                break
+            self.db.execute("DELETE FROM entries WHERE url = ?", (url,))
+            try:
+                os.remove(self._body_path(url))
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def close(self):
+        with self.lock:
+            self.db.close()
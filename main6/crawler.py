@@ -0,0 +1,385 @@
+import hashlib
+import mimetypes
+import posixpath
+import re
+import threading
+from collections import deque
+from html.parser import HTMLParser
+from urllib.parse import urlparse, urlunparse, urljoin
+
+# Ports that are implied by the scheme and can be dropped from a URL
+DEFAULT_PORTS = {"http": 80, "https": 443}
+
+# Pages a crawl downloads at most, the start page included, unless told otherwise
+DEFAULT_MAX_PAGES = 500
+
+# Link schemes that never point at a page we can download
+SKIPPED_SCHEMES = ("mailto:", "javascript:", "tel:", "data:")
+
+# <link rel> values whose href is a resource of the page
+RESOURCE_RELS = {"stylesheet", "icon", "apple-touch-icon", "apple-touch-icon-precomposed", "mask-icon",
+                 "manifest", "preload", "modulepreload"}
+
+# Attributes holding a resource URL, by tag
+RESOURCE_ATTRIBUTES = {
+    "script": ("src",), "img": ("src",), "source": ("src",), "video": ("src", "poster"), "audio": ("src",),
+    "track": ("src",), "embed": ("src",), "object": ("data",), "input": ("src",),
+}
+
+# Which candidates of a srcset to download
+SRCSET_POLICIES = ("largest", "smallest", "all", "none")
+
+CSS_COMMENT = re.compile(r"/\*.*?\*/", re.S)
+CSS_URL = re.compile(r"""url\(\s*(?:"([^"]*)"|'([^']*)'|([^)"'\s]*))\s*\)""", re.I)
+CSS_IMPORT = re.compile(r"""@import\s+(?:"([^"]*)"|'([^']*)')""", re.I)
+SRCSET_CANDIDATE = re.compile(r"(\S+?)(?:\s+([\d.]+)[wxh])?\s*(?:,\s*|$)")
+
+
+def normalize_url(url):
+    """Return a canonical form of the URL so that equivalent links are only crawled once."""
+    parsed = urlparse(url.strip())
+    scheme = parsed.scheme.lower()
+    host = (parsed.hostname or "").lower()
+    try:
+        port = parsed.port
+    except ValueError:
+        port = None
+    netloc = host
+    if port and DEFAULT_PORTS.get(scheme) != port:
+        netloc = f"{host}:{port}"
+
+    # Collapse "." and ".." segments but keep a trailing slash, it is significant
+    path = parsed.path or "/"
+    trailing = path.endswith("/")
+    path = posixpath.normpath("/" + path.lstrip("/"))
+    if trailing and path != "/":
+        path += "/"
+
+    # Fragments only move around inside a page, so drop them
+    return urlunparse((scheme, netloc, path, parsed.params, parsed.query, ""))
+
+
+def get_origin(url):
+    """Return the (scheme, netloc) pair used for same-origin checks; netloc includes a non-default port."""
+    parsed = urlparse(normalize_url(url))
+    return parsed.scheme, parsed.netloc
+
+
+def is_same_origin(url, other):
+    return get_origin(url) == get_origin(other)
+
+
+def extract_links(soup, base_url):
+    """Collect absolute, normalized http(s) URLs from the <a href> tags of a page."""
+    base = soup.find("base", href=True)
+    if base:
+        base_url = urljoin(base_url, base["href"])
+
+    links = []
+    for anchor in soup.find_all("a", href=True):
+        href = anchor["href"].strip()
+        if not href or href.startswith("#") or href.lower().startswith(SKIPPED_SCHEMES):
+            continue
+        link = urljoin(base_url, href)
+        if urlparse(link).scheme in ("http", "https"):
+            links.append(normalize_url(link))
+    return links
+
+
+def resolve_url(base_url, url):
+    """Return url made absolute against base_url, or None if it is empty or not http(s)."""
+    url = (url or "").strip()
+    if not url or url.startswith("#") or url.lower().startswith(SKIPPED_SCHEMES):
+        return None
+    url = urljoin(base_url, url)
+    return url if urlparse(url).scheme in ("http", "https") else None
+
+
+def extract_css_urls(css, base_url):
+    """Return the absolute URLs a stylesheet references with url() and @import."""
+    css = CSS_COMMENT.sub("", css)
+    urls = []
+    for pattern in (CSS_IMPORT, CSS_URL):
+        for match in pattern.finditer(css):
+            url = resolve_url(base_url, next(group for group in match.groups() if group is not None))
+            if url:
+                urls.append(url)
+    return urls
+
+
+def pick_srcset(srcset, policy="largest"):
+    """Return the URLs of a srcset attribute to download under policy (see SRCSET_POLICIES)."""
+    if policy == "none":
+        return []
+    candidates = []
+    for match in SRCSET_CANDIDATE.finditer(srcset.strip()):
+        if match.group(1):
+            # No descriptor means 1x
+            candidates.append((float(match.group(2) or 1), match.group(1)))
+    if policy == "all" or not candidates:
+        return [url for _, url in candidates]
+    pick = max if policy == "largest" else min
+    return [pick(candidates, key=lambda candidate: candidate[0])[1]]
+
+
+def extract_resources(soup, base_url):
+    """Collect the CSS, JS and image URLs referenced by a page."""
+    css_links = [urljoin(base_url, link.get("href")) for link in soup.find_all("link", {"rel": "stylesheet"})]
+    js_links = [urljoin(base_url, script.get("src")) for script in soup.find_all("script", {"src": True})]
+    img_links = [urljoin(base_url, img.get("src")) for img in soup.find_all("img", {"src": True})]
+    return css_links + js_links + img_links
+
+
+class PageUrls:
+    """Collects the links and resources of a page from its tags, whatever parser reports them.
+
+    Resources are stylesheets, scripts, icons, preloads, images (with one
+    candidate of each srcset, chosen by `srcset`), audio/video sources and
+    posters, and the url()s of inline styles. on_resource, if given, is
+    called with every resource URL as soon as it is seen, so it can be
+    downloaded while the rest of the page is parsed.
+    """
+
+    def __init__(self, base_url, on_resource=None, srcset="largest"):
+        self.base_url = base_url
+        self.on_resource = on_resource
+        self.srcset = srcset
+        self.links = []
+        self.resources = []
+
+    def start_tag(self, tag, attrs):
+        """Handle one start tag; attrs is a dict of its attributes."""
+        if tag == "base" and attrs.get("href"):
+            self.base_url = urljoin(self.base_url, attrs["href"])
+        elif tag == "a":
+            link = resolve_url(self.base_url, attrs.get("href"))
+            if link:
+                self.links.append(normalize_url(link))
+        elif tag == "link":
+            if RESOURCE_RELS.intersection((attrs.get("rel") or "").lower().split()):
+                self._resource(attrs.get("href"))
+                if attrs.get("imagesrcset"):
+                    self._srcset(attrs["imagesrcset"])
+        elif tag in RESOURCE_ATTRIBUTES:
+            if tag == "input" and (attrs.get("type") or "").lower() != "image":
+                return
+            for name in RESOURCE_ATTRIBUTES[tag]:
+                self._resource(attrs.get(name))
+            if attrs.get("srcset"):
+                self._srcset(attrs["srcset"])
+        if attrs.get("style"):
+            self.style(attrs["style"])
+
+    def style(self, css):
+        """Handle the CSS of a <style> element or style attribute."""
+        for url in extract_css_urls(css, self.base_url):
+            self._resource(url)
+
+    def _srcset(self, srcset):
+        for url in pick_srcset(srcset, self.srcset):
+            self._resource(url)
+
+    def _resource(self, url):
+        url = resolve_url(self.base_url, url)
+        if url:
+            self.resources.append(url)
+            if self.on_resource:
+                self.on_resource(url)
+
+    def result(self):
+        return self.links, self.resources
+
+
+class StreamPageParser(HTMLParser):
+    """Single-pass page parser on the standard library's tokenizer, without building a tree.
+
+    Feed it the page in pieces as they arrive; close() returns (links, resources).
+    """
+
+    def __init__(self, base_url, on_resource=None, srcset="largest"):
+        # convert_charrefs=True lets the tokenizer skip over text in big steps
+        super().__init__(convert_charrefs=True)
+        self.urls = PageUrls(base_url, on_resource, srcset)
+        self.in_style = False
+
+    def handle_starttag(self, tag, attrs):
+        self.urls.start_tag(tag, dict(attrs))
+        self.in_style = tag == "style"
+
+    def handle_endtag(self, tag):
+        self.in_style = False
+
+    def handle_data(self, data):
+        if self.in_style:
+            self.urls.style(data)
+
+    def close(self):
+        super().close()
+        return self.urls.result()
+
+
+class LxmlPageParser:
+    """Same as StreamPageParser on lxml's incremental parser, which is faster still."""
+
+    def __init__(self, base_url, on_resource=None, srcset="largest"):
+        try:
+            from lxml import etree
+        except ImportError:
+            raise RuntimeError("The lxml parser requires lxml (pip install lxml)")
+        self.parser = etree.HTMLPullParser(events=("start", "end"))
+        self.urls = PageUrls(base_url, on_resource, srcset)
+
+    def _read_events(self):
+        for event, element in self.parser.read_events():
+            # Comments and processing instructions have no string tag
+            if not isinstance(element.tag, str):
+                continue
+            if event == "start":
+                self.urls.start_tag(element.tag.lower(), dict(element.attrib))
+            elif element.tag.lower() == "style" and element.text:
+                # The text of an element is only complete at its end
+                self.urls.style(element.text)
+
+    def feed(self, data):
+        self.parser.feed(data)
+        self._read_events()
+
+    def close(self):
+        self.parser.close()
+        self._read_events()
+        return self.urls.result()
+
+
+class SoupPageParser:
+    """The original BeautifulSoup tree and find_all passes, behind the same interface.
+
+    Only finds stylesheets, scripts and images, srcset is ignored.
+    """
+
+    def __init__(self, base_url, on_resource=None, srcset="largest"):
+        try:
+            from bs4 import BeautifulSoup
+        except ImportError:
+            raise RuntimeError("The bs4 parser requires BeautifulSoup (pip install beautifulsoup4)")
+        self.BeautifulSoup = BeautifulSoup
+        self.base_url = base_url
+        self.on_resource = on_resource
+        self.parts = []
+
+    def feed(self, data):
+        self.parts.append(data)
+
+    def close(self):
+        soup = self.BeautifulSoup("".join(self.parts), 'html.parser')
+        links, resources = extract_links(soup, self.base_url), extract_resources(soup, self.base_url)
+        if self.on_resource:
+            for resource in resources:
+                self.on_resource(resource)
+        return links, resources
+
+
+# Page parsers by name, all with feed(text) and close() -> (links, resources)
+PARSERS = {"stream": StreamPageParser, "lxml": LxmlPageParser, "bs4": SoupPageParser}
+
+
+def check_page_parser(parser, srcset="largest"):
+    """Raise ValueError for an unknown parser or srcset policy."""
+    if parser not in PARSERS:
+        raise ValueError(f"Unknown parser {parser!r}, use one of {', '.join(PARSERS)}")
+    if srcset not in SRCSET_POLICIES:
+        raise ValueError(f"Unknown srcset policy {srcset!r}, use one of {', '.join(SRCSET_POLICIES)}")
+
+
+def new_page_parser(parser, base_url, on_resource=None, srcset="largest"):
+    check_page_parser(parser, srcset)
+    return PARSERS[parser](base_url, on_resource, srcset)
+
+
+def parse_page(html, base_url, parser="stream", srcset="largest"):
+    """Return the (links, resources) found in a page's HTML."""
+    page = new_page_parser(parser, base_url, srcset=srcset)
+    page.feed(html)
+    return page.close()
+
+
+def is_stylesheet(url, content_type=None):
+    if content_type:
+        return "text/css" in content_type.lower()
+    return urlparse(url).path.lower().endswith(".css")
+
+
+def page_path(url):
+    """Map a page URL to a relative .html path, e.g. /docs/intro -> docs/intro.html.
+
+    Links to documents such as /files/report.pdf keep their own extension.
+    """
+    parsed = urlparse(url)
+    path = parsed.path.lstrip("/")
+    guessed, _ = mimetypes.guess_type(path)
+    if not path or path.endswith("/"):
+        path += "index.html"
+    elif not path.endswith((".html", ".htm")) and (guessed is None or "html" in guessed):
+        path += ".html"
+    if parsed.query:
+        # Pages that only differ by query string must not overwrite each other
+        digest = hashlib.sha1(parsed.query.encode("utf-8")).hexdigest()[:8]
+        root, ext = posixpath.splitext(path)
+        path = f"{root}_{digest}{ext}"
+    return path
+
+
+class Frontier:
+    """Deduplicated, bounded queue of pages that still have to be crawled.
+
+    Accepted pages are also queued in `journal`, if given, so that an
+    interrupted crawl can be restored with restore().
+    """
+
+    def __init__(self, start_url, max_depth=0, max_pages=DEFAULT_MAX_PAGES, same_origin=True, journal=None):
+        self.start_url = normalize_url(start_url)
+        self.max_depth = max_depth
+        self.max_pages = max_pages
+        self.same_origin = same_origin
+        self.journal = journal
+        self.queue = deque()
+        self.seen = {self.start_url}
+        # The start page has already been accepted
+        self.accepted = 1
+        self.lock = threading.Lock()
+
+    def add(self, url, depth):
+        """Queue a page if it is in scope and new; return True when it was accepted."""
+        if depth > self.max_depth:
+            return False
+        url = normalize_url(url)
+        if self.same_origin and not is_same_origin(url, self.start_url):
+            return False
+        with self.lock:
+            if url in self.seen or self.accepted >= self.max_pages:
+                return False
+            self.seen.add(url)
+            self.accepted += 1
+            self.queue.append((url, depth))
+        if self.journal:
+            self.journal.queue(url, "page", depth)
+        return True
+
+    def restore(self, known, pending):
+        """Resume from a journal: `known` pages were accepted before, `pending` (url, depth) pairs still need crawling."""
+        with self.lock:
+            self.seen.update(known)
+            self.accepted = len(self.seen)
+            for url, depth in pending:
+                if url != self.start_url:
+                    self.queue.append((url, depth))
+
+    def pop(self):
+        """Return the next (url, depth) pair, or None when the queue is empty."""
+        with self.lock:
+            if self.queue:
+                return self.queue.popleft()
+            return None
+
+    def __len__(self):
+        with self.lock:
+            return len(self.queue)
@@ -0,0 +1,163 @@
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import threading
+import time
+
+# Bodies bigger than this are downloaded into a named partial file whose
+# offset is journaled, so they can be continued with a Range request
+PARTIAL_THRESHOLD = 8 * 1024 * 1024
+
+# How often the offset of a partial download is written to the journal
+CHECKPOINT_BYTES = 1024 * 1024
+
+# Changes are committed in batches of this many, or once the oldest
+# uncommitted change is this many seconds old
+COMMIT_EVERY = 200
+COMMIT_SECONDS = 1.0
+
+
+class JobJournal:
+    """Write-ahead journal of one download job, so an interrupted run can resume.
+
+    Records which pages and resources were queued, completed or failed, the
+    archive entries already stored, and how far big downloads got. Backed by
+    SQLite in WAL mode. Changes are committed in batches, in the order they
+    were made, so a crash only loses the last few; those URLs are simply
+    downloaded again on resume.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.partial_dir = path + ".partials"
+        os.makedirs(self.partial_dir, exist_ok=True)
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.batch_started = 0.0
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS job (key TEXT PRIMARY KEY, value TEXT)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS urls (url TEXT PRIMARY KEY, kind TEXT, depth INTEGER, status TEXT)")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS entries ("
+            "path TEXT PRIMARY KEY, url TEXT, sha256 TEXT, size INTEGER, content_type TEXT)"
+        )
+        self.db.execute("CREATE TABLE IF NOT EXISTS partials (url TEXT PRIMARY KEY, offset INTEGER, validator TEXT)")
+
+    def _execute(self, sql, params=()):
+        with self.lock:
+            return self.db.execute(sql, params).fetchall()
+
+    def _write(self, sql, params=()):
+        # Reads on the same connection see the uncommitted changes
+        with self.lock:
+            if not self.db.in_transaction:
+                self.db.execute("BEGIN")
+                self.batch_started = time.monotonic()
+            self.db.execute(sql, params)
+            self.pending += 1
+            if self.pending >= COMMIT_EVERY or time.monotonic() - self.batch_started >= COMMIT_SECONDS:
+                self._commit()
+
+    def _commit(self):
+        if self.db.in_transaction:
+            self.db.execute("COMMIT")
+        self.pending = 0
+
+    def flush(self):
+        """Commit the changes of the current batch."""
+        with self.lock:
+            self._commit()
+
+    def info(self):
+        """Return the job description saved with start(), or None for a new journal."""
+        rows = self._execute("SELECT value FROM job WHERE key = 'info'")
+        return json.loads(rows[0][0]) if rows else None
+
+    def start(self, info):
+        """Forget any previous job and record the description of a new one."""
+        with self.lock:
+            self._commit()
+            self.db.execute("BEGIN")
+            for table in ("job", "urls", "entries", "partials"):
+                self.db.execute(f"DELETE FROM {table}")
+            self.db.execute("INSERT INTO job VALUES ('info', ?)", (json.dumps(info),))
+            self.db.execute("COMMIT")
+        shutil.rmtree(self.partial_dir, ignore_errors=True)
+        os.makedirs(self.partial_dir, exist_ok=True)
+
+    def queue(self, url, kind, depth=None):
+        self._write("INSERT OR IGNORE INTO urls VALUES (?, ?, ?, 'queued')", (url, kind, depth))
+
+    def finish(self, url, ok):
+        self._write("UPDATE urls SET status = ? WHERE url = ?", ("done" if ok else "failed", url))
+
+    def done_urls(self):
+        """Return the URLs that completed, including bodies stored just before an interruption."""
+        done = {row[0] for row in self._execute("SELECT url FROM urls WHERE status = 'done'")}
+        return done | {row[0] for row in self._execute("SELECT url FROM entries WHERE url IS NOT NULL")}
+
+    def known_pages(self):
+        return {row[0] for row in self._execute("SELECT url FROM urls WHERE kind = 'page'")}
+
+    def unfinished(self, kind):
+        """Return the (url, depth) pairs of this kind that were queued or failed but never completed."""
+        return self._execute("SELECT url, depth FROM urls WHERE kind = ? AND status != 'done'", (kind,))
+
+    def record_entry(self, entry):
+        self._write(
+            "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)",
+            (entry["path"], entry["url"], entry["sha256"], entry["size"], entry["content_type"]),
+        )
+
+    def entries(self):
+        rows = self._execute("SELECT path, url, sha256, size, content_type FROM entries")
+        return [dict(zip(("path", "url", "sha256", "size", "content_type"), row)) for row in rows]
+
+    def partial_path(self, url):
+        return os.path.join(self.partial_dir, hashlib.sha256(url.encode("utf-8")).hexdigest())
+
+    def partial(self, url):
+        """Return (offset, validator) of an interrupted download of url, or (0, None)."""
+        rows = self._execute("SELECT offset, validator FROM partials WHERE url = ?", (url,))
+        if not rows:
+            return 0, None
+        offset, validator = rows[0]
+        try:
+            size = os.path.getsize(self.partial_path(url))
+        except OSError:
+            return 0, None
+        # Bytes written after the last checkpoint are not trusted
+        return min(offset, size), validator
+
+    def open_partial(self, url, offset):
+        """Open the partial file of url positioned at offset, dropping anything after it."""
+        file = open(self.partial_path(url), 'r+b' if offset else 'w+b')
+        file.truncate(offset)
+        file.seek(offset)
+        return file
+
+    def checkpoint(self, url, offset, validator):
+        self._write("INSERT OR REPLACE INTO partials VALUES (?, ?, ?)", (url, offset, validator))
+
+    def drop_partial(self, url):
+        self._write("DELETE FROM partials WHERE url = ?", (url,))
+        try:
+            os.remove(self.partial_path(url))
+        except FileNotFoundError:
+            pass
+
+    def close(self, remove=False):
+        """Close the journal; remove=True deletes it once the job has completed."""
+        with self.lock:
+            self._commit()
+            self.db.close()
+        if remove:
+            for suffix in ("", "-wal", "-shm"):
+                try:
+                    os.remove(self.path + suffix)
+                except FileNotFoundError:
+                    pass
+            shutil.rmtree(self.partial_dir, ignore_errors=True)
@@ -0,0 +1,223 @@
+import atexit
+import datetime
+import json
+import logging
+import queue
+import sys
+import threading
+import time
+
+from metrics import METRICS
+
+# Logger of the downloader; per-file successes are DEBUG, site progress INFO, retries WARNING, failures ERROR
+LOGGER = logging.getLogger("website_downloader")
+
+# extra= for INFO messages reporting that something worked, shown in green
+SUCCESS = {"success": True}
+
+# Console colours per level, colorama.Fore names
+LEVEL_COLORS = {
+    logging.DEBUG: "GREEN",
+    logging.INFO: "CYAN",
+    logging.WARNING: "YELLOW",
+    logging.ERROR: "RED",
+    logging.CRITICAL: "RED",
+}
+
+# Attributes every LogRecord has; the others were passed with extra= and go into the JSON lines
+RECORD_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime", "success"}
+
+# Seconds between updates of the progress line
+PROGRESS_INTERVAL = 1.0
+
+# The listener running the handlers, set by setup_logging()
+listener = None
+listener_lock = threading.Lock()
+
+
+class ColorFormatter(logging.Formatter):
+    """Formats records for the terminal, coloured by level like the old print() calls."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Only runs that log to the terminal load colorama
+        from colorama import Fore, Style, just_fix_windows_console
+
+        just_fix_windows_console()
+        self.colors = {level: getattr(Fore, name) for level, name in LEVEL_COLORS.items()}
+        self.success = Fore.GREEN
+        self.reset = Style.RESET_ALL
+
+    def format(self, record):
+        color = self.success if getattr(record, "success", False) else self.colors.get(record.levelno, "")
+        return color + super().format(record) + self.reset
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats each record as one JSON object: time, level, message and the fields passed with extra=."""
+
+    def format(self, record):
+        entry = {
+            "time": datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc).isoformat(),
+            "level": record.levelname,
+            "message": record.getMessage(),
+        }
+        for name, value in vars(record).items():
+            if name not in RECORD_ATTRIBUTES:
+                entry[name] = value if isinstance(value, (str, int, float, bool, type(None))) else str(value)
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+
+class TqdmHandler(logging.StreamHandler):
+    """Writes to the terminal through tqdm, so lines don't break a progress bar that is being drawn."""
+
+    def __init__(self, stream=None):
+        super().__init__(stream)
+        from tqdm import tqdm
+
+        self.write = tqdm.write
+
+    def emit(self, record):
+        try:
+            self.write(self.format(record), file=self.stream)
+        except Exception:
+            self.handleError(record)
+
+
+def setup_logging(level="INFO", json_path=None, quiet=False):
+    """Send LOGGER's records through a queue to a background thread that formats and writes them.
+
+    Worker threads only put records on the queue, the terminal and file I/O
+    happens in the listener thread. Records of `level` and above are shown
+    in colour on the terminal, unless quiet is set, and written as JSON lines
+    to json_path ("-" for stdout) if given. Calling it again replaces the
+    previous setup.
+    """
+    global listener
+    # Not needed until logging is set up
+    import logging.handlers
+
+    level = logging.getLevelName(level.upper()) if isinstance(level, str) else level
+    handlers = []
+    if not quiet:
+        console = TqdmHandler(sys.stderr)
+        console.setFormatter(ColorFormatter("%(message)s"))
+        handlers.append(console)
+    if json_path:
+        stream = logging.StreamHandler(sys.stdout) if json_path == "-" else logging.FileHandler(json_path, "a", "utf-8")
+        stream.setFormatter(JsonFormatter())
+        handlers.append(stream)
+    with listener_lock:
+        stop_logging()
+        records = queue.SimpleQueue()
+        for handler in list(LOGGER.handlers):
+            LOGGER.removeHandler(handler)
+        LOGGER.addHandler(logging.handlers.QueueHandler(records))
+        LOGGER.setLevel(level)
+        LOGGER.propagate = False
+        listener = logging.handlers.QueueListener(records, *handlers)
+        listener.start()
+
+
+def stop_logging():
+    """Write out the records still queued and stop the listener thread."""
+    global listener
+    if listener is not None:
+        listener.stop()
+        for handler in listener.handlers:
+            handler.close()
+        listener = None
+
+
+atexit.register(stop_logging)
+
+
+class NullProgressBar:
+    """Stands in for a tqdm progress bar in quiet runs, which then don't import tqdm."""
+
+    total = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return None
+
+    def update(self, n=1):
+        pass
+
+    def refresh(self):
+        pass
+
+    def set_postfix_str(self, text="", refresh=True):
+        pass
+
+
+def progress_bar(quiet=False, **kwargs):
+    """Return a tqdm progress bar made with kwargs, or a NullProgressBar if quiet is set."""
+    if quiet:
+        return NullProgressBar()
+    from tqdm import tqdm
+
+    return tqdm(**kwargs)
+
+
+def describe_metrics(started):
+    """Return one line summing up METRICS: sites and files by result, bytes, throughput and retries."""
+    totals = {}
+    downloaded = 0
+    for (name, labels), value in METRICS.snapshot().items():
+        if name == "response_bytes":
+            downloaded += value[-1]
+        elif name in ("files_total", "sites_total"):
+            key = (name, dict(labels).get("result"))
+            totals[key] = totals.get(key, 0) + value
+        elif name in ("retries_total", "throttled_total"):
+            totals[name] = totals.get(name, 0) + value
+    elapsed = max(time.monotonic() - started, 1e-9)
+    return (f"sites {totals.get(('sites_total', 'ok'), 0)} ok {totals.get(('sites_total', 'failed'), 0)} failed | "
+            f"files {totals.get(('files_total', 'ok'), 0)} ok {totals.get(('files_total', 'failed'), 0)} failed | "
+            f"{downloaded / 1e6:.1f} MB, {downloaded / 1e6 / elapsed:.2f} MB/s | "
+            f"retries {totals.get('retries_total', 0)}, throttled {totals.get('throttled_total', 0)}")
+
+
+class ProgressLine:
+    """Keeps one line on the terminal up to date with describe(), for quiet runs.
+
+    The line is redrawn in place every `interval` seconds from a background
+    thread; when the stream is not a terminal, a new line is written every
+    10 intervals instead. describe defaults to a summary of METRICS.
+    """
+
+    def __init__(self, describe=None, stream=None, interval=PROGRESS_INTERVAL):
+        started = time.monotonic()
+        self.describe = describe or (lambda: describe_metrics(started))
+        self.stream = stream or sys.stderr
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, name="progress-line", daemon=True)
+
+    def _run(self):
+        tty = self.stream.isatty()
+        ticks = 0
+        while not self.stopped.wait(self.interval):
+            ticks += 1
+            if tty:
+                self.stream.write("\r\033[K" + self.describe())
+                self.stream.flush()
+            elif ticks % 10 == 0:
+                self.stream.write(self.describe() + "\n")
+                self.stream.flush()
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stopped.set()
+        self.thread.join()
+        # The final state stays on the terminal
+        self.stream.write(("\r\033[K" if self.stream.isatty() else "") + self.describe() + "\n")
+        self.stream.flush()
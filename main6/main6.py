@@ -1,227 +1,794 @@
+import io
 import os
-import zipfile
+import codecs
+import functools
 import requests
-from urllib.parse import urlparse, urljoin
-from bs4 import BeautifulSoup
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import urlparse
+from concurrent.futures import Future, ThreadPoolExecutor, FIRST_COMPLETED, wait
 import time
 import shutil
-from tqdm import tqdm
-import pyfiglet
-from colorama import Fore, Back, Style, init
+import tempfile
+import threading
+from cache import DEFAULT_MAX_BYTES, HttpCache
+from blobstore import BlobStore, BlobWriter, start_url_hash
+from journal import CHECKPOINT_BYTES, PARTIAL_THRESHOLD, JobJournal
+from politeness import DEFAULT_PER_HOST, MAX_THROTTLED, THROTTLE_STATUSES, HostScheduler, Throttled, \
+    retry_after_seconds
+from retry import DEFAULT_RETRIES, RetryPolicy
+from segments import DEFAULT_SEGMENTS, SEGMENT_THRESHOLD, SegmentPolicy, download_segments
+from archive import ArchiveWriter, CompressionPolicy, FolderWriter, ParallelArchiveWriter, check_parallel_policy, \
+    new_buffer
+from crawler import DEFAULT_MAX_PAGES, Frontier, check_page_parser, extract_css_urls, is_stylesheet, normalize_url, \
+    new_page_parser, parse_page
+from rewrite import LocalPaths, rewrite_page, rewrite_stylesheet
+from transport import new_session
+from metrics import METRICS
+from logs import LOGGER, SUCCESS, progress_bar
+from tracing import bind, span, traceable
+import tracing
 
-# Initialize colorama
-init(autoreset=True)
+# Size of the pieces a download is written to disk in, so a worker never
+# holds more than one chunk of a response in memory
+CHUNK_SIZE = 64 * 1024
 
-# Global variables for scoring and level tracking
-score = 0
+# Where download_website() can save a site
+OUTPUTS = ("zip", "folder", "store")
+
+# Most threads a crawl uses; how many are busy is up to the adaptive per-host limits
+MAX_WORKERS = 256
+
+# Level reached so far, from the files downloaded in this process; score and file counts
+# for the menu are read from METRICS
 level = 1
-downloaded_files = 0
-failed_files = 0
+level_files = 0
+level_lock = threading.Lock()
 
 def update_score(success=True):
-    global score, downloaded_files, failed_files
+    """Count a finished page or resource, once per URL, in METRICS."""
+    global level_files
+    METRICS.inc("files_total", result="ok" if success else "failed")
     if success:
-        score += 10  # Each successful download adds 10 points
-        downloaded_files += 1
-    else:
-        failed_files += 1
-    # Level up after every 5 successful downloads
-    if downloaded_files // 5 >= level:
-        level_up()
+        # Level up after every 5 successful downloads
+        with level_lock:
+            level_files += 1
+            reached = 1 + level_files // 5
+        if reached > level:
+            level_up(reached)
 
-def level_up():
+def level_up(reached):
     global level
-    level += 1
-    print(Fore.GREEN + f"🎉 Congratulations! You've reached Level {level}! 🎉")
+    with level_lock:
+        if reached <= level:
+            return
+        level = reached
+    LOGGER.info("🎉 Congratulations! You've reached Level %d! 🎉", reached, extra=SUCCESS)
+
+def current_score():
+    """Return (score, downloaded files, failed files) from METRICS; every download is worth 10 points."""
+    downloaded = METRICS.value("files_total", result="ok")
+    return 10 * downloaded, downloaded, METRICS.value("files_total", result="failed")
 
-def get_unique_website_name(base_name="website"):
-    """Generate a unique name for the website folder/zip."""
+# Names handed out to downloads still running in this process
+reserved_names = set()
+reserved_names_lock = threading.Lock()
+
+def get_unique_website_name(base_name="website", store_dir=None):
+    """Generate a unique name for the website folder/zip (and blob store manifest)."""
     index = 1
-    while True:
-        website_folder = f"{base_name}_{index}"
-        if not os.path.exists(website_folder):
-            return website_folder
-        index += 1
+    with reserved_names_lock:
+        while True:
+            website_folder = f"{base_name}_{index}"
+            taken = website_folder in reserved_names
+            taken = taken or os.path.exists(website_folder) or os.path.exists(f"{website_folder}.zip")
+            if store_dir:
+                taken = taken or os.path.exists(os.path.join(store_dir, "manifests", f"{website_folder}.json"))
+            if not taken:
+                reserved_names.add(website_folder)
+                return website_folder
+            index += 1
+
+@traceable
+def download_website(url, zip_name="website.zip", max_depth=0, max_pages=DEFAULT_MAX_PAGES, same_origin=True,
+                     workers=None, engine="threads", max_in_flight=1000, limit_per_host=100, output="zip",
+                     compression="deflate", compress_level=6, archive_processes=0,
+                     cache_dir=None, cache_max_bytes=DEFAULT_MAX_BYTES, store_dir=".website_store", reuse_known=False,
+                     incremental=False, resumable=False, quiet=False, per_host=DEFAULT_PER_HOST, host_rate=None,
+                     robots=True, retries=DEFAULT_RETRIES, parser="stream", srcset="largest", rewrite_links=True,
+                     segments=DEFAULT_SEGMENTS, segment_threshold=SEGMENT_THRESHOLD, pool_size=None, dns_cache=True,
+                     http2=False):
+    """Download a page and its resources; with max_depth > 0 also crawl the pages it links to.
+
+    Pages are saved with the folder structure of their URLs (see
+    rewrite.LocalPaths), together with their stylesheets, scripts, images,
+    icons, media and the url()s found in stylesheets.
+
+    Crawling:
+        max_depth, max_pages: how many links deep to follow and how many pages at most
+            (DEFAULT_MAX_PAGES, the start page included).
+        same_origin: only follow links to the start URL's host.
+        parser: "stream" (standard library), "lxml" or "bs4".
+        srcset: which srcset candidate to download: "largest", "smallest", "all" or "none".
+        rewrite_links: point references at the local copies, so the archive browses offline.
 
-def download_website(url, zip_name="website.zip"):
-    global score, level, downloaded_files, failed_files
+    Fetching:
+        engine: "threads" (a thread pool, see crawl()) or "async" (aiohttp, see aiocrawl.crawl_async()).
+            The async engine only limits connections; per_host, host_rate, robots and
+            segments are threads-only, and host_rate raises ValueError with it.
+        workers: requests in flight with the threads engine (MAX_WORKERS if None).
+        max_in_flight, limit_per_host: requests in flight and per host with the async engine.
+        per_host: upper bound of each host's adaptive (AIMD) request limit.
+        host_rate: requests per second to each host, if set.
+        robots: honour the Crawl-delay of each host's robots.txt.
+        retries: attempts after a network error (see retry.RetryPolicy).
+        segments, segment_threshold: fetch files this big as parallel byte ranges
+            (see segments.SegmentPolicy; segments=1 turns it off).
+        pool_size: connections kept open per host (per_host plus segments if None).
+        dns_cache, http2: reuse DNS lookups; send https:// requests over HTTP/2
+            (needs httpx[http2], see transport.new_session()).
 
-    # Graffiti-like header for the download
-    print(Fore.YELLOW + pyfiglet.figlet_format("Downloading Website", font="slant"))
-    print(Fore.CYAN + f"Attempting to download: {url}")
+    Output:
+        output: "zip" (written as files complete), "folder", or "store" for the
+            shared content-addressed BlobStore at store_dir (see export_website()).
+        compression, compress_level, archive_processes: how ZIP entries are
+            compressed (see archive.CompressionPolicy) and in how many processes.
+        reuse_known: don't fetch URLs whose last body is already in the store.
+        incremental: implies output="store"; revalidates the site's latest
+            snapshot so only new or changed resources are fetched.
+        cache_dir, cache_max_bytes: on-disk HTTP cache for resources.
+        resumable: journal the job in website_<domain>_<hash>.journal, so calling
+            this again for the same URL after a crash or Ctrl-C continues it.
+            ZIP output is then staged in a blob store and exported at the end.
+        quiet: no progress bar. Progress and errors go to LOGGER (see logs.setup_logging()).
+        trace, profile: write <name>.trace.json and <name>.pstats (see tracing.traceable()).
+
+    Returns a summary dict: url, name, saved_as, ok, downloaded, failed,
+    seconds and error.
+    """
+    # Bad arguments are reported before anything is opened or fetched
+    if engine == "async" and host_rate is not None:
+        raise ValueError('host_rate needs engine="threads", the async engine is not throttled per host')
+    if output not in OUTPUTS:
+        raise ValueError(f"Unknown output {output!r}, use one of {', '.join(OUTPUTS)}")
+    policy = CompressionPolicy(compression, compress_level)
+    if archive_processes and output == "zip" and not (resumable or incremental):
+        check_parallel_policy(policy)
+    check_page_parser(parser, srcset)
+    started = time.perf_counter()
+    summary = {"url": url, "name": None, "saved_as": None, "ok": False, "downloaded": 0, "failed": 0,
+               "seconds": 0.0, "error": None}
+
+    LOGGER.info("Attempting to download: %s", url, extra={"url": url})
 
     # Parse the URL to get the base URL
     parsed_url = urlparse(url)
     domain = parsed_url.netloc
     if not domain:
-        print(Fore.RED + "Invalid URL")
-        return
+        LOGGER.error("Invalid URL: %s", url, extra={"url": url})
+        summary["error"] = "Invalid URL"
+        METRICS.inc("sites_total", result="failed")
+        return summary
 
-    # Get a unique folder name for the website
-    folder_name = get_unique_website_name(f"website_{domain.replace('.', '_')}")
-    print(Fore.CYAN + f"Saving website as: {folder_name}")
+    if incremental:
+        output = "store"
 
-    # Create the base folder and subfolders
-    os.makedirs(folder_name)
-    os.makedirs(os.path.join(folder_name, "html"), exist_ok=True)
-    os.makedirs(os.path.join(folder_name, "css"), exist_ok=True)
-    os.makedirs(os.path.join(folder_name, "js"), exist_ok=True)
-    os.makedirs(os.path.join(folder_name, "images"), exist_ok=True)
+    # Pick up an interrupted job for the same URL, if there is one
+    journal = None
+    resuming = False
+    folder_name = None
+    session = None
+    store = None
+    writer = None
+    writer_open = False
+    cache = None
+    # Whatever happens, Ctrl-C included, the journal is flushed and closed and
+    # the session and the reserved name are released, so the job can resume
+    try:
+        if resumable:
+            # One journal per start URL, so jobs for different pages of a site don't mix
+            url_hash = start_url_hash(url)[:8]
+            journal = JobJournal(f"website_{domain.replace('.', '_')}_{url_hash}.journal")
+            info = journal.info()
+            if info and info["url"] == url and info["output"] == output:
+                folder_name = info["folder"]
+                resuming = True
+                LOGGER.info("Resuming interrupted download: %s", folder_name, extra={"url": url})
 
-    # Use requests session to reuse connections
-    session = requests.Session()
+        if not resuming:
+            # Get a unique folder name for the website
+            # Snapshots in the store count for every output, export_website() writes <name>.zip for them
+            folder_name = get_unique_website_name(f"website_{domain.replace('.', '_')}", store_dir)
+            if journal:
+                journal.start({"url": url, "folder": folder_name, "output": output})
+        LOGGER.info("Saving website as: %s", folder_name, extra={"url": url})
+        summary["name"] = folder_name
 
-    # Download the main HTML page
-    try:
-        response = session.get(url)
-        if response.status_code == 200:
-            html_path = os.path.join(folder_name, "html", "index.html")
-            with open(html_path, "w", encoding="utf-8") as file:
-                file.write(response.text)
-            print(Fore.GREEN + f"Main page downloaded: {url}")
-            update_score(True)
-        else:
-            print(Fore.RED + f"Failed to download the website. Status code: {response.status_code}")
+        # Download the main HTML page
+        try:
+            # One session for the whole job, so connections are reused
+            session = new_session(pool_size or per_host + segments, dns_cache=dns_cache, http2=http2)
+            session.hooks["response"].extend([METRICS.response_hook, tracing.response_hook])
+            with span("main page", "fetch", url=url) as info:
+                response = session.get(url, timeout=10)
+                info["bytes"] = len(response.content)
+            if response.status_code == 200:
+                LOGGER.info("Main page downloaded: %s", url, extra={"url": url, "success": True})
+                METRICS.record_body(url, response.headers.get("Content-Type"), len(response.content))
+                update_score(True)
+            else:
+                LOGGER.error("Failed to download the website. Status code: %s", response.status_code,
+                             extra={"url": url, "status": response.status_code})
+                update_score(False)
+                METRICS.inc("sites_total", result="failed")
+                summary["error"] = f"Status code {response.status_code}"
+                summary["seconds"] = time.perf_counter() - started
+                return summary
+        except Exception as e:
+            LOGGER.error("Error downloading the website: %s", e, extra={"url": url})
             update_score(False)
-            return
-    except Exception as e:
-        print(Fore.RED + f"Error downloading the website: {e}")
-        update_score(False)
-        return
+            METRICS.inc("sites_total", result="failed")
+            summary["error"] = str(e)
+            summary["seconds"] = time.perf_counter() - started
+            return summary
+
+        # Downloads are written straight into the ZIP as they complete, or into a
+        # plain folder or the shared blob store. A resumable ZIP download needs its
+        # files to survive a crash, so it is staged in a blob store of its own.
+        if cache_dir:
+            cache = HttpCache(cache_dir, cache_max_bytes)
+        if output == "folder":
+            writer = FolderWriter(folder_name)
+            saved_as = folder_name
+        elif output == "store" or journal:
+            store = BlobStore(store_dir if output == "store" else f"{folder_name}.staging")
+            previous = None
+            if incremental:
+                base_name = store.latest_manifest(url)
+                if base_name:
+                    LOGGER.info("Updating snapshot: %s", base_name, extra={"url": url})
+                    previous = store.read_manifest(base_name)
+            writer = BlobWriter(store, folder_name, url, reuse_known, previous, journal, cache)
+            if resuming:
+                writer.restore(journal.entries())
+            # The blob store revalidates against the previous snapshot, then the HTTP cache
+            cache = writer.cache
+            saved_as = store.manifest_path(folder_name) if output == "store" else f"{folder_name}.zip"
+        else:
+            saved_as = f"{folder_name}.zip"
+            if archive_processes:
+                writer = ParallelArchiveWriter(saved_as, policy, archive_processes)
+            else:
+                writer = ArchiveWriter(saved_as, policy)
+        writer_open = True
+
+        # Parse HTML and download linked resources (CSS, JS, images), following
+        # <a href> links to other pages when crawling is enabled
+        try:
+            with span("parse", url=url):
+                links, resources = parse_page(response.text, url, parser, srcset)
+            frontier = Frontier(url, max_depth=max_depth, max_pages=max_pages, same_origin=same_origin,
+                                journal=journal)
+            paths = LocalPaths(url, rewrite_links)
+            if resuming:
+                frontier.restore(journal.known_pages(), journal.unfinished("page"))
+                for page_url in journal.known_pages():
+                    paths.page(page_url)
+                resources += [link for link, _ in journal.unfinished("resource")]
+            if max_depth > 0:
+                for link in links:
+                    if frontier.add(link, 1):
+                        paths.page(link)
+            # Saved once its links are known, so they can point at the pages that will be crawled
+            save_page(io.BytesIO(response.content), response.encoding, url, writer, paths, resources)
+            if engine == "async":
+                # Imported here, so runs with the thread pool never load asyncio
+                from aiocrawl import crawl_async
+                counts = crawl_async(frontier, resources, writer, max_in_flight, limit_per_host, cache, journal,
+                                     quiet, parser, srcset, paths, dns_cache, RetryPolicy(retries))
+            else:
+                hosts = HostScheduler(per_host, host_rate, robots, session.headers.get("User-Agent", "*"))
+                counts = crawl(session, frontier, resources, writer, workers, cache, journal, quiet, hosts,
+                               RetryPolicy(retries), parser, srcset, paths, SegmentPolicy(segments, segment_threshold))
+            summary["downloaded"], summary["failed"] = counts
+        except Exception as e:
+            LOGGER.error("Error parsing HTML and downloading resources: %s", e, extra={"url": url})
+            summary["error"] = str(e)
+
+        try:
+            writer_open = False
+            with span("close archive", "disk"):
+                writer.close()
+            stats = writer.stats
+            if journal and output == "zip":
+                # The blob writer only stages files; the archive is compressed here
+                with span("export", "disk"):
+                    stats = store.export_zip(folder_name, saved_as, policy)
+            LOGGER.info("Website saved in %s", saved_as, extra={"url": url, "saved_as": saved_as, "success": True})
+            show_compression_report(stats)
+            summary["saved_as"] = saved_as
+            summary["ok"] = summary["error"] is None
+            if journal and summary["ok"]:
+                # The job is complete, nothing is left to resume
+                journal.close(remove=True)
+                journal = None
+                if output == "zip":
+                    store.close()
+                    store = None
+                    with span("cleanup", "disk"):
+                        shutil.rmtree(f"{folder_name}.staging")
+        except Exception as e:
+            LOGGER.error("Error saving %s: %s", saved_as, e, extra={"url": url})
+            summary["error"] = str(e)
+            summary["ok"] = False
+    finally:
+        if writer_open:
+            # Interrupted while downloading; a journaled job keeps what it stored
+            writer.abort()
+        if cache:
+            cache.close()
+        if store:
+            store.close()
+        if journal:
+            journal.close()
+        if session:
+            session.close()
+        if folder_name:
+            with reserved_names_lock:
+                reserved_names.discard(folder_name)
+    METRICS.inc("sites_total", result="ok" if summary["ok"] else "failed")
+    summary["seconds"] = time.perf_counter() - started
+    return summary
+
+def export_website(name, zip_path=None, store_dir=".website_store", compression="deflate", compress_level=6,
+                   delta=False):
+    """Build the ZIP archive of a website downloaded with output="store".
 
-    # Parse HTML and download linked resources (CSS, JS, images)
+    delta=True only exports what changed since the snapshot it was based on.
+    """
+    store = BlobStore(store_dir)
     try:
-        soup = BeautifulSoup(response.text, 'html.parser')
-
-        # Extract resource URLs (CSS, JS, images)
-        css_links = [urljoin(url, link.get("href")) for link in soup.find_all("link", {"rel": "stylesheet"})]
-        js_links = [urljoin(url, script.get("src")) for script in soup.find_all("script", {"src": True})]
-        img_links = [urljoin(url, img.get("src")) for img in soup.find_all("img", {"src": True})]
-
-        # Combine all URLs to download
-        all_links = css_links + js_links + img_links
-
-        # Use ThreadPoolExecutor to download resources concurrently with a progress bar
-        with ThreadPoolExecutor(max_workers=10) as executor:
-            futures = {executor.submit(download_file, session, link, folder_name): link for link in all_links}
-            with tqdm(total=len(futures), desc="Downloading resources", unit="file", ncols=100) as pbar:
-                for future in as_completed(futures):
-                    url = futures[future]
+        zip_path = zip_path or (f"{name}.delta.zip" if delta else f"{name}.zip")
+        stats = store.export_zip(name, zip_path, CompressionPolicy(compression, compress_level), delta)
+        LOGGER.info("Website exported to %s", zip_path, extra=SUCCESS)
+        show_compression_report(stats)
+    finally:
+        store.close()
+
+def show_compression_report(stats):
+    """Log bytes in vs bytes out and the time spent compressing each kind of file."""
+    for kind, entry in sorted(stats.items()):
+        ratio = entry["bytes_out"] / entry["bytes_in"] * 100 if entry["bytes_in"] else 100
+        LOGGER.info("  %-6s %5d files  %12s -> %12s bytes (%.0f%%)  %.2fs", kind, entry["files"],
+                    f"{entry['bytes_in']:,}", f"{entry['bytes_out']:,}", ratio, entry["seconds"],
+                    extra={"kind": kind, "files": entry["files"], "bytes_in": entry["bytes_in"],
+                           "bytes_out": entry["bytes_out"]})
+
+def crawl(session, frontier, resources, writer, workers=None, cache=None, journal=None, quiet=False, hosts=None,
+          retry=None, parser="stream", srcset="largest", paths=None, segments=None):
+    """Download resources and crawl queued pages in one shared worker pool.
+
+    Pages fetched by the pool hand their links to the frontier and their
+    resources back to the pool, so pages and assets download side by side;
+    resources are queued while their page is still being parsed, and the
+    URLs found in downloaded stylesheets are queued the same way.
+    Work waits in the per-host queues of `hosts` (a HostScheduler) until its
+    host may be contacted, and URLs throttled with a 429/503 are queued again.
+    URLs failing with a network error are put back with a delay chosen by
+    `retry` (a RetryPolicy), so no worker sleeps while they wait; the
+    failures also feed each host's circuit breaker. How many requests run
+    against a host adapts to its latency and errors, up to `workers` overall;
+    the progress bar shows the current limits.
+    With a journal, every URL is recorded as queued and then done or failed,
+    and resources already completed by an interrupted run are skipped.
+    Files are saved under the paths given by `paths` (a rewrite.LocalPaths),
+    big ones fetched in parallel byte ranges as `segments` (a
+    segments.SegmentPolicy) allows.
+    Returns the number of (downloaded, failed) pages and resources.
+    """
+    if paths is None:
+        paths = LocalPaths(frontier.start_url)
+    if hosts is None:
+        hosts = HostScheduler(robots=False)
+    if retry is None:
+        retry = RetryPolicy()
+    seen_resources = {normalize_url(url) for url in journal.done_urls()} if journal else set()
+    pending = {}
+    throttled = {}
+    attempts = {}
+    counts = [0, 0]
+    workers = workers or MAX_WORKERS
+    # Page workers queue resources too, as soon as they find them, and complete
+    # the wakeup future so the loop starts them instead of waiting for a download
+    queue_lock = threading.Lock()
+    wakeup = [Future()]
+
+    # Set when the crawl is interrupted, so its downloads still running stop at their next
+    # chunk instead of finishing (their progress is in the journal); one per crawl, as batch
+    # runs crawl several sites at once
+    cancelled = threading.Event()
+    # Threads are only started when there is work for them, so idle capacity costs nothing
+    # Named threads, so py-spy and the trace show which are downloading
+    executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="download")
+    # The workers trace into the same run as this thread
+    run_task = bind(hosts.run)
+    session.hooks["response"].append(hosts.observe)
+    try:
+        with progress_bar(quiet, total=0, desc="Downloading resources", unit="file", ncols=100) as pbar:
+            def queue_resources(links, refresh=True):
+                with queue_lock:
+                    for link in links:
+                        key = normalize_url(link)
+                        if key in seen_resources:
+                            continue
+                        seen_resources.add(key)
+                        if journal:
+                            journal.queue(key, "resource")
+                        hosts.push(link, None)
+                        pbar.total += 1
+                    if not wakeup[0].done():
+                        wakeup[0].set_result(None)
+                if refresh:
+                    pbar.refresh()
+
+            def found_resource(link):
+                queue_resources([link], refresh=False)
+
+            def found_links(links, depth):
+                # Called by the page's worker before it saves the page, which then links to the accepted ones
+                for link in links:
+                    if frontier.add(link, depth + 1):
+                        paths.page(link)
+
+            def queue_pages():
+                # Keep only a bounded number of pages queued, the rest wait in the frontier
+                while len(pending) + len(hosts) < workers * 2:
+                    item = frontier.pop()
+                    if item is None:
+                        break
+                    page_url, depth = item
+                    hosts.push(page_url, depth)
+                    pbar.total += 1
+                pbar.refresh()
+
+            def start_ready():
+                # Only as many as there are free workers, so no host slot is held by a queued task
+                for url, depth in hosts.pop_ready(workers - len(pending)):
+                    retry.record_request()
+                    if depth is None:
+                        future = executor.submit(run_task, session, url, download_file, session, url, writer,
+                                                 cache, journal, attempts.get(url, 0), found_resource, paths,
+                                                 segments, cancelled)
+                    else:
+                        future = executor.submit(run_task, session, url, download_page, session, url, writer,
+                                                 parser, found_resource, srcset, paths,
+                                                 functools.partial(found_links, depth=depth), cancelled)
+                    pending[future] = (url, depth)
+
+            queue_resources(resources)
+            queue_pages()
+            start_ready()
+            while pending or len(hosts):
+                if pending:
+                    # With every worker busy, queued work can't start before one of them finishes
+                    if len(pending) < workers:
+                        waiting = [*pending, wakeup[0]]
+                        timeout = hosts.next_delay()
+                    else:
+                        waiting = pending
+                        timeout = None
+                    done, _ = wait(waiting, timeout=timeout, return_when=FIRST_COMPLETED)
+                    # Rearmed before start_ready(), which picks up everything queued until now
+                    with queue_lock:
+                        if wakeup[0].done():
+                            wakeup[0] = Future()
+                    done = [future for future in done if future in pending]
+                else:
+                    # Everything left is waiting for a retry or its host's rate budget
+                    time.sleep(hosts.next_delay() or 0.1)
+                    done = ()
+                for future in done:
+                    url, depth = pending.pop(future)
+                    ok = False
                     try:
-                        future.result()  # Wait for the result and handle exceptions if any
-                        update_score(True)
+                        result = future.result()  # Wait for the result and handle exceptions if any
+                        ok = result is not False
+                        hosts.success(url)
+                        update_score(ok)
+                        if depth is not None and result is not None:
+                            _, page_resources = result
+                            queue_resources(page_resources)
+                    except Throttled as e:
+                        hosts.throttle(url, e.retry_after)
+                        throttled[url] = throttled.get(url, 0) + 1
+                        if throttled[url] <= MAX_THROTTLED:
+                            METRICS.inc("throttled_total", host=urlparse(url).netloc.lower())
+                            LOGGER.warning("Throttled, trying again later: %s", url, extra={"url": url})
+                            hosts.push(url, depth)
+                            continue
+                        LOGGER.error("Error downloading %s: %s", url, e, extra={"url": url})
+                        update_score(False)
+                    except requests.HTTPError as e:
+                        # The host answered, an error status is not worth retrying
+                        LOGGER.error("Error downloading %s: %s", url, e, extra={"url": url})
+                        update_score(False)
+                    except requests.RequestException as e:
+                        hosts.failure(url)
+                        delay = retry.next_delay(attempts.get(url, 0))
+                        if delay is not None:
+                            attempts[url] = attempts.get(url, 0) + 1
+                            METRICS.inc("retries_total", host=urlparse(url).netloc.lower())
+                            LOGGER.warning("Retrying %s in %.1fs... Attempt %d failed: %s", url, delay,
+                                           attempts[url], e, extra={"url": url, "attempt": attempts[url]})
+                            hosts.push(url, depth, delay)
+                            continue
+                        LOGGER.error("Failed to download after %d attempts: %s", attempts.get(url, 0) + 1, url,
+                                     extra={"url": url})
+                        update_score(False)
                     except Exception as e:
-                        print(Fore.RED + f"Error downloading {url}: {e}")
+                        LOGGER.error("Error downloading %s: %s", url, e, extra={"url": url})
                         update_score(False)
+                    if journal:
+                        # Only after the page's links are queued, so none are lost on a crash
+                        journal.finish(normalize_url(url), ok)
+                    counts[0 if ok else 1] += 1
                     pbar.update(1)
-    except Exception as e:
-        print(Fore.RED + f"Error parsing HTML and downloading resources: {e}")
-        update_score(False)
+                queue_pages()
+                start_ready()
+                pbar.set_postfix_str(format_limits(hosts), refresh=False)
+    except BaseException:
+        # On Ctrl-C don't wait for every queued download, the journal has them
+        cancelled.set()
+        executor.shutdown(wait=False, cancel_futures=True)
+        raise
+    finally:
+        session.hooks["response"].remove(hosts.observe)
+    executor.shutdown()
+    return tuple(counts)
+
+def format_limits(hosts, shown=2):
+    """Describe the running requests / concurrency limit of the busiest hosts, e.g. "cdn.com 12/16"."""
+    busiest = sorted(hosts.limits().items(), key=lambda item: item[1][0], reverse=True)[:shown]
+    return " ".join(f"{host} {active}/{limit}" for host, (active, limit) in busiest)
+
+def download_page(session, url, writer, parser="stream", on_resource=None, srcset="largest", paths=None,
+                  on_links=None, cancelled=None):
+    """Download a crawled page; return its (links, resources), or None if it is not HTML.
+
+    The page is parsed while it downloads, chunk by chunk, and on_resource is
+    called with each resource URL as soon as the parser finds it. on_links is
+    called with the page's links before the page is saved (see save_page()).
+    The download stops once the `cancelled` event is set.
+    """
+    if paths is None:
+        paths = LocalPaths(url)
+    with span("download page", "fetch", url=url), session.get(url, timeout=10, stream=True) as response:
+        if response.status_code in THROTTLE_STATUSES:
+            raise Throttled(url, retry_after_seconds(response.headers.get("Retry-After")))
+        response.raise_for_status()
+        if "html" not in response.headers.get("Content-Type", "text/html"):
+            # Linked documents such as PDFs are kept like any other resource
+            save_response(response, writer, paths.page(url), url=url, on_resource=on_resource, paths=paths,
+                          cancelled=cancelled)
+            LOGGER.debug("Downloaded: %s", url, extra={"url": url})
+            return None
+        page = new_page_parser(parser, url, on_resource, srcset)
+        decoder = text_decoder(response.encoding)
+        body = new_buffer()
+        try:
+            for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                if cancelled is not None and cancelled.is_set():
+                    raise RuntimeError(f"Download of {url} cancelled")
+                body.write(chunk)
+                page.feed(decoder.decode(chunk))
+            page.feed(decoder.decode(b"", final=True))
+            links, resources = page.close()
+            METRICS.record_body(url, response.headers.get("Content-Type"), body.tell())
+            if on_links:
+                on_links(links)
+            save_page(body, response.encoding, url, writer, paths, resources)
+        except BaseException:
+            body.close()
+            raise
 
-    # Zip the folder into a .zip file with correct folder structure
+    LOGGER.debug("Page downloaded: %s", url, extra={"url": url})
+    return links, resources
+
+def save_page(body, encoding, url, writer, paths, resources):
+    """Hand a downloaded page to the writer under its local path.
+
+    Its resources are given paths first, so that with paths.rewrite its
+    references can be rewritten to them as the page is copied (see
+    rewrite.rewrite_page()); links to pages not given a path by then become
+    absolute URLs.
+    """
+    with span("save page", url=url):
+        arcname = paths.page(url)
+        for resource in resources:
+            paths.resource(resource)
+        if paths.rewrite:
+            body = rewrite_page(body, encoding, url, arcname, paths)
+        writer.add(arcname, body, "text/html", url)
+
+def text_decoder(encoding):
+    """Return an incremental decoder for a response's encoding, UTF-8 if it has none or an unknown one."""
     try:
-        zip_path = f"{folder_name}.zip"
-        with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
-            for root, dirs, files in os.walk(folder_name):
-                for file in files:
-                    # Preserve the folder structure when adding to zip
-                    file_path = os.path.join(root, file)
-                    # Get the relative path to add to the zip file
-                    arcname = os.path.relpath(file_path, folder_name)
-                    zipf.write(file_path, arcname=arcname)
-        print(Fore.GREEN + f"Website saved in {zip_path}")
-        update_score(True)
-    except Exception as e:
-        print(Fore.RED + f"Error creating ZIP file: {e}")
-        update_score(False)
-
-    # Optionally, remove the downloaded files after zipping
+        return codecs.getincrementaldecoder(encoding or "utf-8")(errors="replace")
+    except LookupError:
+        return codecs.getincrementaldecoder("utf-8")(errors="replace")
+
+def download_file(session, url, writer, cache=None, journal=None, attempt=0, on_resource=None, paths=None,
+                  segments=None, cancelled=None):
+    """Download a file and hand it to the archive writer under its path in `paths`; return True on success.
+
+    If it is a stylesheet, on_resource is called with each URL it references.
+    With a cache, the request is conditional and a 304 reuses the cached body,
+    except on retries (attempt > 0), as the cached copy may be what failed.
+    With a journal, a download interrupted earlier is continued with a Range request.
+    A big file is fetched as parallel byte ranges if `segments` (a SegmentPolicy) says so.
+    The download stops once the `cancelled` event is set.
+    Network errors are raised, for the crawl loop to schedule a retry.
+    """
+    if paths is None:
+        paths = LocalPaths(url)
+    arcname = paths.resource(url)
+    # Stylesheets are fetched (or revalidated) anyway, their references are needed
+    reusable = not (on_resource and is_stylesheet(url))
+    if reusable and writer.reuse(arcname, url):
+        LOGGER.debug("Reused from store: %s", url, extra={"url": url})
+        return True
+    headers = cache.conditional_headers(url) if cache and not attempt else {}
+    offset, range_headers = resume_headers(journal, url)
+    headers = range_headers or headers
+    with span("download file", "fetch", url=url), \
+            session.get(url, timeout=10, stream=True, headers=headers) as response:
+        if response.status_code == 304 and cache:
+            if not save_cached(cache, url, writer, arcname, on_resource, paths):
+                raise requests.RequestException(f"Cached copy of {url} is gone")
+            LOGGER.debug("Not modified (cached): %s", url, extra={"url": url})
+            return True
+        elif response.status_code in (200, 206):
+            ranges = segments.ranges(response, resume_validator(response.headers)) if segments else None
+            if ranges:
+                save_segmented(session, response, ranges, writer, arcname, cache, url, journal, on_resource, paths,
+                               cancelled)
+            else:
+                save_response(response, writer, arcname, cache, url, journal, offset, on_resource, paths, cancelled)
+            LOGGER.debug("Downloaded%s: %s", " (retry)" if attempt else "", url, extra={"url": url})
+            return True
+        elif response.status_code in THROTTLE_STATUSES:
+            raise Throttled(url, retry_after_seconds(response.headers.get("Retry-After")))
+        else:
+            LOGGER.error("Failed to download: %s - Status code: %s", url, response.status_code,
+                         extra={"url": url, "status": response.status_code})
+            return False
+
+def resume_headers(journal, url):
+    """Return (offset, headers) to continue an interrupted download of url, or (0, None)."""
+    if journal is None:
+        return 0, None
+    offset, validator = journal.partial(url)
+    if not offset:
+        return 0, None
+    # If-Range makes the server send the whole body again if it changed meanwhile
+    return offset, {"Range": f"bytes={offset}-", "If-Range": validator}
+
+def resume_validator(headers):
+    """Return the validator an interrupted download can be resumed with, if any."""
+    etag = headers.get("ETag")
+    # Weak ETags can't be used with If-Range
+    if etag and not etag.startswith("W/"):
+        return etag
+    return headers.get("Last-Modified")
+
+def save_response(response, writer, arcname, cache=None, url=None, journal=None, offset=0, on_resource=None,
+                  paths=None, cancelled=None):
+    """Stream a response body in CHUNK_SIZE pieces into a buffer and hand it to the writer.
+
+    Small bodies stay in memory and big ones spill to a temporary file, so a
+    worker never holds more than SPOOL_SIZE of a response in memory. With a
+    cache, the body is also stored under url for later revalidation. With a
+    journal, big bodies go to a partial file whose progress is checkpointed,
+    and a 206 response continues that file from offset. The references of a
+    stylesheet are reported to on_resource and rewritten (see handle_stylesheet()).
+    Setting the `cancelled` event stops it at the next chunk.
+    """
+    if response.status_code == 206:
+        if not response.headers.get("Content-Range", "").startswith(f"bytes {offset}-"):
+            raise requests.RequestException(f"Unexpected Content-Range for {url}")
+    else:
+        offset = 0
+    validator = resume_validator(response.headers) if journal else None
+    size = offset + int(response.headers.get("Content-Length") or 0)
+    partial = validator is not None and size > PARTIAL_THRESHOLD
+    body = journal.open_partial(url, offset) if partial else new_buffer()
+    written = start = offset
     try:
-        time.sleep(1)  # Give some time before cleanup to avoid directory not empty error
-        shutil.rmtree(folder_name)  # More robust way to remove a directory and its contents
-        print(Fore.YELLOW + f"Cleaned up folder: {folder_name}")
-    except Exception as e:
-        print(Fore.RED + f"Error cleaning up the folder: {e}")
-
-def download_file(session, url, folder):
-    """Download a file and save it in the specified folder with retries."""
+        with span("body", "network", url=url) as info:
+            for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                if cancelled is not None and cancelled.is_set():
+                    raise RuntimeError(f"Download of {url} cancelled")
+                body.write(chunk)
+                written += len(chunk)
+                if partial and written - offset >= CHECKPOINT_BYTES:
+                    body.flush()
+                    journal.checkpoint(url, written, validator)
+                    offset = written
+            info["bytes"] = written - start
+        METRICS.record_body(url or response.url, response.headers.get("Content-Type"), written - start)
+        if cache:
+            cache.store(url, body, response.headers)
+        body = handle_stylesheet(body, url, arcname, response.headers.get("Content-Type"), on_resource, paths)
+    except BaseException:
+        body.close()
+        raise
+    writer.add(arcname, body, response.headers.get("Content-Type"), url)
+    if partial:
+        journal.drop_partial(url)
+
+def save_segmented(session, response, ranges, writer, arcname, cache=None, url=None, journal=None, on_resource=None,
+                   paths=None, cancelled=None):
+    """Like save_response(), but the body is fetched as parallel byte ranges (see segments.download_segments()).
+
+    The ranges are written into a preallocated temporary file. With a journal,
+    a partial file is used instead, checkpointed as far as it is complete from
+    its start, so an interrupted download continues from there.
+    """
+    validator = resume_validator(response.headers)
+    partial = journal is not None and ranges[-1][1] + 1 > PARTIAL_THRESHOLD
+    body = journal.open_partial(url, 0) if partial else tempfile.TemporaryFile()
     try:
-        response = session.get(url, timeout=10)
-        if response.status_code == 200:
-            filename = os.path.basename(urlparse(url).path)
-            if filename:
-                file_path = os.path.join(folder, filename)
-                with open(file_path, 'wb') as file:
-                    file.write(response.content)
-                print(Fore.GREEN + f"Downloaded: {url}")
-            update_score(True)
-        else:
-            print(Fore.RED + f"Failed to download: {url} - Status code: {response.status_code}")
-            update_score(False)
-    except requests.RequestException as e:
-        print(Fore.RED + f"Error downloading {url}: {e}")
-        # Retry mechanism for intermittent issues
-        retry_download(session, url, folder)
-
-def retry_download(session, url, folder, retries=3, delay=2):
-    """Retry downloading with exponential backoff."""
-    for attempt in range(retries):
-        try:
-            response = session.get(url, timeout=10)
-            if response.status_code == 200:
-                filename = os.path.basename(urlparse(url).path)
-                if filename:
-                    file_path = os.path.join(folder, filename)
-                    with open(file_path, 'wb') as file:
-                        file.write(response.content)
-                    print(Fore.GREEN + f"Downloaded (retry): {url}")
-                update_score(True)
-                return
-        except requests.RequestException as e:
-            print(Fore.YELLOW + f"Retrying {url}... Attempt {attempt + 1} failed: {e}")
-            time.sleep(delay * (2 ** attempt))  # Exponential backoff
-    print(Fore.RED + f"Failed to download after {retries} attempts: {url}")
-    update_score(False)
-
-def show_menu():
-    print(Fore.MAGENTA + pyfiglet.figlet_format("Website Downloader", font="slant"))
-    print(Fore.YELLOW + f"Level {level} | Score: {score}")
-    print(Fore.YELLOW + f"Successfully Downloaded Files: {downloaded_files} | Failed Files: {failed_files}")
-    print(Fore.CYAN + "1. Download Website")
-    print(Fore.CYAN + "2. Exit")
-    print(Fore.CYAN + "3. List Downloaded Websites")
-    print(Fore.CYAN + "4. Help")
-
-def list_downloaded_websites():
-    print(Fore.GREEN + "\n=== Downloaded Websites ===")
-    # List folders that are named after websites
-    for folder in os.listdir():
-        if os.path.isdir(folder) and folder.startswith("website_"):
-            print(Fore.BLUE + folder)
-
-def main():
-    while True:
-        show_menu()
-        choice = input(Fore.CYAN + "Enter your choice (1/2/3/4): ")
-
-        if choice == "1":
-            url = input(Fore.CYAN + "Enter the website URL: ")
-            download_website(url)
-        elif choice == "2":
-            print(Fore.RED + "Exiting the program...")
-            break
-        elif choice == "3":
-            list_downloaded_websites()
-        elif choice == "4":
-            print(Fore.GREEN + "Help: This program allows you to download a website's HTML, CSS, JS, and images.")
-            print(Fore.GREEN + "1. Download Website: Input a URL and the website will be downloaded as a .zip file.")
-            print(Fore.GREEN + "2. Exit: Exit the program.")
-            print(Fore.GREEN + "3. List Downloaded Websites: List all downloaded websites by their folder name.")
-            print(Fore.GREEN + "4. Help: Displays this help message.")
-        else:
-            print(Fore.RED + "Invalid choice. Please try again.")
+        checkpoint = None
+        if partial:
+            def checkpoint(complete):
+                journal.checkpoint(url, complete, validator)
+        with span("segments", "network", url=url, ranges=len(ranges), bytes=ranges[-1][1] + 1):
+            download_segments(session, url, response, body, ranges, validator, CHUNK_SIZE, cancelled, checkpoint,
+                              CHECKPOINT_BYTES)
+        METRICS.record_body(url, response.headers.get("Content-Type"), ranges[-1][1] + 1)
+        if cache:
+            cache.store(url, body, response.headers)
+        body = handle_stylesheet(body, url, arcname, response.headers.get("Content-Type"), on_resource, paths)
+    except BaseException:
+        body.close()
+        raise
+    writer.add(arcname, body, response.headers.get("Content-Type"), url)
+    if partial:
+        journal.drop_partial(url)
+
+def save_cached(cache, url, writer, arcname, on_resource=None, paths=None):
+    """Hand the cached body of url to the writer after a 304 Not Modified.
+
+    Returns False if the entry was evicted since the conditional request was sent.
+    """
+    body, content_type = cache.open(url)
+    if body is None:
+        return False
+    try:
+        body = handle_stylesheet(body, url, arcname, content_type, on_resource, paths)
+    except BaseException:
+        body.close()
+        raise
+    writer.add(arcname, body, content_type, url)
+    return True
+
+def handle_stylesheet(body, url, arcname, content_type, on_resource=None, paths=None):
+    """If body is a stylesheet, call on_resource with each URL it references and rewrite them.
+
+    Returns the body to store: with paths.rewrite a new buffer whose
+    references point at the local copies (the caches keep the original).
+    """
+    if not is_stylesheet(url, content_type):
+        return body
+    with span("stylesheet", url=url):
+        if on_resource:
+            body.seek(0)
+            for link in extract_css_urls(body.read().decode("utf-8", errors="replace"), url):
+                on_resource(link)
+        if paths and paths.rewrite:
+            body = rewrite_stylesheet(body, url, arcname, paths)
+    return body
 
 if __name__ == "__main__":
+    # The menu lives in shell.py, so importing main6 doesn't load the UI
+    from shell import main
     main()
 
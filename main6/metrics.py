@@ -0,0 +1,229 @@
+import json
+import os
+import threading
+from urllib.parse import urlparse
+
+# Prefix of every metric name in the Prometheus export
+METRIC_PREFIX = "website_downloader_"
+
+# Upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+# Upper bounds of the body size histogram buckets, in bytes
+SIZE_BUCKETS = tuple(1024 * 4 ** power for power in range(10))
+
+# Known metrics: name -> (type, help text, histogram buckets)
+METRICS_HELP = {
+    "files_total": ("counter", "Pages and resources finished, by result.", None),
+    "sites_total": ("counter", "Websites saved, by result.", None),
+    "responses_total": ("counter", "HTTP responses received, by host and status.", None),
+    "retries_total": ("counter", "Downloads scheduled to be tried again after a network error, by host.", None),
+    "throttled_total": ("counter", "Downloads put back after a 429/503, by host.", None),
+    "response_seconds": ("histogram", "Time to the response headers, by host and content type.", LATENCY_BUCKETS),
+    "response_bytes": ("histogram", "Size of downloaded bodies, by host and content type.", SIZE_BUCKETS),
+}
+
+
+class Shard:
+    """The metrics recorded by one thread.
+
+    Only its own thread writes to it, so its lock is never contended except
+    for the moment a reader merges it.
+    """
+
+    def __init__(self):
+        self.values = {}
+        self.lock = threading.Lock()
+        self.thread = threading.current_thread()
+
+
+class MetricsRegistry:
+    """Counters and histograms, sharded per thread and added up when read.
+
+    Recording only touches the calling thread's shard, so the crawl's worker
+    threads never wait for each other. The shards of threads that ended are
+    folded into one base total, so a long batch run doesn't pile them up.
+    Metrics are identified by a name from METRICS_HELP and keyword labels;
+    snapshot() merges the shards, and to_json() / to_prometheus() export them.
+    """
+
+    def __init__(self):
+        self.shards = []
+        self.base = {}
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def _shard(self):
+        shard = getattr(self.local, "shard", None)
+        if shard is None:
+            shard = self.local.shard = Shard()
+            with self.lock:
+                self._fold()
+                self.shards.append(shard)
+        return shard
+
+    def _fold(self):
+        # Called with self.lock held; a thread that ended won't write to its shard again
+        live = []
+        for shard in self.shards:
+            if shard.thread.is_alive():
+                live.append(shard)
+            else:
+                merge(self.base, shard.values)
+        self.shards = live
+
+    def _shards(self):
+        """Return the base total and the live shards, folding the ones of ended threads first."""
+        with self.lock:
+            self._fold()
+            return dict(self.base), list(self.shards)
+
+    def inc(self, name, value=1, **labels):
+        """Add value to the counter name with the given labels."""
+        key = (name, tuple(sorted(labels.items())))
+        shard = self._shard()
+        with shard.lock:
+            shard.values[key] = shard.values.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        """Record value in the histogram name with the given labels."""
+        buckets = METRICS_HELP[name][2]
+        key = (name, tuple(sorted(labels.items())))
+        shard = self._shard()
+        with shard.lock:
+            counts = shard.values.get(key)
+            if counts is None:
+                # One count per bucket, one for +Inf, then the sum
+                counts = shard.values[key] = [0] * (len(buckets) + 1) + [0.0]
+            index = 0
+            while index < len(buckets) and value > buckets[index]:
+                index += 1
+            counts[index] += 1
+            counts[-1] += value
+
+    def value(self, name, **labels):
+        """Return the current total of the counter name with exactly these labels."""
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self._fold()
+            total = self.base.get(key, 0)
+            shards = list(self.shards)
+        for shard in shards:
+            with shard.lock:
+                total += shard.values.get(key, 0)
+        return total
+
+    def snapshot(self):
+        """Return {(name, labels): total} merged from all shards; histograms as per-bucket counts plus sum."""
+        merged, shards = self._shards()
+        for shard in shards:
+            with shard.lock:
+                merge(merged, shard.values)
+        return merged
+
+    def reset(self):
+        with self.lock:
+            self.base = {}
+            shards = list(self.shards)
+        for shard in shards:
+            with shard.lock:
+                shard.values.clear()
+
+    def to_json(self):
+        """Return the metrics as a JSON document: {"counters": {...}, "histograms": {...}}."""
+        counters = {}
+        histograms = {}
+        for (name, labels), value in sorted(self.snapshot().items()):
+            if isinstance(value, list):
+                buckets = METRICS_HELP[name][2]
+                histograms.setdefault(name, []).append({
+                    "labels": dict(labels),
+                    "buckets": dict(zip([str(bound) for bound in buckets] + ["+Inf"], cumulative(value[:-1]))),
+                    "sum": value[-1],
+                    "count": sum(value[:-1]),
+                })
+            else:
+                counters.setdefault(name, []).append({"labels": dict(labels), "value": value})
+        return json.dumps({"counters": counters, "histograms": histograms}, indent=2)
+
+    def to_prometheus(self):
+        """Return the metrics in the Prometheus text exposition format."""
+        lines = []
+        described = set()
+        for (name, labels), value in sorted(self.snapshot().items()):
+            full_name = METRIC_PREFIX + name
+            kind, help_text, buckets = METRICS_HELP[name]
+            if name not in described:
+                described.add(name)
+                lines.append(f"# HELP {full_name} {help_text}")
+                lines.append(f"# TYPE {full_name} {kind}")
+            if kind == "histogram":
+                for bound, count in zip([str(bound) for bound in buckets] + ["+Inf"], cumulative(value[:-1])):
+                    lines.append(f"{full_name}_bucket{format_labels(labels + (('le', bound),))} {count}")
+                lines.append(f"{full_name}_sum{format_labels(labels)} {value[-1]}")
+                lines.append(f"{full_name}_count{format_labels(labels)} {sum(value[:-1])}")
+            else:
+                lines.append(f"{full_name}{format_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+    def write(self, path):
+        """Write the metrics to path, as Prometheus text if it ends in .prom or .txt, otherwise as JSON.
+
+        The file is replaced in one step, so a collector never reads half of it.
+        """
+        text = self.to_prometheus() if path.endswith((".prom", ".txt")) else self.to_json()
+        temporary = f"{path}.tmp"
+        with open(temporary, "w", encoding="utf-8") as file:
+            file.write(text)
+        os.replace(temporary, path)
+
+    def record_response(self, url, status, content_type, seconds):
+        """Count a response and record its latency to the headers."""
+        host = urlparse(url).netloc.lower()
+        self.inc("responses_total", host=host, status=str(status))
+        self.observe("response_seconds", seconds, host=host, content_type=media_type(content_type))
+
+    def record_body(self, url, content_type, size):
+        """Record the size of a downloaded body."""
+        self.observe("response_bytes", size, host=urlparse(url).netloc.lower(), content_type=media_type(content_type))
+
+    def response_hook(self, response, *args, **kwargs):
+        """requests response hook that records every response of a session."""
+        self.record_response(response.url, response.status_code, response.headers.get("Content-Type"),
+                             response.elapsed.total_seconds())
+
+
+def merge(total, values):
+    """Add the values of a shard to total, in place; histograms bucket by bucket."""
+    for key, value in values.items():
+        if isinstance(value, list):
+            current = total.get(key)
+            total[key] = value[:] if current is None else [a + b for a, b in zip(current, value)]
+        else:
+            total[key] = total.get(key, 0) + value
+
+
+def cumulative(counts):
+    """Turn per-bucket counts into the running totals Prometheus buckets hold."""
+    total = 0
+    result = []
+    for count in counts:
+        total += count
+        result.append(total)
+    return result
+
+
+def media_type(content_type):
+    """Return the media type of a Content-Type header without its parameters, "unknown" if missing."""
+    return (content_type or "unknown").split(";", 1)[0].strip().lower() or "unknown"
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in labels)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(labels, escaped)) + "}"
+
+
+# Shared by everything in the process, like the score the menu shows
+METRICS = MetricsRegistry()
@@ -0,0 +1,343 @@
+import heapq
+import itertools
+import threading
+import time
+from collections import OrderedDict, deque
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlparse
+from urllib.robotparser import RobotFileParser
+
+from retry import CircuitBreaker, HostDown
+
+# Most requests running at the same time against one host
+DEFAULT_PER_HOST = 32
+
+# Requests a host starts with before its limit adapts
+INITIAL_PER_HOST = 4
+
+# Latency up to this multiple of a host's lowest latency counts as flat
+LATENCY_TOLERANCE = 2.0
+
+# Latency changes smaller than this many seconds are noise
+LATENCY_NOISE = 0.01
+
+# How long a host is left alone after a 429/503 without a usable Retry-After
+DEFAULT_THROTTLE_DELAY = 5
+
+# Longest Retry-After honoured; a host asking for more is retried after this,
+# and gives up once its URLs were throttled MAX_THROTTLED times
+MAX_THROTTLE_DELAY = 120
+
+# Responses telling us to slow down
+THROTTLE_STATUSES = (429, 503)
+
+# Responses that make a host's concurrency limit back off
+OVERLOAD_STATUSES = (429, 500, 502, 503, 504)
+
+# How often a URL is queued again after being throttled before it counts as failed
+MAX_THROTTLED = 5
+
+
+class Throttled(Exception):
+    """Raised for a 429/503 response, so the URL is queued again once the host allows it."""
+
+    def __init__(self, url, retry_after=None):
+        super().__init__(f"{url} is throttled by the server")
+        self.url = url
+        self.retry_after = retry_after
+
+
+def throttle_delay(retry_after):
+    """Return how long to leave a host alone after a 429/503 with Retry-After retry_after (None if absent)."""
+    delay = DEFAULT_THROTTLE_DELAY if retry_after is None else retry_after
+    return min(delay, MAX_THROTTLE_DELAY)
+
+
+def retry_after_seconds(value, now=None):
+    """Parse a Retry-After header (seconds or an HTTP date) into seconds, or None."""
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return int(value)
+    try:
+        date = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, date.timestamp() - (now or time.time()))
+
+
+class TokenBucket:
+    """Allows `rate` requests per second on average, in bursts of up to `burst`."""
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now):
+        """Return how many seconds until a token is available."""
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def take(self, now):
+        self._refill(now)
+        self.tokens -= 1
+
+
+class AdaptiveLimit:
+    """AIMD concurrency limit of one host, like TCP congestion control.
+
+    While the host answers with flat latency (within LATENCY_TOLERANCE of
+    the lowest seen) and all its slots are in use, the limit grows by one
+    per round trip. Errors, timeouts and overload statuses halve it, at most
+    once per round trip; a rising latency shrinks it a little.
+    """
+
+    def __init__(self, initial=INITIAL_PER_HOST, maximum=DEFAULT_PER_HOST, minimum=1):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.limit = float(min(initial, maximum))
+        self.min_latency = None
+        self.latency = None
+        self.last_decrease = 0.0
+
+    @property
+    def value(self):
+        return max(self.minimum, int(self.limit))
+
+    def sample(self, latency, saturated, now):
+        """Record the latency of a successful response."""
+        if self.min_latency is None or latency < self.min_latency:
+            self.min_latency = latency
+        else:
+            # Let the baseline drift up slowly, the no-load latency of a host can change
+            self.min_latency *= 1.001
+        self.latency = latency
+        if latency > LATENCY_TOLERANCE * self.min_latency + LATENCY_NOISE:
+            self._decrease(0.9, now)
+        elif saturated:
+            self.limit = min(self.maximum, self.limit + 1 / self.limit)
+
+    def overloaded(self, now):
+        """Record a timeout, connection error or overload status."""
+        self._decrease(0.5, now)
+
+    def _decrease(self, factor, now):
+        # Responses to requests sent before the last decrease don't count again
+        if now - self.last_decrease < (self.latency or 0):
+            return
+        self.limit = max(self.minimum, self.limit * factor)
+        self.last_decrease = now
+
+
+class HostState:
+    """Queue and budgets of one host."""
+
+    def __init__(self, per_host, rate):
+        self.queue = deque()
+        self.limit = AdaptiveLimit(maximum=per_host)
+        self.active = 0
+        self.bucket = TokenBucket(rate, max(1, int(rate))) if rate else None
+        self.blocked_until = 0.0
+        self.breaker = CircuitBreaker()
+        # Only one request goes out until robots.txt has been read
+        self.robots_known = False
+        self.robots_lock = threading.Lock()
+
+    def delay(self, now):
+        """Return seconds until the next request may start, inf while all slots are busy."""
+        delay = max(0.0, self.blocked_until - now, self.breaker.delay(now))
+        # A half-open breaker only lets one probe through
+        limit = self.limit.value if self.robots_known and not self.breaker.half_open else 1
+        if self.active >= limit:
+            return float("inf")
+        if self.bucket:
+            delay = max(delay, self.bucket.delay(now))
+        return delay
+
+
+class HostScheduler:
+    """Per-host politeness queues for the crawl loop.
+
+    Work is queued per host with push() and handed out by pop_ready() only
+    when its host has a free slot (an AdaptiveLimit of up to `per_host`
+    requests at once, fed by observe() and failure()), a
+    token in its rate budget (`rate` requests per second, if set) and is not
+    backing off after a 429/503 or behind an open circuit breaker. Hosts
+    are served round-robin, so a slow, throttled or failing host only holds
+    up its own queue and CDNs keep going at full speed. With `robots` set,
+    the Crawl-delay and Request-rate of each host's robots.txt tighten its
+    rate budget. push(..., delay=...) keeps work back for a while, which is
+    how retries are scheduled. Never blocks, the caller waits for
+    next_delay() itself.
+    """
+
+    def __init__(self, per_host=DEFAULT_PER_HOST, rate=None, robots=True, user_agent="*"):
+        self.per_host = per_host
+        self.rate = rate
+        self.robots = robots
+        self.user_agent = user_agent
+        self.hosts = OrderedDict()
+        # Delayed work as a heap of (due time, sequence number, url, item)
+        self.delayed = []
+        self.sequence = itertools.count()
+        self.queued = 0
+        self.lock = threading.Lock()
+
+    def _host(self, url):
+        host = urlparse(url).netloc.lower()
+        state = self.hosts.get(host)
+        if state is None:
+            state = self.hosts[host] = HostState(self.per_host, self.rate)
+            state.robots_known = not self.robots
+        return state
+
+    def push(self, url, item, delay=0):
+        """Queue item, the work for url, behind the other work for its host, after `delay` seconds."""
+        with self.lock:
+            if delay > 0:
+                heapq.heappush(self.delayed, (time.monotonic() + delay, next(self.sequence), url, item))
+            else:
+                self._host(url).queue.append((url, item))
+            self.queued += 1
+
+    def _release_delayed(self, now):
+        while self.delayed and self.delayed[0][0] <= now:
+            _, _, url, item = heapq.heappop(self.delayed)
+            self._host(url).queue.append((url, item))
+
+    def pop_ready(self, limit):
+        """Take up to `limit` (url, item) pairs that may start now, one host at a time."""
+        ready = []
+        now = time.monotonic()
+        with self.lock:
+            self._release_delayed(now)
+            progress = True
+            while progress and len(ready) < limit:
+                progress = False
+                for state in self.hosts.values():
+                    if len(ready) >= limit:
+                        break
+                    if not state.queue or state.delay(now) > 0:
+                        continue
+                    ready.append(state.queue.popleft())
+                    state.active += 1
+                    if state.bucket:
+                        state.bucket.take(now)
+                    self.queued -= 1
+                    progress = True
+        return ready
+
+    def next_delay(self):
+        """Return seconds until queued work can start, or None if it waits for running requests."""
+        now = time.monotonic()
+        with self.lock:
+            delays = [state.delay(now) for state in self.hosts.values() if state.queue]
+            if self.delayed:
+                delays.append(max(0.0, self.delayed[0][0] - now))
+        delays = [delay for delay in delays if delay != float("inf")]
+        return min(delays) if delays else None
+
+    def done(self, url):
+        """Free the slot taken by url when it was handed out."""
+        with self.lock:
+            self._host(url).active -= 1
+
+    def success(self, url):
+        """Record that url's host answered, which closes its circuit breaker."""
+        with self.lock:
+            self._host(url).breaker.success()
+
+    def failure(self, url):
+        """Record a network failure of url's host; enough of them open its circuit breaker."""
+        now = time.monotonic()
+        with self.lock:
+            state = self._host(url)
+            state.breaker.failure(now)
+            state.limit.overloaded(now)
+
+    def observe(self, response, *args, **kwargs):
+        """requests response hook that feeds each host's adaptive limit with latency and status."""
+        now = time.monotonic()
+        with self.lock:
+            state = self._host(response.url)
+            if response.status_code in OVERLOAD_STATUSES:
+                state.limit.overloaded(now)
+            else:
+                # elapsed is the time to the response headers, so body sizes don't skew it
+                state.limit.sample(response.elapsed.total_seconds(), state.active >= state.limit.value, now)
+
+    def limits(self):
+        """Return {host: (requests running, current limit)} for the hosts seen so far."""
+        with self.lock:
+            return {host: (state.active, state.limit.value) for host, state in self.hosts.items()}
+
+    def throttle(self, url, retry_after=None):
+        """Stop starting requests to url's host for retry_after seconds, at most MAX_THROTTLE_DELAY."""
+        delay = throttle_delay(retry_after)
+        with self.lock:
+            state = self._host(url)
+            state.blocked_until = max(state.blocked_until, time.monotonic() + delay)
+
+    def read_robots(self, session, url):
+        """Fetch the robots.txt of url's host once and apply its Crawl-delay / Request-rate.
+
+        Called from the worker, so the crawl loop never waits for it.
+        """
+        with self.lock:
+            state = self._host(url)
+        with state.robots_lock:
+            if state.robots_known:
+                return
+            try:
+                parsed = urlparse(url)
+                response = session.get(f"{parsed.scheme}://{parsed.netloc}/robots.txt", timeout=10)
+                rate = None
+                if response.status_code == 200:
+                    parser = RobotFileParser()
+                    parser.parse(response.text.splitlines())
+                    delay = parser.crawl_delay(self.user_agent)
+                    request_rate = parser.request_rate(self.user_agent)
+                    if delay:
+                        rate = 1 / float(delay)
+                    if request_rate and request_rate.seconds:
+                        rate = min(rate or float("inf"), request_rate.requests / request_rate.seconds)
+                if rate and (self.rate is None or rate < self.rate):
+                    with self.lock:
+                        state.bucket = TokenBucket(rate)
+                        # The request that read robots.txt already went out
+                        state.bucket.tokens = 0
+            except Exception:
+                # No usable robots.txt means no extra limits
+                pass
+            finally:
+                with self.lock:
+                    state.robots_known = True
+
+    def run(self, session, url, function, *args):
+        """Worker side of a handed out url: read robots.txt if needed, call function, free the slot.
+
+        Raises HostDown without calling function if the host's breaker gave up on it.
+        """
+        try:
+            with self.lock:
+                down = self._host(url).breaker.down
+            if down:
+                raise HostDown(f"{urlparse(url).netloc} keeps failing, not trying {url}")
+            if self.robots:
+                self.read_robots(session, url)
+            return function(*args)
+        finally:
+            self.done(url)
+
+    def __len__(self):
+        with self.lock:
+            return self.queued
@@ -0,0 +1,109 @@
+import random
+import threading
+
+# Attempts after the first one for a URL that failed with a network error
+DEFAULT_RETRIES = 3
+
+# First backoff delay in seconds, doubled on every further attempt
+DEFAULT_BACKOFF = 2
+
+# No backoff is longer than this
+MAX_BACKOFF = 60
+
+# Retries allowed per run: RETRY_RATIO of the requests made, plus MIN_RETRIES
+RETRY_RATIO = 0.2
+MIN_RETRIES = 10
+
+# Consecutive failures after which a host's circuit breaker opens
+FAILURE_THRESHOLD = 5
+
+# How long an open breaker keeps its host paused, doubled each time it opens again
+BREAKER_COOLDOWN = 10
+
+# A host whose breaker opened this many times in a row is given up on
+MAX_OPENS = 3
+
+
+class HostDown(Exception):
+    """Raised instead of sending a request to a host that keeps failing."""
+
+
+class RetryPolicy:
+    """Decides whether and when a failed URL is tried again.
+
+    Delays grow exponentially with jitter, so retries of many URLs don't hit
+    the server at the same moment. A run-wide budget caps retries at
+    RETRY_RATIO of all requests (plus MIN_RETRIES), so a broken site can't
+    multiply the work of the whole run.
+    """
+
+    def __init__(self, retries=DEFAULT_RETRIES, backoff=DEFAULT_BACKOFF, max_backoff=MAX_BACKOFF,
+                 ratio=RETRY_RATIO, min_retries=MIN_RETRIES):
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.ratio = ratio
+        self.min_retries = min_retries
+        self.requests = 0
+        self.retried = 0
+        self.lock = threading.Lock()
+
+    def record_request(self):
+        with self.lock:
+            self.requests += 1
+
+    def next_delay(self, attempt):
+        """Return the delay before retry number `attempt` (0 for the first retry), or None if not allowed."""
+        with self.lock:
+            if attempt >= self.retries or self.retried >= self.min_retries + self.ratio * self.requests:
+                return None
+            self.retried += 1
+        delay = min(self.max_backoff, self.backoff * 2 ** attempt)
+        # Half fixed, half random
+        return delay / 2 + random.uniform(0, delay / 2)
+
+
+class CircuitBreaker:
+    """Pauses a host after FAILURE_THRESHOLD consecutive failures.
+
+    While open the host gets no requests. After the cooldown a single probe
+    request is let through (half-open): a success closes the breaker, a
+    failure opens it again for twice as long. After MAX_OPENS openings
+    without a success in between the host counts as down.
+    """
+
+    def __init__(self, threshold=FAILURE_THRESHOLD, cooldown=BREAKER_COOLDOWN, max_opens=MAX_OPENS):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.max_opens = max_opens
+        self.failures = 0
+        self.opens = 0
+        self.open_until = 0.0
+        self.half_open = False
+
+    @property
+    def down(self):
+        return self.opens >= self.max_opens
+
+    def delay(self, now):
+        """Return seconds until the breaker lets requests through again."""
+        if self.down:
+            return 0.0
+        if self.open_until > now:
+            return self.open_until - now
+        if self.opens:
+            self.half_open = True
+        return 0.0
+
+    def success(self):
+        self.failures = 0
+        self.opens = 0
+        self.half_open = False
+
+    def failure(self, now):
+        self.failures += 1
+        if self.half_open or self.failures >= self.threshold:
+            self.opens += 1
+            self.open_until = now + self.cooldown * 2 ** (self.opens - 1)
+            self.failures = 0
+            self.half_open = False
@@ -0,0 +1,345 @@
+import codecs
+import hashlib
+import html
+import posixpath
+import re
+import threading
+from urllib.parse import quote, unquote, urldefrag, urlparse
+
+from archive import new_buffer
+from crawler import CSS_IMPORT, CSS_URL, extract_css_urls, normalize_url, page_path, resolve_url
+
+# Where the start page of a site is saved
+START_PAGE = "html/index.html"
+
+# Characters that can't be part of a file name on common file systems
+UNSAFE_CHARACTERS = re.compile(r'[\x00-\x1f<>:"/\\|?*]')
+
+# Attributes holding a single URL, on any tag ("data" only counts on <object>)
+URL_ATTRIBUTES = {"href", "src", "poster", "action", "formaction", "background", "cite"}
+
+# Attributes holding a list of image candidates
+SRCSET_ATTRIBUTES = {"srcset", "imagesrcset"}
+
+# Where the raw text content of a <script> or <style> element, or a comment, ends
+RAW_TEXT_END = {"script": re.compile(r"</script", re.I), "style": re.compile(r"</style", re.I)}
+COMMENT_END = re.compile(r"-->")
+
+# How much of a script or comment is held back in case it is the start of its end marker
+RAW_TEXT_TAIL = len("</script") - 1
+
+# Longest start tag waited for across chunks before its "<" is passed on as text
+MAX_TAG = 64 * 1024
+
+TAG = re.compile(r"""<([a-zA-Z][^\s/>]*)((?:[^>"']|"[^"]*"|'[^']*')*)>""")
+TAG_NAME_START = re.compile(r"[a-zA-Z]")
+ATTRIBUTE = re.compile(r"""([^\s"'>/=]+)(?:\s*=\s*("[^"]*"|'[^']*'|[^\s>]*))?""")
+CSS_REFERENCE = re.compile(f"{CSS_IMPORT.pattern}|{CSS_URL.pattern}", re.I)
+SRCSET_ITEM = re.compile(r"\s*([^\s,]\S*?)(\s+[^,]*?)?\s*(?:,|$)")
+
+
+def safe_name(segment):
+    """Make one path segment usable as a file or folder name."""
+    segment = UNSAFE_CHARACTERS.sub("_", segment).rstrip(". ")
+    return segment or "_"
+
+
+class LocalPaths:
+    """Maps the URLs of a mirrored site to paths in its archive or folder.
+
+    Pages go under html/ (see crawler.page_path), the start page is
+    html/index.html. Other files keep the directory structure of their URL;
+    files from other hosts go under a folder named after the host. A path
+    that another URL already has, also when only the case differs or when a
+    file would be where a folder is, gets a hash of the URL added. With
+    rewrite=True, pages and stylesheets are saved with their references
+    pointing at these paths, see rewrite_page() and rewrite_css().
+    """
+
+    def __init__(self, start_url, rewrite=True):
+        self.host = urlparse(normalize_url(start_url)).netloc
+        self.rewrite = rewrite
+        self.paths = {}
+        # Lowercased, so names that only differ by case don't clash on Windows and macOS
+        self.files = set()
+        self.folders = set()
+        self.lock = threading.Lock()
+        self._assign(start_url, START_PAGE)
+
+    def get(self, url):
+        """Return the path given to url, or None if it has none (it is not downloaded)."""
+        with self.lock:
+            return self.paths.get(normalize_url(url))
+
+    def page(self, url):
+        """Return the path of a page, giving it one if it has none yet."""
+        host = urlparse(normalize_url(url)).netloc
+        folder = "html" if host == self.host else f"html/{safe_name(host)}"
+        return self._assign(url, f"{folder}/{page_path(url)}")
+
+    def resource(self, url):
+        """Return the path of a resource, giving it one if it has none yet."""
+        parsed = urlparse(normalize_url(url))
+        # Split before unquoting, so an encoded "/" can't add a folder (or "..")
+        segments = [safe_name(unquote(segment)) for segment in parsed.path.split("/") if segment]
+        if not segments or parsed.path.endswith("/"):
+            segments.append("index")
+        if parsed.netloc != self.host:
+            segments.insert(0, safe_name(parsed.netloc))
+        path = "/".join(segments)
+        if parsed.query:
+            # Same as pages, files that only differ by query string must not overwrite each other
+            digest = hashlib.sha1(parsed.query.encode("utf-8")).hexdigest()[:8]
+            root, ext = posixpath.splitext(path)
+            path = f"{root}_{digest}{ext}"
+        return self._assign(url, path)
+
+    def reference(self, url, from_path):
+        """Return how the file at from_path links to the local copy of url, or None if there is none."""
+        url, fragment = urldefrag(url)
+        path = self.get(url)
+        if path is None:
+            return None
+        reference = quote(posixpath.relpath(path, posixpath.dirname(from_path) or "."))
+        return f"{reference}#{fragment}" if fragment else reference
+
+    def _assign(self, url, path):
+        key = normalize_url(url)
+        with self.lock:
+            known = self.paths.get(key)
+            if known:
+                return known
+            digest = hashlib.sha1(key.encode("utf-8")).hexdigest()[:8]
+            while True:
+                clash = self._clash(path.lower())
+                if clash is None:
+                    break
+                segments = path.split("/")
+                if clash == len(segments):
+                    root, ext = posixpath.splitext(path)
+                    path = f"{root}_{digest}{ext}"
+                else:
+                    # A file has the name of one of its folders
+                    segments[clash - 1] += f"_{digest}"
+                    path = "/".join(segments)
+            self.paths[key] = path
+            parts = path.lower().split("/")
+            self.files.add("/".join(parts))
+            self.folders.update("/".join(parts[:end]) for end in range(1, len(parts)))
+            return path
+
+    def _clash(self, folded):
+        # Return how many segments of the path clash with a path already given out, or None
+        parts = folded.split("/")
+        for end in range(1, len(parts)):
+            if "/".join(parts[:end]) in self.files:
+                return end
+        if folded in self.files or folded in self.folders:
+            return len(parts)
+        return None
+
+
+def rewrite_url(value, base_url, from_path, paths):
+    """Return what a reference to value should become in the file at from_path, or None to leave it.
+
+    URLs that are downloaded point at their local copy, others at their
+    absolute URL, so they still work when the file is opened from disk.
+    """
+    url = resolve_url(base_url, value)
+    if url is None:
+        # In-page anchors, mailto:, data: and the like
+        return None
+    new = paths.reference(url, from_path) or url
+    return new if new != value else None
+
+
+def rewrite_srcset(value, base_url, from_path, paths):
+    """Rewrite a srcset attribute; only the candidates that were downloaded are kept, if there are any."""
+    candidates = []
+    for match in SRCSET_ITEM.finditer(value):
+        url = resolve_url(base_url, match.group(1))
+        if url:
+            candidates.append((url, match.group(2) or ""))
+    local = [(paths.reference(url, from_path), descriptor) for url, descriptor in candidates
+             if paths.get(url) is not None]
+    new = ", ".join(url + descriptor for url, descriptor in local or candidates)
+    return new if new != value else None
+
+
+def rewrite_css(css, base_url, from_path, paths):
+    """Point the url() and @import references of CSS in the file at from_path at their local copies."""
+    def replace(match):
+        index = next(index for index, group in enumerate(match.groups(), 1) if group is not None)
+        new = rewrite_url(match.group(index), base_url, from_path, paths)
+        if new is None:
+            return match.group(0)
+        start, end = match.start(index) - match.start(), match.end(index) - match.start()
+        return match.group(0)[:start] + new + match.group(0)[end:]
+
+    return CSS_REFERENCE.sub(replace, css)
+
+
+class HtmlRewriter:
+    """Streaming rewriter of the references in a page, fed text in pieces like the page parsers.
+
+    feed() returns the text rewritten so far; a tag cut in two by a chunk
+    boundary is held back until its end arrives. Only the attribute values
+    that change are touched, everything else is passed through as it was.
+    A <base href> is dropped, as the references it applied to are rewritten.
+    """
+
+    def __init__(self, base_url, arcname, paths):
+        self.base_url = base_url
+        self.arcname = arcname
+        self.paths = paths
+        self.pending = ""
+        # End marker of the script, style or comment being passed through
+        self.raw_end = None
+        self.in_style = False
+
+    def feed(self, text):
+        self.pending += text
+        return self._rewrite(final=False)
+
+    def close(self):
+        return self._rewrite(final=True)
+
+    def _rewrite(self, final):
+        data = self.pending
+        out = []
+        pos = 0
+        while pos < len(data):
+            if self.raw_end:
+                match = self.raw_end.search(data, pos)
+                if match is None and not final:
+                    # Styles are rewritten as a whole, scripts and comments pass through as they come
+                    if not self.in_style:
+                        keep = max(pos, len(data) - RAW_TEXT_TAIL)
+                        out.append(data[pos:keep])
+                        pos = keep
+                    break
+                end = match.start() if match else len(data)
+                text = data[pos:end]
+                out.append(rewrite_css(text, self.base_url, self.arcname, self.paths) if self.in_style else text)
+                pos = end
+                self.raw_end = None
+                self.in_style = False
+                continue
+            start = data.find("<", pos)
+            if start < 0:
+                out.append(data[pos:])
+                pos = len(data)
+                break
+            out.append(data[pos:start])
+            pos = start
+            rest = len(data) - pos
+            if data.startswith("<!--", pos):
+                out.append("<!--")
+                pos += 4
+                self.raw_end = COMMENT_END
+                continue
+            if not final and rest < 4 and "<!--".startswith(data[pos:]):
+                break
+            match = TAG.match(data, pos)
+            if match:
+                out.append(self._tag(match))
+                pos = match.end()
+                continue
+            # A start tag whose end has not arrived yet is waited for, anything else is text
+            if not final and rest < MAX_TAG and (rest == 1 or TAG_NAME_START.match(data, pos + 1)):
+                break
+            out.append("<")
+            pos += 1
+        self.pending = data[pos:]
+        return "".join(out)
+
+    def _tag(self, match):
+        name = match.group(1).lower()
+        attributes = match.group(2)
+        # A "/>" does not end a script or style early in HTML
+        if name in RAW_TEXT_END:
+            self.raw_end = RAW_TEXT_END[name]
+            self.in_style = name == "style"
+        parts = []
+        last = 0
+        for attribute in ATTRIBUTE.finditer(attributes):
+            value = attribute.group(2)
+            if value is None:
+                continue
+            key = attribute.group(1).lower()
+            if value[:1] in ('"', "'"):
+                value = value[1:-1]
+            value = html.unescape(value)
+            if name == "base" and key == "href":
+                self.base_url = resolve_url(self.base_url, value) or self.base_url
+                parts.append(attributes[last:attribute.start()].rstrip())
+                last = attribute.end()
+                continue
+            new = self._attribute(name, key, value)
+            if new is not None:
+                parts.append(attributes[last:attribute.start(2)])
+                parts.append('"' + html.escape(new, quote=False).replace('"', "&quot;") + '"')
+                last = attribute.end(2)
+        if not parts:
+            return match.group(0)
+        return f"<{match.group(1)}{''.join(parts)}{attributes[last:]}>"
+
+    def _attribute(self, tag, key, value):
+        if key in URL_ATTRIBUTES or (key == "data" and tag == "object"):
+            return rewrite_url(value, self.base_url, self.arcname, self.paths)
+        if key in SRCSET_ATTRIBUTES:
+            return rewrite_srcset(value, self.base_url, self.arcname, self.paths)
+        if key == "style":
+            new = rewrite_css(value, self.base_url, self.arcname, self.paths)
+            return new if new != value else None
+        return None
+
+
+def known_encoding(encoding):
+    """Return encoding if Python has a codec for it, else UTF-8."""
+    try:
+        return codecs.lookup(encoding or "utf-8").name
+    except LookupError:
+        return "utf-8"
+
+
+def rewrite_page(body, encoding, url, arcname, paths):
+    """Return a new buffer with the page in body rewritten by an HtmlRewriter, chunk by chunk.
+
+    Bytes that don't decode are carried over unchanged (surrogateescape), so
+    the page only changes where its references do. Closes body.
+    """
+    encoding = known_encoding(encoding)
+    decoder = codecs.getincrementaldecoder(encoding)(errors="surrogateescape")
+    rewriter = HtmlRewriter(url, arcname, paths)
+    rewritten = new_buffer()
+    try:
+        body.seek(0)
+        while True:
+            chunk = body.read(64 * 1024)
+            text = rewriter.feed(decoder.decode(chunk, final=not chunk))
+            if not chunk:
+                text += rewriter.close()
+            rewritten.write(text.encode(encoding, errors="surrogateescape"))
+            if not chunk:
+                break
+    except BaseException:
+        rewritten.close()
+        raise
+    body.close()
+    return rewritten
+
+
+def rewrite_stylesheet(body, url, arcname, paths):
+    """Return a new buffer with the stylesheet in body pointing at local copies; closes body.
+
+    Everything it references is given a path, as it is all downloaded.
+    """
+    body.seek(0)
+    css = body.read().decode("utf-8", errors="surrogateescape")
+    for link in extract_css_urls(css, url):
+        paths.resource(link)
+    rewritten = new_buffer()
+    rewritten.write(rewrite_css(css, url, arcname, paths).encode("utf-8", errors="surrogateescape"))
+    body.close()
+    return rewritten
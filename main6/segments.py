@@ -0,0 +1,209 @@
+import base64
+import binascii
+import hashlib
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+# Files at least this big are downloaded as several byte ranges at once
+SEGMENT_THRESHOLD = 32 * 1024 * 1024
+
+# Byte ranges of one file downloaded at the same time
+DEFAULT_SEGMENTS = 4
+
+# No range is made smaller than this, a smaller file gets fewer segments
+MIN_SEGMENT_SIZE = 8 * 1024 * 1024
+
+# Digest headers a server may send, and the hashlib name of each algorithm they use
+DIGEST_ALGORITHMS = {"md5": "md5", "sha": "sha1", "sha-256": "sha256", "sha-512": "sha512"}
+
+
+class IntegrityError(requests.RequestException):
+    """Raised when a downloaded body doesn't have the length or hash the server announced."""
+
+
+class SegmentPolicy:
+    """Decides whether a download is split into byte ranges fetched in parallel.
+
+    Only bodies of at least `threshold` bytes are split, into up to
+    `segments` ranges of at least `min_size` bytes. The server has to accept
+    ranges (Accept-Ranges: bytes), send the body without a content encoding
+    and give a strong validator, which the range requests send as If-Range,
+    so the pieces can't come from two versions of the file. The headers of
+    the first GET are the probe, no extra HEAD request is made.
+    """
+
+    def __init__(self, segments=DEFAULT_SEGMENTS, threshold=SEGMENT_THRESHOLD, min_size=MIN_SEGMENT_SIZE):
+        self.segments = segments
+        self.threshold = threshold
+        self.min_size = min_size
+
+    def ranges(self, response, validator):
+        """Return the (start, end) byte ranges (end inclusive) to fetch response's body in, or None."""
+        headers = response.headers
+        if self.segments < 2 or response.status_code != 200 or validator is None:
+            return None
+        if headers.get("Accept-Ranges", "").lower() != "bytes":
+            return None
+        if headers.get("Content-Encoding", "identity").lower() != "identity":
+            return None
+        size = int(headers.get("Content-Length") or 0)
+        if size < self.threshold:
+            return None
+        count = max(1, min(self.segments, size // self.min_size))
+        if count < 2:
+            return None
+        step = -(-size // count)
+        return [(start, min(start + step, size) - 1) for start in range(0, size, step)]
+
+
+def preallocate(file, size):
+    """Reserve size bytes for file, so segments can be written at their offsets in any order."""
+    if hasattr(os, "posix_fallocate"):
+        try:
+            os.posix_fallocate(file.fileno(), 0, size)
+            return
+        except OSError:
+            # Not supported by every file system, a sparse file does too
+            pass
+    file.truncate(size)
+
+
+class PositionalWriter:
+    """Writes pieces of a file at given offsets from several threads."""
+
+    def __init__(self, file):
+        self.file = file
+        self.fd = file.fileno()
+        self.lock = threading.Lock()
+
+    def write(self, data, offset):
+        if hasattr(os, "pwrite"):
+            while data:
+                written = os.pwrite(self.fd, data, offset)
+                data = data[written:]
+                offset += written
+            return
+        # Windows has no pwrite
+        with self.lock:
+            self.file.seek(offset)
+            self.file.write(data)
+            self.file.flush()
+
+
+def download_segments(session, url, response, file, ranges, validator, chunk_size=64 * 1024, cancelled=None,
+                      checkpoint=None, checkpoint_bytes=None):
+    """Download the body of url into file as parallel byte ranges.
+
+    response is the open 200 response of the first GET; it serves the first
+    range and is left unread after it. The other ranges are requested with
+    Range and If-Range: validator, one thread each, and written at their
+    offsets in file, which is preallocated first. Each range must come back
+    as a 206 of exactly the requested bytes, otherwise IntegrityError is
+    raised. checkpoint, if given, is called with the length of the part of
+    the file that is complete from its start, every checkpoint_bytes.
+    """
+    size = ranges[-1][1] + 1
+    preallocate(file, size)
+    writer = PositionalWriter(file)
+    stop = threading.Event()
+    # Bytes received per range, to know how much of the file is complete from its start
+    received = [0] * len(ranges)
+    progress_lock = threading.Lock()
+    progress = {"checkpointed": 0}
+
+    def report(index, length):
+        with progress_lock:
+            received[index] += length
+            if checkpoint is None:
+                return
+            complete = 0
+            for (start, end), count in zip(ranges, received):
+                complete += count
+                if count < end - start + 1:
+                    break
+            if complete - progress["checkpointed"] >= (checkpoint_bytes or 0) or complete == size:
+                progress["checkpointed"] = complete
+                checkpoint(complete)
+
+    def copy(index, source):
+        start, end = ranges[index]
+        offset = start
+        for chunk in source.iter_content(chunk_size=chunk_size):
+            if stop.is_set() or (cancelled and cancelled.is_set()):
+                raise RuntimeError(f"Download of {url} cancelled")
+            chunk = chunk[:end + 1 - offset]
+            writer.write(chunk, offset)
+            offset += len(chunk)
+            report(index, len(chunk))
+            if offset > end:
+                break
+        if offset != end + 1:
+            raise IntegrityError(f"Range {start}-{end} of {url} ended after {offset - start} bytes")
+
+    def fetch(index):
+        start, end = ranges[index]
+        headers = {"Range": f"bytes={start}-{end}", "If-Range": validator}
+        try:
+            with session.get(url, timeout=10, stream=True, headers=headers) as part:
+                if part.status_code != 206:
+                    # A 200 means the file changed since the first request
+                    raise IntegrityError(f"Range {start}-{end} of {url} was answered with {part.status_code}")
+                if not part.headers.get("Content-Range", "").startswith(f"bytes {start}-{end}/"):
+                    raise IntegrityError(f"Unexpected Content-Range for range {start}-{end} of {url}")
+                copy(index, part)
+        except BaseException as e:
+            # The first error is what went wrong, the ones after it are ranges being stopped
+            errors.append(e)
+            stop.set()
+
+    errors = []
+    with ThreadPoolExecutor(max_workers=len(ranges) - 1, thread_name_prefix="segment") as executor:
+        for index in range(1, len(ranges)):
+            executor.submit(fetch, index)
+        try:
+            copy(0, response)
+        except BaseException:
+            stop.set()
+            if errors:
+                raise errors[0]
+            raise
+    if errors:
+        raise errors[0]
+    verify_digest(file, response.headers, url)
+
+
+def expected_digests(headers):
+    """Return {hashlib name: digest bytes} announced by Content-MD5, Digest or Repr-Digest headers."""
+    digests = {}
+    try:
+        if headers.get("Content-MD5"):
+            digests["md5"] = base64.b64decode(headers["Content-MD5"])
+        for item in (headers.get("Digest") or "").split(","):
+            algorithm, _, value = item.strip().partition("=")
+            if algorithm.lower() in DIGEST_ALGORITHMS and value:
+                digests[DIGEST_ALGORITHMS[algorithm.lower()]] = base64.b64decode(value)
+        for item in (headers.get("Repr-Digest") or "").split(","):
+            algorithm, _, value = item.strip().partition("=")
+            if algorithm.lower() in DIGEST_ALGORITHMS and value.startswith(":"):
+                digests[DIGEST_ALGORITHMS[algorithm.lower()]] = base64.b64decode(value.strip(":"))
+    except (ValueError, binascii.Error):
+        # A malformed header can't be checked against
+        return {}
+    return digests
+
+
+def verify_digest(file, headers, url):
+    """Check file against the digest the server announced for it, if any; raise IntegrityError if it differs."""
+    digests = expected_digests(headers)
+    if not digests:
+        return
+    name, expected = next(iter(digests.items()))
+    digest = hashlib.new(name)
+    file.seek(0)
+    for chunk in iter(lambda: file.read(1024 * 1024), b""):
+        digest.update(chunk)
+    if digest.digest() != expected:
+        raise IntegrityError(f"{name} of {url} does not match the one sent by the server")
@@ -0,0 +1,88 @@
+"""The interactive menu: banners, score and prompts around download_website().
+
+Everything the terminal UI needs (pyfiglet, colorama) is imported here
+rather than in main6, so scripts and job runners importing the downloader
+don't load it.
+"""
+import functools
+import os
+
+import pyfiglet
+from colorama import Fore, init
+
+import main6
+from blobstore import BlobStore
+from crawler import DEFAULT_MAX_PAGES
+from logs import setup_logging
+from main6 import current_score, download_website
+
+
+@functools.lru_cache(maxsize=None)
+def banner(text, font="slant"):
+    """Render text in a FIGlet font once; the menu is drawn again after every choice."""
+    return pyfiglet.figlet_format(text, font=font)
+
+
+def show_menu():
+    print(Fore.MAGENTA + banner("Website Downloader"))
+    score, downloaded_files, failed_files = current_score()
+    print(Fore.YELLOW + f"Level {main6.level} | Score: {score}")
+    print(Fore.YELLOW + f"Successfully Downloaded Files: {downloaded_files} | Failed Files: {failed_files}")
+    print(Fore.CYAN + "1. Download Website")
+    print(Fore.CYAN + "2. Exit")
+    print(Fore.CYAN + "3. List Downloaded Websites")
+    print(Fore.CYAN + "4. Help")
+
+
+def list_downloaded_websites():
+    print(Fore.GREEN + "\n=== Downloaded Websites ===")
+    # List archives and folders that are named after websites
+    for name in sorted(os.listdir()):
+        if name.startswith("website_") and (os.path.isdir(name) or name.endswith(".zip")):
+            print(Fore.BLUE + name)
+    # And websites kept in the default blob store
+    if os.path.isdir(os.path.join(".website_store", "manifests")):
+        store = BlobStore(".website_store")
+        for name in store.list_manifests():
+            print(Fore.BLUE + f"{name} (in .website_store)")
+        store.close()
+
+
+def main():
+    init(autoreset=True)
+    setup_logging()
+    while True:
+        show_menu()
+        choice = input(Fore.CYAN + "Enter your choice (1/2/3/4): ")
+
+        if choice == "1":
+            url = input(Fore.CYAN + "Enter the website URL: ")
+            depth = input(Fore.CYAN + "Crawl depth (press Enter for this page only): ").strip()
+            max_depth = int(depth) if depth.isdigit() else 0
+            max_pages = 1
+            if max_depth > 0:
+                pages = input(Fore.CYAN + f"Maximum number of pages (press Enter for {DEFAULT_MAX_PAGES}): ").strip()
+                max_pages = int(pages) if pages.isdigit() else DEFAULT_MAX_PAGES
+            # Graffiti-like header for the download
+            print(Fore.YELLOW + banner("Downloading Website"))
+            # Crawls are journaled, so entering the same URL after a crash or Ctrl-C resumes it.
+            # A single page is quick to fetch again and is written straight into its ZIP.
+            download_website(url, max_depth=max_depth, max_pages=max_pages, resumable=max_depth > 0)
+        elif choice == "2":
+            print(Fore.RED + "Exiting the program...")
+            break
+        elif choice == "3":
+            list_downloaded_websites()
+        elif choice == "4":
+            print(Fore.GREEN + "Help: This program allows you to download a website's HTML, CSS, JS, and images.")
+            print(Fore.GREEN + "1. Download Website: Input a URL and the website will be downloaded as a .zip file.")
+            print(Fore.GREEN + "   Enter a crawl depth above 0 to also download the pages it links to on the same site.")
+            print(Fore.GREEN + "2. Exit: Exit the program.")
+            print(Fore.GREEN + "3. List Downloaded Websites: List all downloaded websites by their archive or folder name.")
+            print(Fore.GREEN + "4. Help: Displays this help message.")
+        else:
+            print(Fore.RED + "Invalid choice. Please try again.")
+
+
+if __name__ == "__main__":
+    main()
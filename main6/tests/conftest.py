@@ -0,0 +1,77 @@
+import os
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+# The modules of main6 import each other by their plain names
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Pages of the fixture site, each with a stylesheet and an image of its own
+SITE_PAGES = 8
+
+
+class SiteHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests.append(self.path)
+            if self.headers.get("If-None-Match"):
+                server.conditional += 1
+            # Statuses queued up by a test for this path, sent before the real response
+            status = server.errors.get(self.path, []).pop(0) if server.errors.get(self.path) else None
+        if status:
+            self.send_response(status)
+            self.send_header("Retry-After", "0")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        if self.path in ("/", "/index.html") or self.path.startswith("/page"):
+            links = "".join(f'<a href="/page{number}.html">{number}</a>' for number in range(SITE_PAGES))
+            name = self.path.strip("/").replace(".html", "") or "index"
+            body = (f'<html><head><link rel="stylesheet" href="/css/{name}.css"></head>'
+                    f'<body>{links}<img src="/img/{name}.png"></body></html>').encode()
+            content_type = "text/html"
+        elif self.path.startswith(("/css/", "/img/")):
+            body = (self.path * 50).encode()
+            content_type = "text/css" if self.path.endswith(".css") else "image/png"
+        else:
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        etag = f'"{len(body)}"'
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", etag)
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        self.wfile.write(body)
+
+
+@pytest.fixture
+def site(tmp_path, monkeypatch):
+    """Serve a small site on localhost; downloads are written to a temporary folder."""
+    monkeypatch.chdir(tmp_path)
+    server = ThreadingHTTPServer(("127.0.0.1", 0), SiteHandler)
+    server.daemon_threads = True
+    server.lock = threading.Lock()
+    server.requests = []
+    server.conditional = 0
+    server.errors = {}
+    server.url = f"http://127.0.0.1:{server.server_address[1]}/"
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
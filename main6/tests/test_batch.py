@@ -0,0 +1,20 @@
+import multiprocessing
+import os
+
+import pytest
+
+import batch
+
+
+def crash(*args, **kwargs):
+    os._exit(3)
+
+
+@pytest.mark.skipif(multiprocessing.get_start_method() != "fork", reason="workers must inherit the patched run_worker")
+def test_coordinator_gives_up_on_workers_that_keep_crashing(tmp_path, monkeypatch):
+    monkeypatch.setattr(batch, "run_worker", crash)
+    monkeypatch.setattr(batch, "RESTART_BACKOFF", 0)
+    monkeypatch.setattr(batch, "MAX_RESTARTS_PER_WORKER", 2)
+    with pytest.raises(RuntimeError, match="1 sites left"):
+        batch.run_coordinator(["http://127.0.0.1:9/"], str(tmp_path / "queue.sqlite"), processes=1,
+                              summary_path=str(tmp_path / "summary.jsonl"))
@@ -0,0 +1,85 @@
+import pytest
+
+from crawler import Frontier, new_page_parser, parse_page, pick_srcset
+
+URL = "https://example.com/docs/"
+
+PAGE = """<html><head>
+<link rel="stylesheet" href="../css/site.css">
+<link rel="icon" href="/favicon.ico">
+<link rel="preload" as="image" imagesrcset="/img/hero-1x.jpg 1x, /img/hero-2x.jpg 2x">
+<script src="app.js"></script>
+<style>body { background: url("/img/bg.png") } @import url(print.css);</style>
+</head><body>
+<a href="intro">Intro</a> <a href="/about#team">About</a> <a href="mailto:me@example.com">Mail</a>
+<img src="a.png" srcset="a-480.png 480w, a-960.png 960w">
+<video poster="/poster.jpg"><source src="/clip.mp4"></video>
+<div style="background: url('/img/div.png')"></div>
+<input type="image" src="/button.png"> <input type="text" src="/not-a-resource.png">
+</body></html>
+"""
+
+EXPECTED_LINKS = ["https://example.com/docs/intro", "https://example.com/about"]
+EXPECTED_RESOURCES = {
+    "https://example.com/css/site.css", "https://example.com/favicon.ico", "https://example.com/img/hero-2x.jpg",
+    "https://example.com/docs/app.js", "https://example.com/img/bg.png", "https://example.com/docs/print.css",
+    "https://example.com/docs/a-960.png", "https://example.com/docs/a.png", "https://example.com/poster.jpg",
+    "https://example.com/clip.mp4", "https://example.com/img/div.png", "https://example.com/button.png",
+}
+
+
+@pytest.mark.parametrize("parser", ["stream", "lxml"])
+def test_finds_links_and_resources(parser):
+    if parser == "lxml":
+        pytest.importorskip("lxml")
+    links, resources = parse_page(PAGE, URL, parser)
+    assert links == EXPECTED_LINKS
+    assert set(resources) == EXPECTED_RESOURCES
+
+
+@pytest.mark.parametrize("size", [1, 5, 16, 100])
+def test_stream_parser_in_chunks(size):
+    found = []
+    page = new_page_parser("stream", URL, on_resource=found.append)
+    for start in range(0, len(PAGE), size):
+        page.feed(PAGE[start:start + size])
+    links, resources = page.close()
+    assert links == EXPECTED_LINKS
+    assert set(resources) == EXPECTED_RESOURCES
+    # Every resource was reported while parsing
+    assert found == resources
+
+
+def test_bs4_parser_finds_the_original_resources():
+    pytest.importorskip("bs4")
+    links, resources = parse_page(PAGE, URL, "bs4")
+    assert "https://example.com/docs/intro" in links
+    assert {"https://example.com/css/site.css", "https://example.com/docs/app.js",
+            "https://example.com/docs/a.png"} <= set(resources)
+
+
+def test_unknown_parser_and_srcset_policy():
+    with pytest.raises(ValueError):
+        new_page_parser("regex", URL)
+    with pytest.raises(ValueError):
+        new_page_parser("stream", URL, srcset="median")
+
+
+def test_pick_srcset():
+    srcset = "small.png 480w, big.png 960w, medium.png 720w"
+    assert pick_srcset(srcset, "largest") == ["big.png"]
+    assert pick_srcset(srcset, "smallest") == ["small.png"]
+    assert pick_srcset(srcset, "all") == ["small.png", "big.png", "medium.png"]
+    assert pick_srcset(srcset, "none") == []
+
+
+def test_frontier_limits_depth_pages_and_origin():
+    frontier = Frontier("https://example.com/", max_depth=1, max_pages=3)
+    assert frontier.add("https://example.com/a", 1)
+    assert not frontier.add("https://example.com/a#top", 1)
+    assert not frontier.add("https://other.example/", 1)
+    assert not frontier.add("https://example.com/deep", 2)
+    assert frontier.add("https://example.com/b", 1)
+    # The start page counts towards max_pages
+    assert not frontier.add("https://example.com/c", 1)
+    assert frontier.pop() == ("https://example.com/a", 1)
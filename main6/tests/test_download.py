@@ -0,0 +1,116 @@
+import glob
+import os
+import zipfile
+
+import pytest
+
+import main6
+from conftest import SITE_PAGES
+from main6 import download_website
+
+# Every page, its stylesheet and its image
+SITE_FILES = 3 * (SITE_PAGES + 1)
+
+
+def archive_names(path):
+    with zipfile.ZipFile(path) as archive:
+        return archive.namelist()
+
+
+def test_interrupted_job_resumes_in_the_same_process(site, monkeypatch):
+    update_score = main6.update_score
+    calls = []
+
+    def interrupt_after_a_few(success):
+        calls.append(success)
+        if len(calls) == 6:
+            raise KeyboardInterrupt
+        update_score(success)
+
+    monkeypatch.setattr(main6, "update_score", interrupt_after_a_few)
+    with pytest.raises(KeyboardInterrupt):
+        download_website(site.url, max_depth=1, max_pages=50, resumable=True, quiet=True, workers=2)
+    # The journal and what was staged are kept for the next run
+    assert glob.glob("website_*.journal")
+    assert glob.glob("website_*.staging")
+    assert not glob.glob("*.zip")
+    monkeypatch.setattr(main6, "update_score", update_score)
+
+    requested = len(site.requests)
+    summary = download_website(site.url, max_depth=1, max_pages=50, resumable=True, quiet=True, workers=2)
+    assert summary["ok"], summary["error"]
+    assert summary["name"] == "website_127_0_0_1:{}_1".format(site.server_address[1])
+    assert len(archive_names(summary["saved_as"])) == SITE_FILES
+    # Only what the first run had not finished was fetched again
+    assert len(site.requests) - requested < SITE_FILES + 2
+    assert not glob.glob("website_*.journal*")
+    assert not glob.glob("website_*.staging")
+
+
+def test_failed_job_keeps_its_journal(site, monkeypatch):
+    def fail(*args, **kwargs):
+        raise RuntimeError("crawl failed")
+
+    monkeypatch.setattr(main6, "crawl", fail)
+    summary = download_website(site.url, max_depth=1, resumable=True, quiet=True)
+    assert not summary["ok"]
+    assert summary["error"] == "crawl failed"
+    assert glob.glob("website_*.journal")
+    assert os.path.isdir(summary["name"] + ".staging")
+
+
+@pytest.mark.parametrize("options", [{"output": "store"}, {"output": "store", "incremental": True},
+                                     {"resumable": True}])
+def test_http_cache_is_used_with_every_writer(site, options):
+    first = download_website(site.url, max_depth=1, max_pages=50, quiet=True, cache_dir="cache")
+    assert first["ok"] and site.conditional == 0
+    second = download_website(site.url, max_depth=1, max_pages=50, quiet=True, cache_dir="cache", **options)
+    assert second["ok"], second["error"]
+    # Every stylesheet and image is revalidated instead of downloaded
+    assert site.conditional == 2 * (SITE_PAGES + 1)
+    if options.get("resumable"):
+        assert len(archive_names(second["saved_as"])) == SITE_FILES
+
+
+def test_crawl_follows_links_without_a_page_budget(site):
+    summary = download_website(site.url, max_depth=1, quiet=True)
+    assert summary["ok"], summary["error"]
+    assert len(archive_names(summary["saved_as"])) == SITE_FILES
+
+
+def test_single_page_by_default(site):
+    summary = download_website(site.url, quiet=True)
+    assert len(archive_names(summary["saved_as"])) == 3
+
+
+@pytest.mark.parametrize("engine", ["threads", "async"])
+def test_throttled_pages_and_resources_are_retried(site, engine):
+    if engine == "async":
+        pytest.importorskip("aiohttp")
+    site.errors = {"/page1.html": [429, 503], "/img/page2.png": [429], "/page3.html": [404]}
+    summary = download_website(site.url, max_depth=1, quiet=True, engine=engine)
+    assert summary["failed"] == 1
+    assert site.requests.count("/page1.html") == 3
+    assert site.requests.count("/img/page2.png") == 2
+    # An error status is not worth retrying
+    assert site.requests.count("/page3.html") == 1
+    names = archive_names(summary["saved_as"])
+    assert "html/page1.html" in names and "img/page2.png" in names
+
+
+def test_resumable_run_reports_the_exported_archive(site, monkeypatch):
+    reports = []
+    monkeypatch.setattr(main6, "show_compression_report", reports.append)
+    summary = download_website(site.url, max_depth=1, resumable=True, quiet=True)
+    assert summary["ok"], summary["error"]
+    stats = reports[0]
+    assert sum(entry["files"] for entry in stats.values()) == SITE_FILES
+
+
+@pytest.mark.parametrize("options", [{"output": "tar"}, {"compression": "rar"}, {"parser": "regex"},
+                                     {"srcset": "medium"}, {"compression": "lzma", "archive_processes": 2}])
+def test_bad_arguments_are_rejected_before_fetching(site, options):
+    with pytest.raises(ValueError):
+        download_website(site.url, quiet=True, **options)
+    assert site.requests == []
+    assert not glob.glob("website_*")
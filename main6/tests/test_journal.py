@@ -0,0 +1,100 @@
+import os
+import subprocess
+import sys
+import textwrap
+
+import pytest
+
+from journal import COMMIT_EVERY, JobJournal
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / "website_example_com_12345678.journal")
+
+
+def test_resume_sees_what_was_left(path):
+    journal = JobJournal(path)
+    assert journal.info() is None
+    journal.start({"url": "https://example.com/", "folder": "website_example_com_1", "output": "zip"})
+    journal.queue("https://example.com/a", "page", 1)
+    journal.queue("https://example.com/b", "page", 1)
+    journal.queue("https://example.com/x.css", "resource")
+    journal.queue("https://example.com/y.png", "resource")
+    journal.finish("https://example.com/a", True)
+    journal.finish("https://example.com/x.css", False)
+    journal.record_entry({"path": "y.png", "url": "https://example.com/y.png", "sha256": "00" * 32, "size": 3,
+                          "content_type": "image/png"})
+    journal.close()
+
+    journal = JobJournal(path)
+    assert journal.info()["folder"] == "website_example_com_1"
+    assert journal.known_pages() == {"https://example.com/a", "https://example.com/b"}
+    assert journal.unfinished("page") == [("https://example.com/b", 1)]
+    # Failed URLs are tried again
+    assert sorted(url for url, _ in journal.unfinished("resource")) == [
+        "https://example.com/x.css", "https://example.com/y.png"]
+    # A body stored just before the interruption counts as done
+    assert journal.done_urls() == {"https://example.com/a", "https://example.com/y.png"}
+    assert [entry["path"] for entry in journal.entries()] == ["y.png"]
+    journal.close()
+
+
+def test_start_forgets_the_previous_job(path):
+    journal = JobJournal(path)
+    journal.start({"url": "https://example.com/"})
+    journal.queue("https://example.com/a", "page", 1)
+    journal.start({"url": "https://example.com/other"})
+    assert journal.info() == {"url": "https://example.com/other"}
+    assert journal.known_pages() == set()
+    journal.close()
+
+
+def test_partial_download_resumes_from_checkpoint(path):
+    url = "https://example.com/big.bin"
+    journal = JobJournal(path)
+    journal.start({"url": "https://example.com/"})
+    assert journal.partial(url) == (0, None)
+    with journal.open_partial(url, 0) as file:
+        file.write(b"a" * 100)
+        journal.checkpoint(url, 60, '"etag"')
+    journal.close()
+
+    journal = JobJournal(path)
+    # Bytes written after the last checkpoint are not trusted
+    assert journal.partial(url) == (60, '"etag"')
+    with journal.open_partial(url, 60) as file:
+        assert file.tell() == 60
+    assert os.path.getsize(journal.partial_path(url)) == 60
+    journal.drop_partial(url)
+    assert journal.partial(url) == (0, None)
+    journal.close()
+
+
+def test_close_remove_deletes_everything(path):
+    journal = JobJournal(path)
+    journal.start({"url": "https://example.com/"})
+    journal.open_partial("https://example.com/big.bin", 0).close()
+    journal.close(remove=True)
+    assert not [name for name in os.listdir(os.path.dirname(path)) if name.startswith(os.path.basename(path))]
+
+
+def test_crash_keeps_changes_in_order(path):
+    # Changes are committed in batches; a crash loses only the newest ones
+    code = textwrap.dedent(f"""
+        import os, sys
+        sys.path.insert(0, {os.path.dirname(os.path.dirname(os.path.abspath(__file__)))!r})
+        from journal import JobJournal
+        journal = JobJournal({path!r})
+        journal.start({{"url": "https://example.com/"}})
+        for number in range(450):
+            journal.queue(f"https://example.com/{{number}}", "page", 1)
+        os._exit(1)
+    """)
+    subprocess.run([sys.executable, "-c", code], check=False)
+    journal = JobJournal(path)
+    assert journal.info() == {"url": "https://example.com/"}
+    pages = journal.known_pages()
+    assert pages == {f"https://example.com/{number}" for number in range(len(pages))}
+    assert len(pages) > 450 - COMMIT_EVERY
+    journal.close()
@@ -0,0 +1,170 @@
+import types
+from datetime import datetime, timezone
+from email.utils import format_datetime
+
+import pytest
+
+import politeness
+from politeness import MAX_THROTTLE_DELAY, AdaptiveLimit, HostScheduler, TokenBucket, retry_after_seconds
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(politeness, "time", types.SimpleNamespace(monotonic=clock.monotonic, time=clock.monotonic))
+    return clock
+
+
+def test_retry_after_seconds():
+    assert retry_after_seconds("120") == 120
+    assert retry_after_seconds(" 7 ") == 7
+    now = datetime(2024, 1, 1, 12, 0, tzinfo=timezone.utc).timestamp()
+    assert retry_after_seconds(format_datetime(datetime(2024, 1, 1, 12, 0, 30, tzinfo=timezone.utc), usegmt=True),
+                               now) == 30
+    # Dates in the past mean right away
+    assert retry_after_seconds("Mon, 01 Jan 2024 11:00:00 GMT", now) == 0
+    assert retry_after_seconds("soon") is None
+    assert retry_after_seconds("") is None
+    assert retry_after_seconds(None) is None
+
+
+def test_token_bucket(clock):
+    bucket = TokenBucket(rate=2, burst=2)
+    now = clock.now
+    assert bucket.delay(now) == 0
+    bucket.take(now)
+    bucket.take(now)
+    assert bucket.delay(now) == pytest.approx(0.5)
+    assert bucket.delay(now + 0.25) == pytest.approx(0.25)
+    assert bucket.delay(now + 0.5) == 0
+    # Idle time doesn't build up more than a burst
+    bucket.take(now + 0.5)
+    assert bucket.delay(now + 100) == 0
+    bucket.take(now + 100)
+    bucket.take(now + 100)
+    assert bucket.delay(now + 100) > 0
+
+
+def test_adaptive_limit_grows_while_saturated():
+    limit = AdaptiveLimit(initial=4, maximum=6)
+    now = 0.0
+    # About one more slot per round trip of the whole limit
+    for _ in range(5):
+        limit.sample(0.1, saturated=True, now=now)
+    assert limit.value == 5
+    # Not using every slot is no reason to grow
+    for _ in range(20):
+        limit.sample(0.1, saturated=False, now=now)
+    assert limit.value == 5
+    for _ in range(50):
+        limit.sample(0.1, saturated=True, now=now)
+    assert limit.value == 6
+
+
+def test_adaptive_limit_halves_once_per_round_trip():
+    limit = AdaptiveLimit(initial=16, maximum=32)
+    limit.sample(0.1, saturated=False, now=0.0)
+    limit.overloaded(1.0)
+    assert limit.value == 8
+    # Responses to requests sent before the decrease don't count again
+    limit.overloaded(1.05)
+    assert limit.value == 8
+    limit.overloaded(1.2)
+    assert limit.value == 4
+    for now in range(2, 10):
+        limit.overloaded(float(now))
+    assert limit.value == 1
+
+
+def test_adaptive_limit_backs_off_on_rising_latency():
+    limit = AdaptiveLimit(initial=10, maximum=32)
+    limit.sample(0.1, saturated=True, now=0.0)
+    limit.sample(0.5, saturated=True, now=1.0)
+    assert limit.limit == pytest.approx(9.0, abs=0.2)
+
+
+def test_scheduler_round_robin_across_hosts(clock):
+    hosts = HostScheduler(per_host=8, robots=False)
+    for name in ("a1", "a2", "a3"):
+        hosts.push(f"http://a.test/{name}", name)
+    hosts.push("http://b.test/b1", "b1")
+    assert len(hosts) == 4
+    assert [item for _, item in hosts.pop_ready(10)] == ["a1", "b1", "a2", "a3"]
+    assert len(hosts) == 0
+
+
+def test_scheduler_limits_requests_per_host(clock):
+    hosts = HostScheduler(per_host=2, robots=False)
+    for number in range(5):
+        hosts.push(f"http://a.test/{number}", number)
+    hosts.push("http://b.test/0", "b")
+    ready = hosts.pop_ready(10)
+    assert [item for _, item in ready] == [0, "b", 1]
+    assert hosts.limits()["a.test"] == (2, 2)
+    # Everything left waits for a running request, not for time
+    assert hosts.next_delay() is None
+    assert hosts.pop_ready(10) == []
+    hosts.done("http://a.test/0")
+    assert [item for _, item in hosts.pop_ready(10)] == [2]
+
+
+def test_scheduler_pop_ready_respects_limit_argument(clock):
+    hosts = HostScheduler(per_host=8, robots=False)
+    for number in range(4):
+        hosts.push(f"http://a.test/{number}", number)
+    assert len(hosts.pop_ready(3)) == 3
+    assert len(hosts) == 1
+
+
+def test_scheduler_rate_and_throttle(clock):
+    hosts = HostScheduler(per_host=8, rate=1, robots=False)
+    for number in range(3):
+        hosts.push(f"http://a.test/{number}", number)
+    assert [item for _, item in hosts.pop_ready(10)] == [0]
+    assert hosts.next_delay() == pytest.approx(1.0)
+    clock.now += 1
+    assert [item for _, item in hosts.pop_ready(10)] == [1]
+
+    hosts.throttle("http://a.test/2", 30)
+    clock.now += 1
+    assert hosts.pop_ready(10) == []
+    assert hosts.next_delay() == pytest.approx(29)
+    clock.now += 29
+    assert [item for _, item in hosts.pop_ready(10)] == [2]
+
+
+@pytest.mark.parametrize("retry_after", ["86400", "Fri, 01 Jan 2100 00:00:00 GMT"])
+def test_scheduler_caps_huge_retry_after(clock, retry_after):
+    hosts = HostScheduler(robots=False)
+    hosts.push("http://a.test/", "a")
+    hosts.throttle("http://a.test/", retry_after_seconds(retry_after))
+    assert hosts.next_delay() == pytest.approx(MAX_THROTTLE_DELAY)
+    clock.now += MAX_THROTTLE_DELAY
+    assert [item for _, item in hosts.pop_ready(10)] == ["a"]
+
+
+def test_scheduler_delayed_push(clock):
+    hosts = HostScheduler(robots=False)
+    hosts.push("http://a.test/later", "later", delay=5)
+    hosts.push("http://a.test/now", "now")
+    assert [item for _, item in hosts.pop_ready(10)] == ["now"]
+    assert hosts.next_delay() == pytest.approx(5)
+    clock.now += 5
+    assert [item for _, item in hosts.pop_ready(10)] == ["later"]
+
+
+def test_scheduler_sends_one_request_until_robots_is_read(clock):
+    hosts = HostScheduler(per_host=8, robots=True)
+    for number in range(3):
+        hosts.push(f"http://a.test/{number}", number)
+    assert len(hosts.pop_ready(10)) == 1
+    hosts._host("http://a.test/").robots_known = True
+    assert len(hosts.pop_ready(10)) == 2
@@ -0,0 +1,72 @@
+import io
+
+import pytest
+
+from rewrite import HtmlRewriter, LocalPaths, rewrite_page
+
+URL = "https://example.com/"
+
+PAGE = """<!DOCTYPE html>
+<html><head>
+<base href="https://example.com/">
+<link rel="stylesheet" href="/css/site.css">
+<style>body { background: url('img/bg.png') } @import "css/print.css";</style>
+<script>if (a < b && "</scr" + "ipt>") { document.write('<a href="/x">') }</script>
+<!-- <img src="/commented.png"> -- still a comment -->
+</head><body style="background-image: url(/img/bg.png)">
+<a href="/about.html#team" title='a > b'>About</a>
+<a href="https://other.example/page">Elsewhere</a>
+<img src="img/photo.jpg" srcset="img/photo-2x.jpg 2x, img/missing.jpg 3x">
+<p>1 < 2 and café <not a tag</p>
+</body></html>
+"""
+
+
+@pytest.fixture
+def paths():
+    paths = LocalPaths(URL)
+    paths.page(URL + "about.html")
+    for resource in ("css/site.css", "css/print.css", "img/bg.png", "img/photo.jpg", "img/photo-2x.jpg"):
+        paths.resource(URL + resource)
+    return paths
+
+
+def rewrite_in_chunks(paths, chunks):
+    rewriter = HtmlRewriter(URL, "html/index.html", paths)
+    return "".join(rewriter.feed(chunk) for chunk in chunks) + rewriter.close()
+
+
+def test_rewrites_references_to_local_copies(paths):
+    text = rewrite_in_chunks(paths, [PAGE])
+    assert 'href="../css/site.css"' in text
+    assert "url('../img/bg.png')" in text
+    assert 'href="about.html#team"' in text
+    assert 'href="https://other.example/page"' in text
+    assert 'srcset="../img/photo-2x.jpg 2x"' in text
+    assert "<base>" in text
+    # Scripts and comments are passed through untouched
+    assert """document.write('<a href="/x">')""" in text
+    assert '<img src="/commented.png">' in text
+
+
+@pytest.mark.parametrize("size", [1, 2, 3, 7, 8, 9, 31, 64, 100])
+def test_chunk_size_does_not_change_output(paths, size):
+    expected = rewrite_in_chunks(paths, [PAGE])
+    chunks = [PAGE[start:start + size] for start in range(0, len(PAGE), size)]
+    assert rewrite_in_chunks(paths, chunks) == expected
+
+
+def test_every_split_point_gives_same_output(paths):
+    expected = rewrite_in_chunks(paths, [PAGE])
+    for split in range(len(PAGE) + 1):
+        assert rewrite_in_chunks(paths, [PAGE[:split], PAGE[split:]]) == expected, split
+
+
+def test_rewrite_page_keeps_undecodable_bytes(paths):
+    body = PAGE.encode("utf-8") + b"<p>\xff\xfe</p>" + b"<img src='img/bg.png'>" * 20000
+    rewritten = rewrite_page(io.BytesIO(body), "utf-8", URL, "html/index.html", paths)
+    rewritten.seek(0)
+    data = rewritten.read()
+    expected = rewrite_in_chunks(paths, [body.decode("utf-8", errors="surrogateescape")])
+    assert data == expected.encode("utf-8", errors="surrogateescape")
+    assert b"\xff\xfe" in data
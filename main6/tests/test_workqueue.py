@@ -0,0 +1,83 @@
+import types
+
+import pytest
+
+import workqueue
+from workqueue import WorkQueue, new_run_id
+
+
+@pytest.fixture
+def queue(tmp_path):
+    queue = WorkQueue(str(tmp_path / "queue.sqlite"), lease_seconds=60, max_attempts=2)
+    yield queue
+    queue.close()
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(workqueue, "time", types.SimpleNamespace(time=lambda: now[0]))
+    return now
+
+
+def test_claim_and_complete(queue):
+    run = new_run_id()
+    assert queue.add(["http://a.test/", "http://b.test/"], run) == 2
+    assert queue.claim("w1") == "http://a.test/"
+    assert queue.claim("w2") == "http://b.test/"
+    assert queue.claim("w3") is None
+    assert queue.unfinished(run) == 2
+    assert queue.complete("w1", "http://a.test/", {"ok": True})
+    assert queue.complete("w2", "http://b.test/", {"ok": False, "error": "boom"})
+    assert queue.unfinished(run) == 0
+    results = queue.results(run=run)
+    assert [(summary["url"], summary["ok"]) for _, summary in results] == [
+        ("http://a.test/", True), ("http://b.test/", False)]
+    assert queue.results(after=results[0][0], run=run) == results[1:]
+
+
+def test_per_domain_limit(queue):
+    queue.add(["http://a.test/1", "http://a.test/2", "http://b.test/"])
+    assert queue.claim("w1") == "http://a.test/1"
+    assert queue.claim("w2") == "http://b.test/"
+    assert queue.claim("w3") is None
+    assert queue.claim("w3", per_domain=2) == "http://a.test/2"
+
+
+def test_expired_lease_goes_to_next_worker(queue, clock):
+    queue.add(["http://a.test/"])
+    assert queue.claim("w1") == "http://a.test/"
+    clock[0] += 30
+    assert queue.heartbeat("w1", ["http://a.test/"]) == []
+    # Renewed, so it has not expired 61s after the claim
+    clock[0] += 31
+    assert queue.claim("w2") is None
+    clock[0] += 30
+    assert queue.claim("w2") == "http://a.test/"
+    # The first worker finds out it lost the job, and its result is ignored
+    assert queue.heartbeat("w1", ["http://a.test/"]) == ["http://a.test/"]
+    assert not queue.complete("w1", "http://a.test/", {"ok": True})
+    assert queue.complete("w2", "http://a.test/", {"ok": True})
+
+
+def test_job_fails_after_max_attempts(queue, clock):
+    queue.add(["http://a.test/"])
+    for worker in ("w1", "w2"):
+        assert queue.claim(worker) == "http://a.test/"
+        clock[0] += 61
+    assert queue.claim("w3") is None
+    assert queue.unfinished() == 0
+    [(_, summary)] = queue.results()
+    assert summary == {"url": "http://a.test/", "ok": False, "error": "Worker died"}
+
+
+def test_runs_only_see_their_own_jobs(queue):
+    first, second = new_run_id(), new_run_id()
+    queue.add(["http://a.test/"], first)
+    queue.complete("w1", queue.claim("w1"), {"ok": True})
+    # Finished URLs are queued again by a later run
+    assert queue.add(["http://a.test/", "http://b.test/"], second) == 2
+    assert queue.unfinished(first) == 0
+    assert queue.unfinished(second) == 2
+    assert len(queue.results(run=first)) == 0
+    assert queue.claim("w1") == "http://a.test/"
@@ -0,0 +1,240 @@
+import contextvars
+import functools
+import json
+import os
+import sys
+import threading
+import time
+
+from logs import LOGGER
+
+# The tracer of the download running in this thread or task, None when not tracing
+current = contextvars.ContextVar("tracer", default=None)
+
+# Before 3.12 cProfile only sees the thread that enabled it, so every thread needs its own profiler;
+# since 3.12 one profiler sees all threads and a second one can't be enabled at all
+PROFILE_PER_THREAD = sys.version_info < (3, 12)
+
+# Span names shown in the per-run report, in pipeline order; others follow sorted by time
+STAGES = ("main page", "parse", "save page", "download page", "download file", "connect", "dns", "tcp",
+          "response", "body", "segments", "stylesheet", "write", "close archive", "export", "cleanup")
+
+
+class Span:
+    """Times one stage; the dict returned by `with` collects args such as byte counts."""
+
+    __slots__ = ("tracer", "name", "category", "args", "lane", "start")
+
+    def __init__(self, tracer, name, category, args, lane):
+        self.tracer = tracer
+        self.name = name
+        self.category = category
+        self.args = args
+        self.lane = lane
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self.args
+
+    def __exit__(self, exc_type, exc, traceback):
+        if exc_type is not None:
+            self.args["error"] = exc_type.__name__
+        self.tracer.record(self.name, self.start, time.perf_counter() - self.start, self.category, self.lane,
+                           **self.args)
+
+
+class NullSpan:
+    """What span() returns when nothing is traced."""
+
+    def __enter__(self):
+        return {}
+
+    def __exit__(self, exc_type, exc, traceback):
+        return None
+
+
+NULL_SPAN = NullSpan()
+
+
+class Tracer:
+    """Collects timed spans of one download_website() run.
+
+    Spans are kept as Chrome trace "complete" events (see to_chrome_trace()),
+    one row per thread, or per `lane` for coroutines sharing a thread. With
+    profile=True the threads of the download are profiled with cProfile:
+    before Python 3.12 each thread that runs work through run() has its own
+    profiler, since then one profiler started by start_profile() sees them
+    all. write_profile() merges them.
+    """
+
+    def __init__(self, profile=False):
+        self.started = time.perf_counter()
+        self.events = []
+        self.thread_names = {}
+        self.lock = threading.Lock()
+        self.profile = profile
+        self.profiles = []
+        self.local = threading.local()
+
+    def span(self, name, category="stage", lane=None, **args):
+        return Span(self, name, category, args, lane)
+
+    def record(self, name, start, duration, category="stage", lane=None, **args):
+        """Add a span that started at perf_counter() time `start` and took `duration` seconds."""
+        thread = threading.current_thread()
+        event = {
+            "name": name, "cat": category, "ph": "X", "pid": os.getpid(), "tid": lane or thread.ident,
+            "ts": round((start - self.started) * 1e6, 1), "dur": round(duration * 1e6, 1), "args": args,
+        }
+        with self.lock:
+            self.events.append(event)
+            if lane is None and thread.ident not in self.thread_names:
+                self.thread_names[thread.ident] = thread.name
+
+    def _profiler(self):
+        profiler = getattr(self.local, "profiler", None)
+        if profiler is None:
+            import cProfile
+
+            profiler = self.local.profiler = cProfile.Profile()
+            with self.lock:
+                self.profiles.append(profiler)
+        return profiler
+
+    def start_profile(self):
+        """Start the one profiler of the run, where it covers every thread (Python 3.12+)."""
+        if not self.profile or PROFILE_PER_THREAD:
+            return
+        import cProfile
+
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError as e:
+            raise RuntimeError(f"profile=True can't start cProfile, is another profiler running? ({e})")
+        with self.lock:
+            self.profiles.append(profiler)
+
+    def stop_profile(self):
+        if self.profile and not PROFILE_PER_THREAD:
+            with self.lock:
+                profiles = list(self.profiles)
+            for profiler in profiles:
+                profiler.disable()
+
+    def to_chrome_trace(self):
+        """Return the spans as a Chrome trace (chrome://tracing, ui.perfetto.dev)."""
+        with self.lock:
+            events = list(self.events)
+            names = dict(self.thread_names)
+        metadata = [{"name": "thread_name", "ph": "M", "pid": os.getpid(), "tid": tid, "args": {"name": name}}
+                    for tid, name in names.items()]
+        return {"traceEvents": metadata + events, "displayTimeUnit": "ms"}
+
+    def write(self, path):
+        with open(path, "w", encoding="utf-8") as file:
+            json.dump(self.to_chrome_trace(), file)
+
+    def write_profile(self, path):
+        """Merge the profiles of all threads into one pstats file, for python -m pstats or snakeviz."""
+        with self.lock:
+            profiles = list(self.profiles)
+        if not profiles:
+            return False
+        import pstats
+
+        stats = pstats.Stats(profiles[0])
+        for profiler in profiles[1:]:
+            stats.add(profiler)
+        stats.dump_stats(path)
+        return True
+
+    def report(self):
+        """Return {span name: (count, seconds, bytes)}, the time spent in each stage summed over threads."""
+        totals = {}
+        with self.lock:
+            events = list(self.events)
+        for event in events:
+            count, seconds, size = totals.get(event["name"], (0, 0.0, 0))
+            totals[event["name"]] = (count + 1, seconds + event["dur"] / 1e6, size + event["args"].get("bytes", 0))
+        order = {name: index for index, name in enumerate(STAGES)}
+        return dict(sorted(totals.items(), key=lambda item: (order.get(item[0], len(STAGES)), -item[1][1])))
+
+
+def span(name, category="stage", lane=None, **args):
+    """Time a stage of the current download, if it is traced:
+
+        with span("body", url=url) as info:
+            ...
+            info["bytes"] = size
+    """
+    tracer = current.get()
+    if tracer is None:
+        return NULL_SPAN
+    return tracer.span(name, category, lane, **args)
+
+
+def response_hook(response, *args, **kwargs):
+    """requests response hook adding a "response" span, from sending the request to having its headers."""
+    tracer = current.get()
+    if tracer is not None:
+        elapsed = response.elapsed.total_seconds()
+        tracer.record("response", time.perf_counter() - elapsed, elapsed, "network", url=response.url,
+                      status=response.status_code)
+
+
+def run(tracer, function, *args, **kwargs):
+    """Call function with tracer as the current tracer; before Python 3.12 also profiled if the tracer profiles."""
+    token = current.set(tracer)
+    try:
+        if tracer is None or not tracer.profile or not PROFILE_PER_THREAD:
+            return function(*args, **kwargs)
+        profiler = tracer._profiler()
+        profiler.enable()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            profiler.disable()
+    finally:
+        current.reset(token)
+
+
+def bind(function):
+    """Return function, bound to the current tracer so another thread (an executor's) traces into it too."""
+    tracer = current.get()
+    if tracer is None:
+        return function
+    return functools.partial(run, tracer, function)
+
+
+def traceable(function):
+    """Decorator adding trace= and profile= to download_website().
+
+    trace=True writes the spans of the run as a Chrome trace to
+    <name>.trace.json next to the ZIP and logs the time spent per stage;
+    profile=True profiles every thread of the run with cProfile into
+    <name>.pstats. The paths are added to the summary as "trace" and "profile".
+    """
+    @functools.wraps(function)
+    def wrapper(*args, trace=False, profile=False, **kwargs):
+        if not (trace or profile):
+            return function(*args, **kwargs)
+        tracer = Tracer(profile)
+        tracer.start_profile()
+        try:
+            summary = run(tracer, function, *args, **kwargs)
+        finally:
+            tracer.stop_profile()
+        if summary.get("name"):
+            if trace:
+                summary["trace"] = f"{summary['name']}.trace.json"
+                tracer.write(summary["trace"])
+                for name, (count, seconds, size) in tracer.report().items():
+                    LOGGER.info("  %-14s %6d x %9.3fs%s", name, count, seconds,
+                                f"  {size:,} bytes" if size else "", extra={"stage": name, "seconds": seconds})
+                LOGGER.info("Trace written to %s", summary["trace"])
+            if profile and tracer.write_profile(f"{summary['name']}.pstats"):
+                summary["profile"] = f"{summary['name']}.pstats"
+                LOGGER.info("Profile written to %s", summary["profile"])
+        return summary
+    return wrapper
@@ -0,0 +1,334 @@
+import ipaddress
+import os
+import socket
+import ssl
+import threading
+import time
+
+import requests
+from requests.adapters import BaseAdapter, HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.exceptions import ConnectTimeoutError, NewConnectionError
+
+from tracing import span
+
+# Hosts whose connection pools are kept open at the same time
+POOL_HOSTS = 100
+
+# How long a resolved host address is reused
+DNS_TTL = 300
+
+# Seconds a connection is idle before TCP keep-alive probes start, between probes, and probes before giving up
+KEEPALIVE_IDLE = 60
+KEEPALIVE_INTERVAL = 10
+KEEPALIVE_PROBES = 3
+
+# How long the HTTP/2 client keeps an idle connection open
+HTTP2_KEEPALIVE_EXPIRY = 30
+
+
+def keepalive_socket_options():
+    """Return socket options for TCP_NODELAY and TCP keep-alive, as far as the platform supports them."""
+    options = list(HTTPConnection.default_socket_options)
+    options.append((socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1))
+    # Linux calls the idle time TCP_KEEPIDLE, macOS TCP_KEEPALIVE
+    idle = getattr(socket, "TCP_KEEPIDLE", None) or getattr(socket, "TCP_KEEPALIVE", None)
+    if idle is not None:
+        options.append((socket.IPPROTO_TCP, idle, KEEPALIVE_IDLE))
+    if hasattr(socket, "TCP_KEEPINTVL"):
+        options.append((socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, KEEPALIVE_INTERVAL))
+    if hasattr(socket, "TCP_KEEPCNT"):
+        options.append((socket.IPPROTO_TCP, socket.TCP_KEEPCNT, KEEPALIVE_PROBES))
+    return options
+
+
+class DnsCache:
+    """Resolved addresses of hosts, reused for `ttl` seconds.
+
+    Every new connection otherwise asks the resolver again, which for a
+    crawl opening hundreds of connections to one CDN adds up. An address
+    that can't be connected to is forgotten, so the next connection resolves
+    the host again.
+    """
+
+    def __init__(self, ttl=DNS_TTL):
+        self.ttl = ttl
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def resolve(self, host, port):
+        """Return the addresses of host, or None if it can't be resolved (or is already an address)."""
+        try:
+            ipaddress.ip_address(host.strip("[]"))
+            return None
+        except ValueError:
+            pass
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get((host, port))
+            if entry and entry[0] > now:
+                return entry[1]
+        try:
+            infos = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+        except OSError:
+            # Left to the connection, which reports the error the usual way
+            return None
+        addresses = list(dict.fromkeys(info[4][0] for info in infos))
+        with self.lock:
+            self.entries[(host, port)] = (now + self.ttl, addresses)
+        return addresses
+
+    def forget(self, host, port):
+        with self.lock:
+            self.entries.pop((host, port), None)
+
+
+# Shared by all sessions of the process, so the sites of a batch run share it too
+DNS_CACHE = DnsCache()
+
+
+class TracedConnectionMixin:
+    """Adds the set-up of each new connection to the current trace.
+
+    "connect" covers all of it, TLS included, "tcp" the socket connection
+    (with the DNS lookup, unless it is cached).
+    """
+
+    def connect(self):
+        with span("connect", "network", host=self.host):
+            super().connect()
+
+    def _new_conn(self):
+        with span("tcp", "network", host=self.host):
+            return super()._new_conn()
+
+
+class CachedDnsMixin:
+    """Connects to the addresses in DNS_CACHE instead of resolving the host for every connection.
+
+    Only the address connected to changes, TLS still checks the certificate
+    against the host name.
+    """
+
+    def _new_conn(self):
+        with span("dns", "network", host=self._dns_host):
+            addresses = DNS_CACHE.resolve(self._dns_host, self.port)
+        if not addresses:
+            return super()._new_conn()
+        host = self._dns_host
+        error = None
+        try:
+            for address in addresses:
+                self._dns_host = address
+                try:
+                    return super()._new_conn()
+                except (NewConnectionError, ConnectTimeoutError) as e:
+                    error = e
+        finally:
+            self._dns_host = host
+        DNS_CACHE.forget(host, self.port)
+        raise error
+
+
+class TracedHTTPConnection(TracedConnectionMixin, HTTPConnection):
+    pass
+
+
+class TracedHTTPSConnection(TracedConnectionMixin, HTTPSConnection):
+    pass
+
+
+class CachedDnsHTTPConnection(TracedConnectionMixin, CachedDnsMixin, HTTPConnection):
+    pass
+
+
+class CachedDnsHTTPSConnection(TracedConnectionMixin, CachedDnsMixin, HTTPSConnection):
+    pass
+
+
+class TracedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = TracedHTTPConnection
+
+
+class TracedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = TracedHTTPSConnection
+
+
+class CachedDnsHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = CachedDnsHTTPConnection
+
+
+class CachedDnsHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = CachedDnsHTTPSConnection
+
+
+class TunedAdapter(HTTPAdapter):
+    """HTTPAdapter with TCP keep-alive on its sockets, traced connections and, if dns_cache is set, cached DNS lookups."""
+
+    __attrs__ = HTTPAdapter.__attrs__ + ["dns_cache"]
+
+    def __init__(self, dns_cache=True, **kwargs):
+        self.dns_cache = dns_cache
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, connections, maxsize, block=False, **pool_kwargs):
+        pool_kwargs.setdefault("socket_options", keepalive_socket_options())
+        super().init_poolmanager(connections, maxsize, block, **pool_kwargs)
+        if self.dns_cache:
+            self.poolmanager.pool_classes_by_scheme = {
+                "http": CachedDnsHTTPConnectionPool,
+                "https": CachedDnsHTTPSConnectionPool,
+            }
+        else:
+            self.poolmanager.pool_classes_by_scheme = {
+                "http": TracedHTTPConnectionPool,
+                "https": TracedHTTPSConnectionPool,
+            }
+
+
+# Headers that only concern one HTTP/1.1 connection, HTTP/2 forbids them
+HOP_BY_HOP_HEADERS = {"connection", "keep-alive", "proxy-connection", "transfer-encoding", "upgrade"}
+
+
+class Http2Body:
+    """File-like body of an httpx response, read by requests through Response.raw.
+
+    Also offers the bit of urllib3's response interface that requests reads
+    Set-Cookie headers through.
+    """
+
+    def __init__(self, httpx, response):
+        self.httpx = httpx
+        self.response = response
+        self.chunks = response.iter_bytes()
+        self.buffer = b""
+
+    def read(self, size=-1):
+        try:
+            while size < 0 or len(self.buffer) < size:
+                chunk = next(self.chunks, None)
+                if chunk is None:
+                    break
+                self.buffer += chunk
+        except self.httpx.HTTPError as e:
+            raise requests.ConnectionError(e)
+        if size < 0:
+            data, self.buffer = self.buffer, b""
+        else:
+            data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def close(self):
+        self.response.close()
+
+    @property
+    def _original_response(self):
+        return self
+
+    @property
+    def msg(self):
+        return self
+
+    def get_all(self, name, default=None):
+        return self.response.headers.get_list(name) or default
+
+
+class Http2Adapter(BaseAdapter):
+    """requests transport adapter that sends requests with httpx over HTTP/2.
+
+    Mounted for https://, so many small requests to one host share a few
+    multiplexed connections instead of one connection each. Servers that
+    don't offer h2 are spoken to in HTTP/1.1. requests still handles
+    redirects, cookies, hooks and the verify/cert settings; proxies are not
+    supported. Needs httpx with HTTP/2 support (pip install httpx[http2]).
+    """
+
+    def __init__(self, pool_size=10):
+        super().__init__()
+        try:
+            import h2  # noqa: F401
+            import httpx
+        except ImportError:
+            raise RuntimeError("HTTP/2 requires httpx with HTTP/2 support (pip install httpx[http2])")
+        self.httpx = httpx
+        self.pool_size = pool_size
+        # One connection pool per TLS setting (session.verify / session.cert)
+        self.transports = {}
+        self.lock = threading.Lock()
+
+    def _transport(self, verify, cert):
+        key = (verify, cert if isinstance(cert, (str, type(None))) else tuple(cert))
+        with self.lock:
+            transport = self.transports.get(key)
+            if transport is None:
+                context = verify
+                if isinstance(verify, str) or cert:
+                    context = ssl.create_default_context()
+                    if isinstance(verify, str):
+                        location = "capath" if os.path.isdir(verify) else "cafile"
+                        context.load_verify_locations(**{location: verify})
+                    elif not verify:
+                        context.check_hostname = False
+                        context.verify_mode = ssl.CERT_NONE
+                    if cert:
+                        context.load_cert_chain(*((cert,) if isinstance(cert, str) else cert))
+                limits = self.httpx.Limits(max_connections=None, max_keepalive_connections=self.pool_size,
+                                           keepalive_expiry=HTTP2_KEEPALIVE_EXPIRY)
+                transport = self.transports[key] = self.httpx.HTTPTransport(
+                    http2=True, verify=context, limits=limits, socket_options=keepalive_socket_options())
+            return transport
+
+    def send(self, request, stream=False, timeout=None, verify=True, cert=None, proxies=None):
+        httpx = self.httpx
+        connect, read = timeout if isinstance(timeout, tuple) else (timeout, timeout)
+        headers = [(name, value) for name, value in request.headers.items()
+                   if name.lower() not in HOP_BY_HOP_HEADERS]
+        outgoing = httpx.Request(request.method, request.url, headers=headers, content=request.body,
+                                 extensions={"timeout": {"connect": connect, "read": read, "write": read,
+                                                         "pool": connect}})
+        try:
+            incoming = self._transport(verify, cert).handle_request(outgoing)
+        except httpx.ConnectTimeout as e:
+            raise requests.ConnectTimeout(e, request=request)
+        except httpx.TimeoutException as e:
+            raise requests.ReadTimeout(e, request=request)
+        except httpx.HTTPError as e:
+            raise requests.ConnectionError(e, request=request)
+
+        response = requests.Response()
+        response.status_code = incoming.status_code
+        response.headers = CaseInsensitiveDict(incoming.headers.multi_items())
+        response.encoding = requests.utils.get_encoding_from_headers(response.headers)
+        response.raw = Http2Body(httpx, incoming)
+        response.reason = incoming.reason_phrase
+        response.url = request.url
+        response.request = request
+        response.connection = self
+        requests.cookies.extract_cookies_to_jar(response.cookies, request, response.raw)
+        if not stream:
+            response.content
+        return response
+
+    def close(self):
+        with self.lock:
+            for transport in self.transports.values():
+                transport.close()
+            self.transports.clear()
+
+
+def new_session(pool_size=10, pool_hosts=POOL_HOSTS, dns_cache=True, http2=False):
+    """Return a requests.Session with tuned connection pools.
+
+    Up to pool_size connections per host are kept open (for each of
+    pool_hosts hosts), with TCP keep-alive so idle ones aren't dropped
+    silently by firewalls and NAT. dns_cache=True reuses resolved addresses
+    for DNS_TTL seconds. http2=True sends https:// requests over HTTP/2 with
+    httpx (see Http2Adapter); plain http:// stays on HTTP/1.1.
+    """
+    session = requests.Session()
+    adapter = TunedAdapter(dns_cache, pool_connections=pool_hosts, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", Http2Adapter(pool_size) if http2 else adapter)
+    return session
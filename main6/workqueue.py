@@ -0,0 +1,172 @@
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from urllib.parse import urlparse
+
+# How long a claimed job stays with its worker without a heartbeat
+LEASE_SECONDS = 60
+
+# Jobs whose worker died this many times are given up as failed
+MAX_ATTEMPTS = 3
+
+# Numbers finished jobs in the order they finished, so results can be followed
+NEXT_FINISHED = "(SELECT COALESCE(MAX(finished), 0) + 1 FROM jobs)"
+
+
+def new_run_id():
+    return uuid.uuid4().hex
+
+
+def new_worker_id():
+    return f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+
+
+class WorkQueue:
+    """Queue of websites to download, shared by worker processes on one machine.
+
+    Backed by one SQLite file, so any local process that can open it can take
+    part. The file is in WAL mode, whose shared-memory index only works
+    between processes of one host: it must not be shared over NFS or SMB.
+    A worker claims a job with a lease and has to renew it with heartbeat()
+    while it works; jobs whose lease ran out, because their worker died or
+    hung, are handed to the next worker that asks. At most `per_domain` jobs
+    of one domain are leased at a time, across all workers. Jobs belong to the
+    run that last added their URL, so a queue file can be used for one batch
+    after another and each only reports its own results.
+    """
+
+    def __init__(self, path, lease_seconds=LEASE_SECONDS, max_attempts=MAX_ATTEMPTS):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        # Readers don't block the writer; needs every worker on this host
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            "id INTEGER PRIMARY KEY, url TEXT UNIQUE, domain TEXT, status TEXT, worker TEXT,"
+            "lease_until REAL, attempts INTEGER, result TEXT, finished INTEGER, run TEXT)"
+        )
+        # Queue files from before runs were recorded
+        columns = [row[1] for row in self.db.execute("PRAGMA table_info(jobs)")]
+        if "run" not in columns:
+            self.db.execute("ALTER TABLE jobs ADD COLUMN run TEXT")
+
+    def add(self, urls, run=None):
+        """Queue URLs for `run`; return how many were queued.
+
+        URLs finished by an earlier run are queued again, ones still queued or
+        leased are taken over by this run as they are.
+        """
+        added = 0
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                for url in urls:
+                    cursor = self.db.execute(
+                        "INSERT OR IGNORE INTO jobs (url, domain, status, attempts, run) VALUES (?, ?, 'queued', 0, ?)",
+                        (url, urlparse(url).netloc.lower(), run),
+                    )
+                    if not cursor.rowcount:
+                        cursor = self.db.execute(
+                            "UPDATE jobs SET status = 'queued', worker = NULL, attempts = 0, result = NULL, "
+                            "finished = NULL WHERE url = ? AND status IN ('done', 'failed')",
+                            (url,),
+                        )
+                        self.db.execute("UPDATE jobs SET run = ? WHERE url = ?", (run, url))
+                    added += cursor.rowcount
+            finally:
+                self.db.execute("COMMIT")
+        return added
+
+    def claim(self, worker, per_domain=1):
+        """Lease the next job to worker and return its URL, or None if nothing can be claimed now."""
+        now = time.time()
+        with self.lock:
+            # Takes the write lock up front, so two workers never claim the same job
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                self._expire(now)
+                row = self.db.execute(
+                    "SELECT id, url FROM jobs WHERE status = 'queued' AND domain NOT IN ("
+                    " SELECT domain FROM jobs WHERE status = 'leased' GROUP BY domain HAVING COUNT(*) >= ?"
+                    ") ORDER BY id LIMIT 1",
+                    (per_domain,),
+                ).fetchone()
+                if row:
+                    self.db.execute(
+                        "UPDATE jobs SET status = 'leased', worker = ?, lease_until = ?, attempts = attempts + 1 "
+                        "WHERE id = ?",
+                        (worker, now + self.lease_seconds, row[0]),
+                    )
+            finally:
+                self.db.execute("COMMIT")
+        return row[1] if row else None
+
+    def _expire(self, now):
+        # Jobs of dead workers go back to the queue, or fail once they used up their attempts
+        self.db.execute(
+            f"UPDATE jobs SET status = 'failed', worker = NULL, result = ?, finished = {NEXT_FINISHED} "
+            "WHERE status = 'leased' AND lease_until < ? AND attempts >= ?",
+            (json.dumps({"ok": False, "error": "Worker died"}), now, self.max_attempts),
+        )
+        self.db.execute(
+            "UPDATE jobs SET status = 'queued', worker = NULL WHERE status = 'leased' AND lease_until < ?", (now,)
+        )
+
+    def heartbeat(self, worker, urls):
+        """Extend the leases worker holds on urls; return the URLs it lost to another worker."""
+        lease_until = time.time() + self.lease_seconds
+        lost = []
+        with self.lock:
+            for url in urls:
+                cursor = self.db.execute(
+                    "UPDATE jobs SET lease_until = ? WHERE url = ? AND worker = ? AND status = 'leased'",
+                    (lease_until, url, worker),
+                )
+                if not cursor.rowcount:
+                    lost.append(url)
+        return lost
+
+    def complete(self, worker, url, result):
+        """Store the summary of a finished job; ignored if the lease was lost meanwhile."""
+        with self.lock:
+            cursor = self.db.execute(
+                f"UPDATE jobs SET status = ?, worker = NULL, result = ?, finished = {NEXT_FINISHED} "
+                "WHERE url = ? AND worker = ? AND status = 'leased'",
+                ("done" if result.get("ok") else "failed", json.dumps(result), url, worker),
+            )
+        return cursor.rowcount > 0
+
+    def unfinished(self, run=None):
+        """Return the number of jobs that are queued or leased, of `run` only if given."""
+        with self.lock:
+            self._expire(time.time())
+            if run is None:
+                query, args = "SELECT COUNT(*) FROM jobs WHERE status IN ('queued', 'leased')", ()
+            else:
+                query, args = "SELECT COUNT(*) FROM jobs WHERE status IN ('queued', 'leased') AND run = ?", (run,)
+            return self.db.execute(query, args).fetchone()[0]
+
+    def results(self, after=0, run=None):
+        """Return (position, summary) pairs of the jobs finished after position `after`, in finishing order.
+
+        With `run`, only the jobs of that run.
+        """
+        with self.lock:
+            if run is None:
+                query, args = "SELECT finished, url, result FROM jobs WHERE finished > ? ORDER BY finished", (after,)
+            else:
+                query, args = ("SELECT finished, url, result FROM jobs WHERE finished > ? AND run = ? "
+                               "ORDER BY finished", (after, run))
+            rows = self.db.execute(query, args).fetchall()
+        return [(finished, {"url": url, **json.loads(result)}) for finished, url, result in rows]
+
+    def close(self):
+        with self.lock:
+            self.db.close()